@@ -8,10 +8,9 @@ locals {
 
   environment = merge(
     var.environment,
-    {
-      QUEUE_URL     = var.queue_url
-      SCRAPE_CONFIG = var.scrape_config
-    }
+    { SCRAPE_CONFIG = var.scrape_config },
+    var.queue_url == null ? {} : { QUEUE_URL = var.queue_url },
+    var.sink_url == null ? {} : { SINK_URL = var.sink_url },
   )
 
 }
@@ -49,4 +48,11 @@ resource "aws_lambda_function" "this" {
     data.archive_file.this
   ]
 
+  lifecycle {
+    precondition {
+      condition     = (var.queue_url == null) != (var.sink_url == null)
+      error_message = "set exactly one of queue_url or sink_url"
+    }
+  }
+
 }
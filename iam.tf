@@ -60,18 +60,21 @@ data "aws_iam_policy_document" "this" {
     ]
   }
 
-  statement {
-    effect        = "Allow"
-    not_actions   = []
-    not_resources = []
-    actions = [
-      "sqs:SendMessage",
-      "sqs:SendMessageBatch",
-      "sqs:GetQueueAttributes"
-    ]
-    resources = [
-      var.queue_arn
-    ]
+  dynamic "statement" {
+    for_each = var.queue_arn == null ? [] : [var.queue_arn]
+    content {
+      effect        = "Allow"
+      not_actions   = []
+      not_resources = []
+      actions = [
+        "sqs:SendMessage",
+        "sqs:SendMessageBatch",
+        "sqs:GetQueueAttributes"
+      ]
+      resources = [
+        statement.value
+      ]
+    }
   }
 
 }
@@ -0,0 +1,126 @@
+"""
+times Associator mapping and metric association for synthetic ALB and API Gateway
+resources and metrics
+
+poetry run python scripts/benchmark_associator.py 10000 100000
+"""
+
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, f"{os.path.dirname(__file__)}/../src")
+
+from associator import Associator
+from model import CloudwatchMetric, Resource
+from services import _SERVICES_CONF, _Services
+
+_ARN_PREFIX = "arn:aws:elasticloadbalancing:eu-west-2:123456789012"
+_APIGW_PREFIX = "arn:aws:apigateway:eu-west-2::"
+
+
+def _alb_inputs(
+    num_metrics: int,
+) -> tuple[list[Resource], list[CloudwatchMetric]]:
+    num_lbs = max(num_metrics // 10, 1)
+    resources: list[Resource] = []
+    metrics: list[CloudwatchMetric] = []
+    for ix in range(num_lbs):
+        lb = f"app/lb-{ix}/{ix:016x}"
+        tg = f"targetgroup/tg-{ix}/{ix:016x}"
+        resources.append(
+            Resource(
+                ns="AWS/ApplicationELB", arn=f"{_ARN_PREFIX}:loadbalancer/{lb}", tags={}
+            )
+        )
+        resources.append(
+            Resource(ns="AWS/ApplicationELB", arn=f"{_ARN_PREFIX}:{tg}", tags={})
+        )
+
+    for ix in range(num_metrics):
+        lb_ix = ix % num_lbs
+        dimensions = {"LoadBalancer": f"app/lb-{lb_ix}/{lb_ix:016x}"}
+        if ix % 3 == 0:
+            dimensions["TargetGroup"] = f"targetgroup/tg-{lb_ix}/{lb_ix:016x}"
+        if ix % 5 == 0:
+            dimensions["AvailabilityZone"] = "eu-west-2a"
+        metrics.append(
+            CloudwatchMetric(
+                ns="AWS/ApplicationELB", name="RequestCount", dimensions=dimensions
+            )
+        )
+
+    return resources, metrics
+
+
+def _apigateway_inputs(
+    num_metrics: int,
+) -> tuple[list[Resource], list[CloudwatchMetric]]:
+    num_apis = max(num_metrics // 10, 1)
+    resources: list[Resource] = []
+    metrics: list[CloudwatchMetric] = []
+    for ix in range(num_apis):
+        resources.extend(
+            Resource(ns="AWS/ApiGateway", arn=f"{_APIGW_PREFIX}{suffix}", tags={})
+            for suffix in (
+                f"/restapis/rest-{ix}",
+                f"/restapis/rest-{ix}/stages/live",
+                f"/apis/http-{ix}",
+                f"/apis/http-{ix}/stages/live",
+                f"/apis/http-{ix}/routes/route-{ix}",
+            )
+        )
+
+    for ix in range(num_metrics):
+        api_ix = ix % num_apis
+        dimensions = (
+            {"ApiName": f"rest-{api_ix}"} if ix % 2 else {"ApiId": f"http-{api_ix}"}
+        )
+        if ix % 3 == 0:
+            dimensions["Stage"] = "live"
+        metrics.append(
+            CloudwatchMetric(ns="AWS/ApiGateway", name="Count", dimensions=dimensions)
+        )
+
+    return resources, metrics
+
+
+_INPUTS = {"alb": _alb_inputs, "apigateway": _apigateway_inputs}
+
+
+def run(service: str, num_metrics: int, repeat: int = 5):
+    services = _Services(_SERVICES_CONF)
+    mapping_times: list[float] = []
+    associate_times: list[float] = []
+    associated = 0
+    num_resources = 0
+
+    for _ in range(repeat):
+        resources, metrics = _INPUTS[service](num_metrics)
+        num_resources = len(resources)
+
+        started = perf_counter()
+        associator = Associator(services.get(service).rex, resources)
+        mapped = perf_counter()
+
+        associated = 0
+        for metric in metrics:
+            resource, skip = associator.associate_metric_to_resource(metric)
+            if resource and not skip:
+                associated += 1
+        finished = perf_counter()
+
+        mapping_times.append(mapped - started)
+        associate_times.append(finished - mapped)
+
+    print(
+        f"{service} metrics={num_metrics} resources={num_resources} associated={associated} "
+        f"get_mappings={min(mapping_times) * 1000:.1f}ms "
+        f"associate={min(associate_times) * 1000:.1f}ms (best of {repeat})"
+    )
+
+
+if __name__ == "__main__":
+    for service_name in _INPUTS:
+        for arg in sys.argv[1:] or ["10000", "100000"]:
+            run(service_name, int(arg))
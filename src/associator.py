@@ -1,4 +1,5 @@
 import re
+from dataclasses import dataclass
 
 from model import CloudwatchMetric, Resource
 
@@ -21,10 +22,13 @@ def _fix_dimension(ns: str, dimension: str, value: str) -> tuple[str, bool]:
 
 
 def _maybe_fix_sig(
-    ns: str, metric_dims: dict[str, str], mapping_dim_keys: set[str], try_fix: bool
+    ns: str,
+    metric_dims: dict[str, str],
+    mapping_dim_keys: tuple[str, ...],
+    try_fix: bool,
 ) -> tuple[tuple[tuple[str, str], ...], bool]:
     if not try_fix or ns not in ("AWS/AmazonMQ", "AWS/SageMaker"):
-        return tuple((k, metric_dims[k]) for k in mapping_dim_keys), False
+        return tuple([(k, metric_dims[k]) for k in mapping_dim_keys]), False
 
     was_fixed = False
     sig_parts = []
@@ -36,6 +40,14 @@ def _maybe_fix_sig(
     return tuple(sig_parts), was_fixed
 
 
+@dataclass
+class DimensionsMapping:
+    dim_names: frozenset[str]
+    # sorted, the same order as the signatures in resources
+    sig_keys: tuple[str, ...]
+    resources: dict[tuple[tuple[str, str], ...], Resource]
+
+
 class Associator:
 
     def __init__(
@@ -44,15 +56,13 @@ class Associator:
         self.dimensions_regexes = dimensions_regexes
         self.resources = resources
         self.mappings = self.get_mappings()
+        # metric dimension names -> first (most specific) mapping that applies
+        self._index: dict[frozenset[str], DimensionsMapping | None] = {}
 
-    def get_mappings(
-        self,
-    ) -> list[tuple[set[str], dict[tuple[tuple[str, str], ...], Resource]]]:
-        mappings: list[tuple[set[str], dict[tuple[tuple[str, str], ...], Resource]]] = (
-            []
-        )
+    def get_mappings(self) -> list[DimensionsMapping]:
+        mappings: list[DimensionsMapping] = []
         for rex in self.dimensions_regexes:
-            dim_names: set[str] | None = None
+            sig_keys: tuple[str, ...] | None = None
             mapped: dict[tuple[tuple[str, str], ...], Resource] = {}
             for resource in self.resources:
                 if resource.mapped:
@@ -64,14 +74,30 @@ class Associator:
                 sig = tuple(sorted(dims.items()))
                 mapped[sig] = resource
                 resource.mapped = True
-                if dim_names is None:
-                    dim_names = {a[0] for a in sig}
-            if dim_names:
-                mappings.append((dim_names, mapped))
+                if sig_keys is None:
+                    sig_keys = tuple(a[0] for a in sig)
+            if sig_keys:
+                mappings.append(
+                    DimensionsMapping(
+                        dim_names=frozenset(sig_keys),
+                        sig_keys=sig_keys,
+                        resources=mapped,
+                    )
+                )
 
-        mappings.sort(key=lambda x: len(x[0]), reverse=True)
+        mappings.sort(key=lambda x: len(x.dim_names), reverse=True)
         return mappings
 
+    def _get_mapping(self, dimension_names: frozenset[str]) -> DimensionsMapping | None:
+        if dimension_names in self._index:
+            return self._index[dimension_names]
+
+        mapping = next(
+            (m for m in self.mappings if m.dim_names.issubset(dimension_names)), None
+        )
+        self._index[dimension_names] = mapping
+        return mapping
+
     def associate_metric_to_resource(
         self, metric: CloudwatchMetric
     ) -> tuple[Resource | None, bool]:
@@ -79,27 +105,23 @@ class Associator:
         if not metric.dimension_names:
             return None, False
 
-        skip = False
-        for mapping_dim_keys, resources in self.mappings:
-
-            if not mapping_dim_keys.issubset(metric.dimension_names):
-                continue
-
-            skip = True
+        mapping = self._get_mapping(metric.dimension_names)
+        if not mapping:
+            return None, False
 
-            for try_fix in (True, False):
+        for try_fix in (True, False):
 
-                sig, fixed = _maybe_fix_sig(
-                    metric.ns, metric.dimensions, mapping_dim_keys, try_fix
-                )
-                found = resources.get(sig)
-                if found:
-                    return found, False
+            sig, fixed = _maybe_fix_sig(
+                metric.ns, metric.dimensions, mapping.sig_keys, try_fix
+            )
+            found = mapping.resources.get(sig)
+            if found:
+                return found, False
 
-                if not fixed:
-                    return None, True
+            if not fixed:
+                break
 
-        return None, skip
+        return None, True
 
 
 class NoOpAssociator:
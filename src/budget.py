@@ -0,0 +1,151 @@
+from collections import Counter, defaultdict
+from collections.abc import Hashable
+
+from clients import CloudWatchClient
+from model import (
+    BucketKey,
+    CloudwatchMetricTask,
+    DroppedMetrics,
+    ScrapeBudget,
+    ScrapePlan,
+)
+from shared import logger
+
+# plan index, (period, delay, length)
+type PlanBucket = tuple[int, BucketKey]
+
+
+def _shed_order(task: CloudwatchMetricTask) -> tuple:
+    # highest priority first, then a stable order so the same tasks are always shed
+    _ns, _name, dimensions, tags = task.signature
+    return -task.priority, task.ns, task.metric_name, dimensions, task.statistic, tags
+
+
+def shed(
+    budget: ScrapeBudget,
+    buckets: dict[PlanBucket, list[CloudwatchMetricTask]],
+    job_limit: bool = False,
+) -> tuple[dict[PlanBucket, list[CloudwatchMetricTask]], list[DroppedMetrics]]:
+    """
+        estimate the GetMetricData metrics and requests for the tasks and drop the lowest
+        priority tasks over the budget, tasks sharing a query are only counted once
+    Args:
+        budget: limits to apply
+        buckets: tasks by plan and bucket
+        job_limit: max_metrics is the limit for a single job
+
+    Returns:
+        the kept tasks by plan and bucket, in their original order, and what was dropped
+    """
+    ordered = sorted(
+        (
+            (plan_bucket, task)
+            for plan_bucket, tasks in buckets.items()
+            for task in tasks
+        ),
+        key=lambda item: (_shed_order(item[1]), item[0]),
+    )
+
+    kept_ids: set[int] = set()
+    queries: set[tuple[PlanBucket, Hashable]] = set()
+    ns_metrics: dict[str, int] = defaultdict(int)
+    bucket_usage: dict[PlanBucket, tuple[int, int]] = defaultdict(lambda: (0, 0))
+    total_metrics = 0
+    total_requests = 0
+    exhausted: str | None = None
+    dropped: Counter[tuple[str, str, str]] = Counter()
+
+    for plan_bucket, task in ordered:
+        if exhausted:
+            dropped[(task.ns, task.metric_name, exhausted)] += 1
+            continue
+
+        query = (plan_bucket, task.query_key)
+        if query in queries:
+            # shares a query with a task already kept
+            kept_ids.add(id(task))
+            continue
+
+        metrics = task.metric_count
+        ns_limit = budget.namespaces.get(task.ns, 0)
+        if ns_limit and ns_metrics[task.ns] + metrics > ns_limit:
+            dropped[(task.ns, task.metric_name, "namespace")] += 1
+            continue
+
+        if budget.max_metrics and total_metrics + metrics > budget.max_metrics:
+            exhausted = "job" if job_limit else "metrics"
+            dropped[(task.ns, task.metric_name, exhausted)] += 1
+            continue
+
+        period, _delay, length = plan_bucket[1]
+        sent, returned = bucket_usage[plan_bucket]
+        usage = (sent + 1 + len(task.rollup_dimensions), returned + 1)
+        requests = CloudWatchClient.metric_data_requests(
+            period, length, *usage
+        ) - CloudWatchClient.metric_data_requests(period, length, sent, returned)
+        if budget.max_requests and total_requests + requests > budget.max_requests:
+            exhausted = "requests"
+            dropped[(task.ns, task.metric_name, exhausted)] += 1
+            continue
+
+        kept_ids.add(id(task))
+        queries.add(query)
+        ns_metrics[task.ns] += metrics
+        bucket_usage[plan_bucket] = usage
+        total_metrics += metrics
+        total_requests += requests
+
+    kept = {
+        plan_bucket: [task for task in tasks if id(task) in kept_ids]
+        for plan_bucket, tasks in buckets.items()
+    }
+    return kept, [
+        DroppedMetrics(ns=ns, name=name, reason=reason, count=count)
+        for (ns, name, reason), count in sorted(dropped.items())
+    ]
+
+
+def apply_budget(
+    budget: ScrapeBudget, plans: list[ScrapePlan]
+) -> tuple[list[ScrapePlan], list[DroppedMetrics]]:
+    """
+        shed tasks from the scrape plans of an invocation to keep within the budget, before
+        anything is fetched
+    Args:
+        budget: invocation and namespace limits
+        plans: the plan for each region/role
+
+    Returns:
+        the plans, rebuilt without the dropped tasks where any were dropped, and what was
+        dropped
+    """
+    buckets = {
+        (plan_ix, bucket): [task for batch in batches for task in batch.tasks]
+        for plan_ix, plan in enumerate(plans)
+        for bucket, batches in plan.buckets.items()
+    }
+    kept, dropped = shed(budget, buckets)
+    if not dropped:
+        return plans, dropped
+
+    governed: list[ScrapePlan] = []
+    for plan_ix, plan in enumerate(plans):
+        plan_buckets = {}
+        for (period, delay, length), batches in plan.buckets.items():
+            tasks = kept[(plan_ix, (period, delay, length))]
+            if sum(len(batch.tasks) for batch in batches) == len(tasks):
+                plan_buckets[(period, delay, length)] = batches
+            elif tasks:
+                plan_buckets[(period, delay, length)] = (
+                    CloudWatchClient.build_metric_data_batches(period, length, tasks)
+                )
+        governed.append(ScrapePlan(key=plan.key, buckets=plan_buckets))
+
+    return governed, dropped
+
+
+def log_dropped(context: str, dropped: list[DroppedMetrics]):
+    logger.warning(
+        f"{context} over budget, dropped "
+        + ", ".join(f"{d.count} {d.ns} {d.name} ({d.reason})" for d in dropped)
+    )
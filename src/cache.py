@@ -0,0 +1,320 @@
+import asyncio
+import os
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass, replace
+from time import time
+
+from model import (
+    BucketKey,
+    CloudwatchMetric,
+    MetricTaskSignature,
+    Resource,
+    ScrapePlan,
+    ScrapePlanKey,
+)
+from shared import logger
+
+# region, role, namespace, metric name, linked_accounts, recently_active_only
+type ListMetricsKey = tuple[str, str | None, str, str, bool, bool]
+
+# region, role, namespace, resource type filters, search tag keys
+type ResourcesKey = tuple[str, str | None, str, tuple[str, ...], tuple[str, ...]]
+
+# region, role, (period, delay, length), metric task signature, a series fetched at
+# several periods has a mark per period
+type HighWaterMarkKey = tuple[str, str | None, BucketKey, MetricTaskSignature]
+
+
+@dataclass
+class CacheEntry[V]:
+    value: V
+    fetched_at: float
+
+
+class TTLCache[K: Hashable, V]:
+    """
+        module level cache that survives warm lambda invocations, entries older than the ttl
+        are still returned, but are refreshed in the background for subsequent calls
+    Args:
+        name: used in log messages
+        ttl: seconds before an entry is considered stale, <= 0 disables the cache
+    """
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self._entries: dict[K, CacheEntry[V]] = {}
+        self._refreshing: dict[K, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._refreshing.clear()
+
+    def peek(self, key: K) -> CacheEntry[V] | None:
+        return self._entries.get(key)
+
+    def put(self, key: K, value: V, fetched_at: float | None = None):
+        self._entries[key] = CacheEntry(
+            value=value, fetched_at=time() if fetched_at is None else fetched_at
+        )
+
+    def items(self) -> list[tuple[K, CacheEntry[V]]]:
+        return list(self._entries.items())
+
+    def is_stale(self, entry: CacheEntry[V]) -> bool:
+        return time() - entry.fetched_at > self.ttl
+
+    async def get(self, key: K, fetch: Callable[[], Awaitable[V]]) -> V:
+
+        if not self.enabled:
+            return await fetch()
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return await self._fetch(key, fetch)
+
+        if self.is_stale(entry):
+            self._refresh_in_background(key, fetch)
+
+        return entry.value
+
+    async def _fetch(self, key: K, fetch: Callable[[], Awaitable[V]]) -> V:
+        value = await fetch()
+        self.put(key, value)
+        return value
+
+    def _refresh_in_background(self, key: K, fetch: Callable[[], Awaitable[V]]):
+
+        existing = self._refreshing.get(key)
+        if existing and not existing.done():
+            return
+
+        task = asyncio.create_task(self._fetch(key, fetch))
+        self._refreshing[key] = task
+
+        def _done(completed: asyncio.Task):
+            if self._refreshing.get(key) is completed:
+                self._refreshing.pop(key, None)
+            if completed.cancelled():
+                return
+            error = completed.exception()
+            if error:
+                logger.warning(
+                    f"{self.name} background refresh failed for {key}", exc_info=error
+                )
+
+        task.add_done_callback(_done)
+
+    async def wait_for_refreshes(self, timeout: float | None = None):
+        """
+            wait for the background refreshes, a lambda frozen with refreshes pending
+            resumes them mid request on a later invocation
+        Args:
+            timeout: seconds to wait, refreshes still running are then cancelled
+        """
+        pending = [task for task in self._refreshing.values() if not task.done()]
+        if not pending:
+            return
+
+        _, running = await asyncio.wait(pending, timeout=timeout)
+        if running:
+            logger.warning(
+                f"{self.name} cancelling {len(running)} background refreshes"
+            )
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+class Coalescer[K: Hashable, V]:
+    """
+    executes identical requests once, concurrent and later callers with the same key
+    share the result, intended to live for a single invocation
+    """
+
+    def __init__(self):
+        self._requests: dict[K, asyncio.Future[V]] = {}
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+    async def get(self, key: K, fetch: Callable[[], Awaitable[V]]) -> V:
+
+        request = self._requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(fetch())
+            self._requests[key] = request
+
+        # shield so a cancelled caller does not cancel the request for everyone else
+        return await asyncio.shield(request)
+
+
+@dataclass
+class ResourcesEntry:
+    resources: list[Resource]
+    fetched_at: float
+    checked_at: float
+
+
+class ResourceCache:
+    """
+        module level tagging api resource cache, refreshed on a slower cadence than metrics
+        collection, between full refreshes the known resources can be re-checked by arn
+    Args:
+        name: used in log messages
+        ttl: seconds between full refreshes, <= 0 disables the cache
+        incremental_ttl: seconds between re-checking known arns, <= 0 disables incremental refresh
+    """
+
+    def __init__(self, name: str, ttl: float, incremental_ttl: float = 0):
+        self.name = name
+        self.ttl = ttl
+        self.incremental_ttl = incremental_ttl
+        self._entries: dict[ResourcesKey, ResourcesEntry] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def items(self) -> list[tuple[ResourcesKey, ResourcesEntry]]:
+        return list(self._entries.items())
+
+    def peek(self, key: ResourcesKey) -> ResourcesEntry | None:
+        return self._entries.get(key)
+
+    def put(
+        self,
+        key: ResourcesKey,
+        resources: list[Resource],
+        fetched_at: float | None = None,
+        checked_at: float | None = None,
+    ):
+        fetched_at = time() if fetched_at is None else fetched_at
+        self._entries[key] = ResourcesEntry(
+            resources=resources,
+            fetched_at=fetched_at,
+            checked_at=fetched_at if checked_at is None else checked_at,
+        )
+
+    async def get(
+        self,
+        key: ResourcesKey,
+        fetch_all: Callable[[], Awaitable[list[Resource]]],
+        fetch_by_arn: Callable[[list[str]], Awaitable[list[Resource]]],
+    ) -> list[Resource]:
+        """
+            get resources for the key, resources are copied as they are mutated during association
+        Args:
+            key: cache key
+            fetch_all: full refresh
+            fetch_by_arn: incremental refresh of known arns
+
+        Returns:
+            copies of the cached resources
+        """
+
+        if not self.enabled:
+            return await fetch_all()
+
+        now = time()
+        entry = self._entries.get(key)
+
+        if entry is None or now - entry.fetched_at > self.ttl:
+            self.put(key, await fetch_all(), fetched_at=now)
+        elif 0 < self.incremental_ttl < now - entry.checked_at:
+            try:
+                entry.resources = await fetch_by_arn(
+                    [resource.arn for resource in entry.resources]
+                )
+                entry.checked_at = now
+            except Exception:
+                logger.warning(
+                    f"{self.name} incremental refresh failed for {key}", exc_info=True
+                )
+
+        return [
+            replace(resource, mapped=False) for resource in self._entries[key].resources
+        ]
+
+
+@dataclass
+class HighWaterMark:
+    # timestamp of the latest emitted datapoint
+    timestamp: float
+    # once past, the mark is older than any window it could shorten
+    expires_at: float
+
+
+class HighWaterMarks:
+    """
+        module level timestamps of the latest datapoint emitted per series, used to only
+        request datapoints newer than those already emitted, survives warm lambda invocations
+    Args:
+        name: used in log messages
+        enabled: whether scrapes use the marks
+    """
+
+    def __init__(self, name: str, enabled: bool):
+        self.name = name
+        self.enabled = enabled
+        self._marks: dict[HighWaterMarkKey, HighWaterMark] = {}
+
+    def __len__(self) -> int:
+        return len(self._marks)
+
+    def clear(self):
+        self._marks.clear()
+
+    def get(self, key: HighWaterMarkKey) -> float | None:
+        mark = self._marks.get(key)
+        return mark.timestamp if mark else None
+
+    def items(self) -> list[tuple[HighWaterMarkKey, HighWaterMark]]:
+        return list(self._marks.items())
+
+    def advance(self, key: HighWaterMarkKey, timestamp: float, expires_at: float):
+        mark = self._marks.get(key)
+        if mark and mark.timestamp >= timestamp:
+            return
+        self._marks[key] = HighWaterMark(timestamp=timestamp, expires_at=expires_at)
+
+    def prune(self, now: float | None = None):
+        now = time() if now is None else now
+        expired = [key for key, mark in self._marks.items() if mark.expires_at < now]
+        for key in expired:
+            del self._marks[key]
+        if expired:
+            logger.info(f"{self.name} pruned {len(expired)} expired marks")
+
+
+LIST_METRICS_CACHE: TTLCache[ListMetricsKey, list[CloudwatchMetric]] = TTLCache(
+    "list_metrics", float(os.environ.get("DISCOVERY_CACHE_TTL", 0))
+)
+
+RESOURCE_CACHE = ResourceCache(
+    "resources",
+    float(os.environ.get("RESOURCE_CACHE_TTL", 0)),
+    float(os.environ.get("RESOURCE_CACHE_INCREMENTAL_TTL", 0)),
+)
+
+SCRAPE_PLAN_CACHE: TTLCache[ScrapePlanKey, ScrapePlan] = TTLCache(
+    "scrape_plan", float(os.environ.get("SCRAPE_PLAN_TTL", 0))
+)
+
+HIGH_WATER_MARKS = HighWaterMarks(
+    "high_water_marks",
+    os.environ.get("INCREMENTAL_WINDOWS", "false").lower() == "true",
+)
@@ -2,10 +2,11 @@ import asyncio
 import json
 import os
 from abc import ABC, abstractmethod
-from asyncio import Semaphore
 from collections.abc import AsyncGenerator, Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
 from functools import partial
 from math import ceil
+from time import monotonic
 from typing import Any, TypeVar, cast
 
 import boto3
@@ -13,24 +14,97 @@ import botocore.credentials
 import botocore.session
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from envelope import SQS_ENVELOPE, entry_size, pack_batches, pack_envelopes
+from limiter import (
+    API_MAX_ATTEMPTS,
+    API_MAX_CONCURRENCY_FACTOR,
+    AdaptiveLimiter,
+    is_retryable_error,
+    retry_delay,
+    with_retries,
+    with_retries_sync,
+)
 from model import (
     CloudwatchMetric,
     CloudwatchMetricResult,
     CloudwatchMetricTask,
     DiscoveryJob,
-    MetricRequest,
+    EmitThroughput,
+    InsightsQuery,
+    MetricDataBatch,
+    MetricQueryKey,
     Resource,
-    StaticJob,
 )
-from shared import get_start_end
+from shared import logger
+from spill import SpillBuffer
+from transport import AWS_TRANSPORT, AsyncTransport
+
+# GetMetricData limits per request
+METRIC_DATA_MAX_QUERIES = 500
+METRIC_DATA_MAX_DATAPOINTS = 100_800
+
+# upper bound on the threads and http connections for any one client
+AWS_CLIENT_MAX_THREADS = int(os.environ.get("AWS_CLIENT_MAX_THREADS", 32))
+
+_EXECUTORS: dict[tuple[str, str, str | None], ThreadPoolExecutor] = {}
+
+
+def get_executor(
+    client_name: str, region: str, role: str | None, max_workers: int
+) -> ThreadPoolExecutor:
+    """
+        thread pool for a client, kept for the life of the process so warm invocations
+        reuse the threads
+    Args:
+        client_name: boto3 service name
+        region: client region
+        role: the role assumed, None for the lambda's own role
+        max_workers: threads needed, usually the client's concurrency
+
+    Returns:
+        the client's executor
+    """
+    key = (client_name, region, role)
+    executor = _EXECUTORS.get(key)
+    if not executor:
+        executor = ThreadPoolExecutor(
+            max_workers=min(max_workers, AWS_CLIENT_MAX_THREADS),
+            thread_name_prefix=f"{client_name}-{region}",
+        )
+        _EXECUTORS[key] = executor
+    return executor
+
+
+_LIMITERS: dict[tuple[str, str, str | None], AdaptiveLimiter] = {}
 
 
-async def run_in_executor[T](func: Callable[..., T], *args, **kwargs) -> T:
+def get_limiter(
+    client_name: str, region: str, role: str | None, limiter: AdaptiveLimiter
+) -> AdaptiveLimiter:
+    """
+        concurrency limiter for a client, kept for the life of the process so the limit
+        learned from throttling carries over to warm invocations
+    Args:
+        client_name: boto3 service name
+        region: client region
+        role: the role assumed, None for the lambda's own role
+        limiter: the client's own limiter, used the first time
+
+    Returns:
+        the client's limiter
+    """
+    return _LIMITERS.setdefault((client_name, region, role), limiter)
+
+
+async def run_in_executor[T](
+    func: Callable[..., T], *args, executor: Executor | None = None, **kwargs
+) -> T:
     """
         async wrapper for sync code
     Args:
         func: the function to call
         *args: positional args to pass to fund
+        executor: executor to run func in, None for the loop's default executor
         **kwargs: kwargs to pass to func
 
     Returns:
@@ -39,11 +113,19 @@ async def run_in_executor[T](func: Callable[..., T], *args, **kwargs) -> T:
     loop = asyncio.get_running_loop()
 
     to_execute = partial(func, *args, **kwargs)
-    result = cast(T, await loop.run_in_executor(None, to_execute))
+    result = cast(T, await loop.run_in_executor(executor, to_execute))
 
     return result
 
 
+def with_pool_connections(config: Config, concurrency: int) -> Config:
+    # enough http connections for every thread, so requests don't wait on the pool
+    connections = min(concurrency, AWS_CLIENT_MAX_THREADS)
+    if config.max_pool_connections >= connections:
+        return config
+    return config.merge(Config(max_pool_connections=connections))
+
+
 class RegionRoleClient:
 
     def __init__(
@@ -53,39 +135,75 @@ class RegionRoleClient:
         session: boto3.Session = None,
         concurrency: int = 5,
         pagination_token_name: str = "PaginationToken",
+        tps: float = 0,
     ):
         session = session or boto3
-        self.client: boto3.client = session.client(client_name, config=config)
-        self._sf: Semaphore = Semaphore(concurrency)
+        self.client_name = client_name
+        self.limiter = AdaptiveLimiter(
+            f"{client_name} {config.region_name}",
+            initial=concurrency,
+            max_limit=min(
+                ceil(concurrency * API_MAX_CONCURRENCY_FACTOR), AWS_CLIENT_MAX_THREADS
+            ),
+            tps=tps,
+        )
+        # threads and connections for the most the limiter can grow to
+        self.concurrency = self.limiter.max_limit
+        self.client: boto3.client = session.client(
+            client_name,
+            config=with_pool_connections(config, self.concurrency).merge(
+                # throttling is retried by with_retries, so the limiter sees it
+                Config(retries={"mode": "standard", "total_max_attempts": 1})
+            ),
+        )
+        # assigned by ClientFactory, the loop's default executor until then
+        self.executor: ThreadPoolExecutor | None = None
         self._pagination_token_name = pagination_token_name
+        self._transport: AsyncTransport | None = (
+            AsyncTransport(self.client) if AWS_TRANSPORT == "asyncio" else None
+        )
+
+    async def _call(self, method_name: str, **kwargs) -> dict:
+        """
+            make an api call under the client's limiter, with retries
+        Args:
+            method_name: the boto3 client method e.g. list_metrics
+            **kwargs: api parameters
+
+        Returns:
+            the response
+        """
+        return await with_retries(
+            self.limiter, partial(self._call_once, method_name, **kwargs)
+        )
+
+    async def _call_once(self, method_name: str, **kwargs) -> dict:
+        if self._transport:
+            return await self._transport.call(method_name, **kwargs)
+        return cast(
+            dict,
+            await run_in_executor(
+                getattr(self.client, method_name), executor=self.executor, **kwargs
+            ),
+        )
 
     async def _paginate(
-        self, paginator_name: str, pagination_token_name: str | None = None, **kwargs
+        self, method_name: str, pagination_token_name: str | None = None, **kwargs
     ) -> AsyncGenerator[dict, None]:
 
         pagination_token_name = pagination_token_name or self._pagination_token_name
 
-        paginator = self.client.get_paginator(paginator_name)
-
-        page_iterator = paginator.paginate(**kwargs).__iter__()
+        # the operations paginated here use the same name for the input and output
+        # token, each page is requested (and retried) separately
+        while True:
+            page = await self._call(method_name, **kwargs)
 
-        def _get_next_page():
-            try:
-                return page_iterator.__next__()
-            except StopIteration:
-                return None
-
-        async with self._sf:
-            page = await run_in_executor(_get_next_page)
-
-        while page:
             pagination_token = page.get(pagination_token_name, None)
             yield page
             if not pagination_token:
                 break
 
-            async with self._sf:
-                page = await run_in_executor(_get_next_page)
+            kwargs[pagination_token_name] = pagination_token
 
 
 class CloudWatchClient(RegionRoleClient):
@@ -95,6 +213,7 @@ class CloudWatchClient(RegionRoleClient):
             config,
             session,
             int(os.environ.get("METRICS_API_CONCURRENCY", 5)),
+            tps=float(os.environ.get("METRICS_API_TPS", 0)),
         )
 
     async def list_metrics(
@@ -123,132 +242,293 @@ class CloudWatchClient(RegionRoleClient):
 
             yield results
 
+    @staticmethod
+    def metric_data_batch_size(period: int, length: int) -> int:
+        """
+            the most queries that fit in one GetMetricData request, each query returns up
+            to length / period datapoints
+        Args:
+            period: metric period in seconds
+            length: window length in seconds
+
+        Returns:
+            max queries per request
+        """
+        datapoints = max(ceil(length / max(period, 1)), 1)
+        return max(
+            min(METRIC_DATA_MAX_QUERIES, METRIC_DATA_MAX_DATAPOINTS // datapoints), 1
+        )
+
+    @staticmethod
+    def metric_data_requests(
+        period: int, length: int, queries: int, returned: int
+    ) -> int:
+        """
+            the fewest GetMetricData requests for a window
+        Args:
+            period: metric period in seconds
+            length: window length in seconds
+            queries: queries sent, including the series of rollups
+            returned: queries returning data
+
+        Returns:
+            requests needed to stay within both the query and datapoint limits
+        """
+        return max(
+            ceil(queries / METRIC_DATA_MAX_QUERIES),
+            ceil(returned / CloudWatchClient.metric_data_batch_size(period, length)),
+        )
+
+    @staticmethod
+    def max_rollup_series() -> int:
+        # a rollup and its series are sent in the same request
+        return METRIC_DATA_MAX_QUERIES - 1
+
+    @staticmethod
+    def build_metric_data_batches(
+        period: int, length: int, metric_tasks: list[CloudwatchMetricTask]
+    ) -> list[MetricDataBatch]:
+        """
+            split metric tasks into GetMetricData batches and build the query payloads,
+            these can be kept and reused as long as the tasks are unchanged
+        Args:
+            period: metric period in seconds
+            length: window length in seconds, batches are packed up to both the query and
+                datapoint limits for the window
+            metric_tasks: tasks to batch
+
+        Returns:
+            batches with their MetricDataQueries
+        """
+        # tasks differing only by tags, e.g. from jobs exporting different tags, share
+        # one query
+        by_query: dict[MetricQueryKey, list[CloudwatchMetricTask]] = {}
+        for task in metric_tasks:
+            by_query.setdefault(task.query_key, []).append(task)
+        unique_queries = list(by_query.values())
+
+        # a rollup also sends a query for each of its series, but only returns one
+        costs = [1 + len(group[0].rollup_dimensions) for group in unique_queries]
+        num_batches = max(
+            CloudWatchClient.metric_data_requests(
+                period, length, sum(costs), len(unique_queries)
+            ),
+            1,
+        )
+        # spread evenly over the fewest batches
+        max_queries = ceil(sum(costs) / num_batches)
+        max_returned = ceil(len(unique_queries) / num_batches)
+
+        batches: list[MetricDataBatch] = []
+        batch: list[list[CloudwatchMetricTask]] = []
+        batch_cost = 0
+        for query_group, cost in zip(unique_queries, costs, strict=True):
+            if batch and (
+                batch_cost + cost > max_queries or len(batch) >= max_returned
+            ):
+                batches.append(CloudWatchClient._metric_data_batch(period, batch))
+                batch = []
+                batch_cost = 0
+            batch.append(query_group)
+            batch_cost += cost
+
+        if batch:
+            batches.append(CloudWatchClient._metric_data_batch(period, batch))
+
+        return batches
+
+    @staticmethod
+    def _metric_data_batch(
+        period: int, query_groups: list[list[CloudwatchMetricTask]]
+    ) -> MetricDataBatch:
+
+        def _metric_stat(task: CloudwatchMetricTask, dimensions: dict[str, str]):
+            return {
+                "Metric": {
+                    "Namespace": task.ns,
+                    "MetricName": task.metric_name,
+                    "Dimensions": [
+                        {"Name": k, "Value": v} for k, v in dimensions.items()
+                    ],
+                },
+                "Period": period,
+                "Stat": task.statistic,
+                # 'Unit': 'Seconds'|'Microseconds'|'Milliseconds'|'Bytes'|'Kilobytes'|'Megabytes'
+                # |'Gigabytes'|'Terabytes'|'Bits'|'Kilobits'|'Megabits'|'Gigabits'|'Terabits'
+                # |'Percent'|'Count'|'Bytes/Second'|'Kilobytes/Second'|'Megabytes/Second'
+                # |'Gigabytes/Second'|'Terabytes/Second'|'Bits/Second'
+                # |'Kilobits/Second'|'Megabits/Second'|'Gigabits/Second'|'Terabits/Second'|'Count/Second'|'None'
+            }
+
+        tasks: list[CloudwatchMetricTask] = []
+        queries: list[dict] = []
+        query_tasks: list[list[int]] = []
+
+        for ix, query_group in enumerate(query_groups):
+            task = query_group[0]
+            if task.rollup:
+                series_ids = [f"s{ix}_{j}" for j in range(len(task.rollup_dimensions))]
+                queries.extend(
+                    {
+                        "Id": series_id,
+                        "MetricStat": _metric_stat(task, dimensions),
+                        "ReturnData": False,
+                    }
+                    for series_id, dimensions in zip(
+                        series_ids, task.rollup_dimensions, strict=True
+                    )
+                )
+                queries.append(
+                    {
+                        "Id": f"m{ix}",
+                        "Expression": f"{task.rollup}([{', '.join(series_ids)}])",
+                        "ReturnData": True,
+                    }
+                )
+            else:
+                queries.append(
+                    {
+                        "Id": f"m{ix}",
+                        "MetricStat": _metric_stat(task, task.dimensions),
+                        "ReturnData": True,
+                    }
+                )
+            query_tasks.append(list(range(len(tasks), len(tasks) + len(query_group))))
+            tasks.extend(query_group)
+
+        return MetricDataBatch(tasks=tasks, queries=queries, query_tasks=query_tasks)
+
     async def get_metric_data(
         self,
-        period: int,
         start: float,
         end: float,
-        metric_tasks: list[CloudwatchMetricTask],
+        batches: list[MetricDataBatch],
+        start_times: list[float] | None = None,
     ) -> AsyncGenerator[list[CloudwatchMetricTask], None]:
-        total_metrics = len(metric_tasks)
-        batch_size = 300  # max is 500 but scale back
-        if total_metrics > batch_size:
-            num_batches = ceil(total_metrics / 300)
-            batch_size = ceil(total_metrics / num_batches)
+        """
+            fetch the batches concurrently, requests in flight are limited by the client's
+            concurrency
+        Args:
+            start: window start
+            end: window end
+            batches: batches to fetch
+            start_times: optional window start for each batch, in place of start
+
+        Returns:
+            the tasks with results for each batch, in the order the batches complete
+        """
+        fetches = [
+            asyncio.ensure_future(self._get_metric_data_batch(batch_start, end, batch))
+            for batch_start, batch in zip(
+                start_times or [start] * len(batches), batches, strict=True
+            )
+        ]
+        try:
+            for fetch in asyncio.as_completed(fetches):
+                yield await fetch
+        finally:
+            # on error or if the caller stops early, wait for the cancelled fetches to
+            # unwind and retrieve the errors of any others that failed
+            for fetch in fetches:
+                fetch.cancel()
+            await asyncio.gather(*fetches, return_exceptions=True)
+
+    async def get_insights_data(
+        self,
+        start: float,
+        end: float,
+        query: InsightsQuery,
+        custom_tags: dict[str, str],
+    ) -> list[CloudwatchMetricTask]:
+        """
+            run a Metrics Insights query, discovering and fetching the series in one call
+        Args:
+            start: window start
+            end: window end
+            query: the insights query
+            custom_tags: tags for every series
+
+        Returns:
+            a task with its result for each series returned, the dimensions are recovered
+            from the result labels
+        """
+        metric_query: dict = {
+            "Id": "q0",
+            "Expression": query.query,
+            "Period": query.period,
+            "ReturnData": True,
+        }
+        if query.label:
+            metric_query["Label"] = query.label
 
-        remaining: list[CloudwatchMetricTask] = metric_tasks
+        tasks: dict[str, CloudwatchMetricTask] = {}
+        async for page in self._paginate(
+            "get_metric_data",
+            "NextToken",
+            StartTime=start,
+            EndTime=end,
+            MetricDataQueries=[metric_query],
+        ):
+            for result in page.get("MetricDataResults", []):
+                label = result.get("Label", "")
+                task = tasks.get(label)
+                if not task:
+                    task = CloudwatchMetricTask(
+                        ns=query.ns,
+                        metric_name=query.name,
+                        resource_name="insights",
+                        dimensions=query.label_dimensions(label),
+                        statistic=query.statistic,
+                        nil_to_zero=query.nil_to_zero,
+                        add_cw_timestamp=query.add_cw_timestamp,
+                        unit=None,
+                        tags=dict(custom_tags),
+                        result=CloudwatchMetricResult(
+                            values=[],
+                            timestamps=[],
+                            status_code=result.get("StatusCode", ""),
+                            messages=result.get("Messages", []),
+                        ),
+                    )
+                    tasks[label] = task
+                assert task.result
+                task.result.values.extend(result.get("Values", []))
+                task.result.timestamps.extend(result.get("Timestamps", []))
 
-        task_by_id: dict[str, CloudwatchMetricTask] = {}
+        return list(tasks.values())
 
-        while remaining:
-            batch: list[CloudwatchMetricTask] = remaining[:batch_size]
-            remaining = remaining[batch_size:]
-
-            queries: list[dict] = []
-            kwargs = {"StartTime": start, "EndTime": end, "MetricDataQueries": queries}
-
-            for ix, task in enumerate(batch):
-                task_id = f"m{ix}"
-                task_by_id[task_id] = task
-                query = {
-                    "Id": task_id,
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": task.ns,
-                            "MetricName": task.metric_name,
-                            "Dimensions": [
-                                {"Name": k, "Value": v}
-                                for k, v in task.dimensions.items()
-                            ],
-                        },
-                        "Period": period,
-                        "Stat": task.statistic,
-                        # 'Unit': 'Seconds'|'Microseconds'|'Milliseconds'|'Bytes'|'Kilobytes'|'Megabytes'
-                        # |'Gigabytes'|'Terabytes'|'Bits'|'Kilobits'|'Megabits'|'Gigabits'|'Terabits'
-                        # |'Percent'|'Count'|'Bytes/Second'|'Kilobytes/Second'|'Megabytes/Second'
-                        # |'Gigabytes/Second'|'Terabytes/Second'|'Bits/Second'
-                        # |'Kilobits/Second'|'Megabits/Second'|'Gigabits/Second'|'Terabits/Second'|'Count/Second'|'None'
-                    },
-                    "ReturnData": True,
-                }
-                queries.append(query)
+    async def _get_metric_data_batch(
+        self, start: float, end: float, batch: MetricDataBatch
+    ) -> list[CloudwatchMetricTask]:
 
-            batch_metrics = []
-            async for page in self._paginate(
-                "get_metric_data", "PaginationToken", **kwargs
-            ):
-                results = page.get("MetricDataResults", [])
+        kwargs = {
+            "StartTime": start,
+            "EndTime": end,
+            "MetricDataQueries": batch.queries,
+        }
 
-                for result in results:
-                    task = task_by_id[result["Id"]]
+        batch_metrics = []
+        async for page in self._paginate("get_metric_data", "NextToken", **kwargs):
+            results = page.get("MetricDataResults", [])
+
+            for result in results:
+                # fan the result out to every task sharing the query
+                for task_ix in batch.query_tasks[int(result["Id"][1:])]:
+                    task = batch.tasks[task_ix]
                     if task.result:
                         task.result.timestamps.extend(result.get("Timestamps", []))
                         task.result.values.extend(result.get("Values", []))
                         continue
 
                     task.result = CloudwatchMetricResult(
-                        values=result.get("Values", []),
-                        timestamps=result.get("Timestamps", []),
+                        values=list(result.get("Values", [])),
+                        timestamps=list(result.get("Timestamps", [])),
                         status_code=result.get("StatusCode", ""),
                         messages=result.get("Messages", []),
                     )
                     batch_metrics.append(task)
 
-            yield batch_metrics
-
-    async def get_metric_statistics(
-        self, metric: MetricRequest, job: StaticJob
-    ) -> list[CloudwatchMetricTask]:
-
-        start, end = get_start_end(metric.period, metric.length, metric.delay)
-
-        kwargs: dict = {
-            "Namespace": job.ns,
-            "MetricName": metric.name,
-            "StartTime": start,
-            "EndTime": end,
-            "Dimensions": [{"Name": k, "Value": v} for k, v in job.dimensions.items()],
-            "Period": metric.period,
-        }
-
-        results: dict[str, CloudwatchMetricTask] = {
-            stat: CloudwatchMetricTask(
-                ns=job.ns,
-                metric_name=metric.name,
-                resource_name="static",
-                dimensions=job.dimensions,
-                statistic=stat,
-                nil_to_zero=metric.nil_to_zero,
-                add_cw_timestamp=metric.add_cw_timestamp,
-                unit=metric.unit,
-                tags={},
-                result=CloudwatchMetricResult(values=[], timestamps=[]),
-            )
-            for stat in metric.stats
-        }
-
-        response = await run_in_executor(self.client.get_metric_statistics, **kwargs)
-        datapoints = response.get("Datapoints", [])
-        for datapoint in datapoints:
-            unit = datapoint.get("Unit")
-            timestamp = datapoint.get("Timestamp")
-            for stat in metric.stats:
-                task = results[stat]
-                assert task.result
-                if unit and unit != task.unit:
-                    task.unit = unit
-                val = datapoint.get(stat)
-                if val:
-                    task.result.values.append(val)
-                    task.result.timestamps.append(timestamp)
-                    continue
-
-                val = datapoint.get("ExtendedStatistics", {}).get(stat)
-                if not val:
-                    continue
-                task.result.values.append(val)
-                task.result.timestamps.append(timestamp)
-        return list(results.values())
+        return batch_metrics
 
 
 class STSClient(RegionRoleClient):
@@ -270,12 +550,11 @@ class STSClient(RegionRoleClient):
             if self._account_id is not None:
                 return self._account_id
 
-            async with self._sf:
-                try:
-                    response = await run_in_executor(self.client.get_caller_identity)
-                    self._account_id = response.get("Account", "")
-                except ClientError:
-                    self._account_id = ""
+            try:
+                response = await self._call("get_caller_identity")
+                self._account_id = response.get("Account", "")
+            except ClientError:
+                self._account_id = ""
 
         return self._account_id
 
@@ -307,12 +586,16 @@ class STSClient(RegionRoleClient):
         self, role_arn: str, session_name: str | None = None
     ) -> boto3.Session:
 
-        async with self._sf:
-            session = await run_in_executor(
-                self.get_session_sync, role_arn, session_name
-            )
-
-        return session
+        return await with_retries(
+            self.limiter,
+            partial(
+                run_in_executor,
+                self.get_session_sync,
+                role_arn,
+                session_name,
+                executor=self.executor,
+            ),
+        )
 
 
 class SupportAppClient(RegionRoleClient):
@@ -332,7 +615,7 @@ class SupportAppClient(RegionRoleClient):
                 return self._account_alias
 
             try:
-                response = await run_in_executor(self.client.get_account_alias)
+                response = await self._call("get_account_alias")
                 self._account_alias = response.get("accountAlias", "")
             except ClientError:
                 self._account_alias = ""
@@ -340,28 +623,198 @@ class SupportAppClient(RegionRoleClient):
         return self._account_alias
 
 
-class SQSClient:
+class MetricSink(ABC):
+    """
+    where the metric messages are delivered, a sink is created for each invocation
+    """
+
+    name = "sink"
+
+    def __init__(self):
+        self.throughput = EmitThroughput()
+        # monotonic time by which sends should finish, assigned from the lambda context,
+        # None for no deadline
+        self.deadline: float | None = None
+
+    def _past_deadline(self) -> bool:
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    @abstractmethod
+    async def send_messages(self, messages: list[dict]):
+        """
+            deliver metric messages
+        Args:
+            messages: metric messages
+        """
+
+    async def drain(self):  # noqa: B027
+        """
+        deliver anything left by earlier invocations, run alongside the scrape
+        """
 
-    def __init__(self, queue_url: str, config: Config, session: boto3.Session = None):
+    async def close(self):  # noqa: B027
+        """
+        finish delivering, once every message is sent
+        """
+
+
+class SQSClient(MetricSink):
+
+    name = "sqs"
+
+    def __init__(
+        self,
+        queue_url: str,
+        config: Config,
+        session: boto3.Session = None,
+        envelope: str | None = None,
+        spill: SpillBuffer | None = None,
+    ):
+        super().__init__()
         session = session or boto3
-        self.client = session.client("sqs", config=config)
+        concurrency = int(os.environ.get("SQS_API_CONCURRENCY", 5))
+        self.limiter = AdaptiveLimiter(
+            f"sqs {config.region_name}",
+            initial=concurrency,
+            max_limit=min(
+                ceil(concurrency * API_MAX_CONCURRENCY_FACTOR), AWS_CLIENT_MAX_THREADS
+            ),
+        )
+        # threads and connections for the most the limiter can grow to
+        self.concurrency = self.limiter.max_limit
+        self.client = session.client(
+            "sqs",
+            config=with_pool_connections(config, self.concurrency).merge(
+                # throttling is retried by with_retries, so the limiter sees it
+                Config(retries={"mode": "standard", "total_max_attempts": 1})
+            ),
+        )
         self.queue_url = queue_url
+        # none, or the encoding to pack many metric messages into each SQS message
+        self.envelope = (envelope or SQS_ENVELOPE).lower()
+        # unsent messages are spilled here after the deadline
+        self.spill = spill or SpillBuffer(queue_url)
+        # assigned by ClientFactory, the loop's default executor until then
+        self.executor: ThreadPoolExecutor | None = None
+
+    def _message_entries(self, messages: list[dict]) -> list[dict]:
+        if self.envelope == "none":
+            return [{"MessageBody": json.dumps(message)} for message in messages]
+        return pack_envelopes(messages, self.envelope)
+
+    def _spill(self, entries: list[dict]):
+        if self.spill.write(entries):
+            self.throughput.spilled += len(entries)
+        else:
+            self.throughput.dropped += len(entries)
+
+    async def _send_batch_once(self, batch: list[dict]) -> list[dict]:
+        """
+            send a batch, counting the entries sent
+        Returns:
+            the failed entries that can be retried
+        """
+        response = await with_retries(
+            self.limiter,
+            partial(
+                run_in_executor,
+                self.client.send_message_batch,
+                executor=self.executor,
+                QueueUrl=self.queue_url,
+                Entries=batch,
+            ),
+        )
+        failed = {f["Id"]: f for f in response.get("Failed", [])}
+        self.throughput.requests += 1
+        self.throughput.entries += len(batch) - len(failed)
+        self.throughput.bytes += sum(
+            entry_size(entry) for entry in batch if entry["Id"] not in failed
+        )
+        self.throughput.finished = monotonic()
+
+        retryable = []
+        for entry in batch:
+            failure = failed.get(entry["Id"])
+            if not failure:
+                continue
+            if failure.get("SenderFault"):
+                # the message itself is invalid, sending it again won't help
+                logger.error(
+                    f"sqs rejected message: {failure.get('Code')} "
+                    f"{failure.get('Message')}"
+                )
+                self.throughput.dropped += 1
+                continue
+            retryable.append(entry)
+        return retryable
+
+    async def _send_batch(self, batch: list[dict]):
+        """
+        send a batch, retrying failed entries with backoff, entries still unsent at the
+        deadline or after the last attempt are spilled for the next invocation
+        """
+        if not self.throughput.started:
+            self.throughput.started = monotonic()
+
+        attempt = 0
+        while batch:
+            if self._past_deadline():
+                self._spill(batch)
+                return
+            try:
+                batch = await self._send_batch_once(batch)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                logger.warning(f"sqs send failed, spilling {len(batch)} messages: {e}")
+                self._spill(batch)
+                return
+
+            if not batch:
+                return
+            attempt += 1
+            if attempt >= API_MAX_ATTEMPTS:
+                logger.warning(f"sqs {len(batch)} messages failed, spilling")
+                self._spill(batch)
+                return
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def send_entries(self, entries: list[dict]):
+        """
+            send SendMessageBatch entries, batches packed by entry count and size are sent
+            concurrently, up to the limiter's concurrency
+        Args:
+            entries: entries without an Id
+        """
+        batches = pack_batches(entries)
+        await asyncio.gather(*(self._send_batch(batch) for batch in batches))
 
     async def send_messages(self, messages: list[dict]):
+        """
+            send metric messages
+        Args:
+            messages: metric messages
+        """
+        await self.send_entries(self._message_entries(messages))
+        self.throughput.messages += len(messages)
+        return True
 
-        remaining = [
-            {"Id": str(ix), "MessageBody": json.dumps(message)}
-            for ix, message in enumerate(messages)
-        ]
+    async def drain(self):
+        await self.drain_spill()
 
-        while remaining:
-            batch = remaining[:10]
-            remaining = remaining[10:]
-            response = await run_in_executor(
-                self.client.send_message_batch, QueueUrl=self.queue_url, Entries=batch
-            )
-            assert response
-        return True
+    async def drain_spill(self):
+        """
+        send the messages spilled by earlier invocations, oldest first, a file is
+        removed once its messages are sent or spilled again
+        """
+        for path in self.spill.files():
+            if self._past_deadline():
+                return
+            entries = self.spill.read(path)
+            # entries spilled again are written to a new file before this one is removed
+            await self.send_entries(entries)
+            self.spill.remove(path)
+            self.throughput.drained += len(entries)
 
 
 class ResourceDiscovery(ABC):
@@ -387,32 +840,44 @@ class TaggingClient(RegionRoleClient):
             config,
             session,
             int(os.environ.get("TAGGING_API_CONCURRENCY", 5)),
+            tps=float(os.environ.get("TAGGING_API_TPS", 0)),
         )
 
     async def paginate_resources(
         self, job: DiscoveryJob
     ) -> AsyncGenerator[list[Resource], None]:
+        async for resources in self._paginate_unfiltered_resources(job):
+            yield [
+                resource
+                for resource in resources
+                if job.matches_search_tags(resource.tags)
+            ]
+
+    async def _paginate_unfiltered_resources(
+        self, job: DiscoveryJob
+    ) -> AsyncGenerator[list[Resource], None]:
+        """
+        pages of resources filtered server side by resource type and tag key only,
+        search_tags value patterns are not applied
+        """
         kwargs: dict[str, Any] = {"ResourceTypeFilters": job.resource_type_filters}
         if job.search_tags:
             kwargs["TagFilters"] = []
             for tag in job.search_tags:
                 kwargs["TagFilters"].append({"Key": tag})
         async for page in self._paginate("get_resources", **kwargs):
-            response = page.get("ResourceTagMappingList", [])
-            resources: list[Resource] = []
-            for resource in response:
-                tags = {t["Key"]: t["Value"] for t in resource.get("Tags", [])}
-
-                if job.search_tags and not all(
-                    v.match(tags.get(k, "")) for k, v in job.search_tags.items()
-                ):
-                    continue
+            yield self._to_resources(job.ns, page)
 
-                resources.append(
-                    Resource(ns=job.ns, arn=resource["ResourceARN"], tags=tags)
-                )
-
-            yield resources
+    @staticmethod
+    def _to_resources(ns: str, page: dict) -> list[Resource]:
+        return [
+            Resource(
+                ns=ns,
+                arn=resource["ResourceARN"],
+                tags={t["Key"]: t["Value"] for t in resource.get("Tags", [])},
+            )
+            for resource in page.get("ResourceTagMappingList", [])
+        ]
 
     async def get_all_resources(self, job: DiscoveryJob) -> list[Resource]:
         resources: list[Resource] = []
@@ -420,6 +885,40 @@ class TaggingClient(RegionRoleClient):
             resources.extend(page)
         return resources
 
+    async def get_unfiltered_resources(self, job: DiscoveryJob) -> list[Resource]:
+        resources: list[Resource] = []
+        async for page in self._paginate_unfiltered_resources(job):
+            resources.extend(page)
+        return resources
+
+    async def get_resources_by_arn(
+        self, job: DiscoveryJob, arns: list[str]
+    ) -> list[Resource]:
+        """
+            re-fetch the current tags for known resources, resources that no longer exist
+            are not returned
+        Args:
+            job: the discovery job the resources were discovered for
+            arns: resource arns to check
+
+        Returns:
+            the resources which still exist and still have the job's search tag keys
+        """
+        resources: list[Resource] = []
+        remaining = arns
+        while remaining:
+            # ResourceARNList cannot be combined with type filters or pagination
+            batch = remaining[:100]
+            remaining = remaining[100:]
+            page = await self._call("get_resources", ResourceARNList=batch)
+            resources.extend(
+                resource
+                for resource in self._to_resources(job.ns, page)
+                if all(tag in resource.tags for tag in job.search_tags)
+            )
+
+        return resources
+
 
 class APIGatewayV1Client(RegionRoleClient):
 
@@ -700,8 +1199,8 @@ class StorageGatewayClient(RegionRoleClient, ResourceFilter):
             items = page.get("Gateways", [])
             for item in items:
 
-                tags_resp = await self.client.list_tags_for_resource(
-                    ResourceARN=item["GatewayARN"]
+                tags_resp = await self._call(
+                    "list_tags_for_resource", ResourceARN=item["GatewayARN"]
                 )
                 tags = {tag["Key"]: tag["Value"] for tag in tags_resp.get("Tags", [])}
                 if job.search_tags and not all(
@@ -751,7 +1250,8 @@ class ShieldClient(RegionRoleClient, ResourceFilter):
         return resources
 
 
-TClientType = TypeVar("TClientType", bound=RegionRoleClient)
+# resource filters are built and cached by the factory like the region/role clients
+TClientType = TypeVar("TClientType", bound=RegionRoleClient | ResourceFilter)
 
 DISCOVERY_FILTERS = {
     "AWS/ApiGateway": APIGatewayFilter,
@@ -780,6 +1280,12 @@ class ClientFactory:
             )
 
         self._sts = STSClient(config=self._region_config[sts_region])
+        self._sts.executor = get_executor(
+            self._sts.client_name, sts_region, None, self._sts.concurrency
+        )
+        self._sts.limiter = get_limiter(
+            self._sts.client_name, sts_region, None, self._sts.limiter
+        )
         self._sessions: dict[str, boto3.Session] = {}
         self._clients: dict[tuple[type, str, str | None], RegionRoleClient] = {
             (STSClient, sts_region, None): self._sts
@@ -793,20 +1299,32 @@ class ClientFactory:
             self._region_config[region] = config
         return config
 
+    def get_session_sync(self, role: str | None = None) -> boto3.Session:
+        """
+            a session for the role, assumed synchronously, for clients created before the
+            event loop runs
+        Args:
+            role: role to assume, None for the lambda's own role
+        """
+        if not role:
+            return self._base_session
+        # sts retries are left to with_retries, which the sync path can't use
+        session = with_retries_sync(
+            self._sts.limiter.name, partial(self._sts.get_session_sync, role)
+        )
+        self._sessions[role] = session
+        return session
+
     def get_sqs_client(
         self, queue_url: str, region: str, role: str | None = None
     ) -> SQSClient:
-        if not role:
-            return SQSClient(
-                queue_url=queue_url,
-                config=self.region_config(region),
-                session=self._base_session,
-            )
-        session = self._sts.get_session_sync(role)
-        self._sessions[role] = session
-        return SQSClient(
+        session = self.get_session_sync(role)
+        client = SQSClient(
             queue_url=queue_url, config=self.region_config(region), session=session
         )
+        client.executor = get_executor("sqs", region, role, client.concurrency)
+        client.limiter = get_limiter("sqs", region, role, client.limiter)
+        return client
 
     @staticmethod
     def discovery_required_clients(jobs: list[DiscoveryJob]) -> set[type]:
@@ -866,6 +1384,21 @@ class ClientFactory:
             return client
 
         client = client_type(config=self.region_config(region), session=session)
+        region_role_clients = (
+            [client.v1_client, client.v2_client]
+            if isinstance(client, APIGatewayFilter)
+            else [client]
+        )
+        for region_role_client in region_role_clients:
+            region_role_client.executor = get_executor(
+                region_role_client.client_name,
+                region,
+                role,
+                region_role_client.concurrency,
+            )
+            region_role_client.limiter = get_limiter(
+                region_role_client.client_name, region, role, region_role_client.limiter
+            )
         self._clients[key] = cast(RegionRoleClient, client)
 
         return cast(SupportAppClient, client)
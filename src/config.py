@@ -1,7 +1,15 @@
 import json
 import os
+from hashlib import sha256
 
-from model import DiscoveryJob, MetricRequest, StaticJob
+from model import (
+    DiscoveryJob,
+    InsightsJob,
+    InsightsQuery,
+    MetricRequest,
+    ScrapeBudget,
+    StaticJob,
+)
 from services import _SERVICES_CONF, _Services
 
 
@@ -15,6 +23,7 @@ class ScrapeConfig:
 
         config = config or os.environ.get("SCRAPE_CONFIG", "{}")
         assert config
+        self.config_hash = sha256(config.encode()).hexdigest()
         self._services: _Services = _Services(_SERVICES_CONF)
         self._rtf_overrides = rtf_overrides or {}
         self._config = json.loads(config)
@@ -23,8 +32,11 @@ class ScrapeConfig:
         self.boto_kwargs = self._boto_config_base()
         self._discovery = self._config.get("discovery", {})
         self._static = self._config.get("static", {})
+        self._insights = self._config.get("insights", {})
         self.discovery_jobs: list[DiscoveryJob] = self._get_discovery_jobs()
         self.static_jobs: list[StaticJob] = self._get_static_jobs()
+        self.insights_jobs: list[InsightsJob] = self._get_insights_jobs()
+        self.budget = ScrapeBudget(**self._config.get("budget", {}))
 
     def _boto_config_base(self) -> dict:
         cfg = self._config.get("boto-config", {})
@@ -75,3 +87,20 @@ class ScrapeConfig:
                 raise ValueError(f"error parsing: {raw}") from e
 
         return jobs
+
+    def _get_insights_jobs(self) -> list[InsightsJob]:
+
+        cfg = self._insights.get("jobs", [])
+        if not cfg:
+            return []
+
+        jobs: list[InsightsJob] = []
+        for raw in cfg:
+            try:
+                raw["queries"] = [InsightsQuery(**q) for q in raw["queries"]]
+                job = InsightsJob(**raw)
+                jobs.append(job)
+            except Exception as e:
+                raise ValueError(f"error parsing: {raw}") from e
+
+        return jobs
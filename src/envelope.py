@@ -0,0 +1,164 @@
+import base64
+import gzip
+import json
+import os
+from typing import cast
+
+# SQS limits, per message and per SendMessageBatch request
+SQS_MAX_MESSAGE_BYTES = 262_144
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 262_144
+
+# none sends a message per metric, json or gzip pack many metrics into each message
+SQS_ENVELOPE = os.environ.get("SQS_ENVELOPE", "none").lower()
+SQS_ENVELOPE_MAX_BYTES = int(
+    os.environ.get("SQS_ENVELOPE_MAX_BYTES", SQS_MAX_MESSAGE_BYTES)
+)
+
+ENVELOPE_VERSION = "1"
+
+ENVELOPE_ENCODINGS = {"json": "json", "gzip": "gzip+base64"}
+
+# gzip ratio assumed for the first attempt at filling an envelope
+_GZIP_RATIO_GUESS = 8
+_FIT_ATTEMPTS = 4
+
+
+def entry_size(entry: dict) -> int:
+    """
+    bytes counted by SQS towards the message size limits, the body plus the name, type
+    and value of each attribute
+    """
+    size = len(entry["MessageBody"].encode())
+    for name, attribute in entry.get("MessageAttributes", {}).items():
+        size += len(name.encode()) + len(attribute["DataType"].encode())
+        size += len(attribute["StringValue"].encode())
+    return size
+
+
+def pack_batches(entries: list[dict]) -> list[list[dict]]:
+    """
+        pack entries, in order, into SendMessageBatch requests within both the entry count
+        and the total size limits
+    Args:
+        entries: SendMessageBatch entries without an Id
+    Returns:
+        the entries of each request, with Ids unique within the request
+    """
+    batches: list[list[dict]] = []
+    batch: list[dict] = []
+    batch_bytes = 0
+    for entry in entries:
+        size = entry_size(entry)
+        if batch and (
+            len(batch) >= SQS_MAX_BATCH_ENTRIES
+            or batch_bytes + size > SQS_MAX_BATCH_BYTES
+        ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append({"Id": str(len(batch)), **entry})
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _envelope_entry(encoding: str, parts: list[str]) -> dict:
+    body = "[" + ",".join(parts) + "]"
+    if encoding == "gzip":
+        body = base64.b64encode(gzip.compress(body.encode(), mtime=0)).decode()
+    return {
+        "MessageBody": body,
+        "MessageAttributes": {
+            "envelope_version": {"DataType": "String", "StringValue": ENVELOPE_VERSION},
+            "content_encoding": {
+                "DataType": "String",
+                "StringValue": ENVELOPE_ENCODINGS[encoding],
+            },
+            "metric_count": {"DataType": "Number", "StringValue": str(len(parts))},
+        },
+    }
+
+
+def pack_envelopes(
+    messages: list[dict], encoding: str, max_bytes: int = SQS_ENVELOPE_MAX_BYTES
+) -> list[dict]:
+    """
+        pack metric messages into as few SQS messages as fit max_bytes, each body is a json
+        list of the messages, gzip compressed and base64 encoded for gzip, the envelope
+        version, encoding and count are message attributes
+    Args:
+        messages: metric messages
+        encoding: json or gzip
+        max_bytes: the most bytes for an envelope, including attributes
+    Returns:
+        SendMessageBatch entries without an Id
+    """
+    if encoding not in ENVELOPE_ENCODINGS:
+        raise ValueError(f"unknown envelope encoding {encoding}")
+
+    parts = [json.dumps(message) for message in messages]
+    budget = max_bytes - entry_size(_envelope_entry(encoding, []))
+    raw_budget = budget * (_GZIP_RATIO_GUESS if encoding == "gzip" else 1)
+
+    entries: list[dict] = []
+    start = 0
+    count = 0
+    while start < len(parts):
+        if count and encoding == "gzip":
+            # messages are alike, start from as many as fitted the last envelope
+            end = min(len(parts), start + count)
+        else:
+            end = start + 1
+            raw_size = len(parts[start].encode()) + 1
+            while end < len(parts):
+                part_size = len(parts[end].encode()) + 1
+                if raw_size + part_size > raw_budget:
+                    break
+                raw_size += part_size
+                end += 1
+
+        entry = _envelope_entry(encoding, parts[start:end])
+        # compressed sizes are only known after compressing, scale to fill the envelope
+        for _ in range(_FIT_ATTEMPTS):
+            size = entry_size(entry)
+            scaled = max(1, int((end - start) * max_bytes / size * 0.95))
+            if size > max_bytes and end - start > 1:
+                end = start + min(scaled, end - start - 1)
+            elif size < max_bytes * 0.8 and end < len(parts) and scaled > end - start:
+                end = min(len(parts), start + scaled)
+            else:
+                break
+            entry = _envelope_entry(encoding, parts[start:end])
+
+        while end - start > 1 and entry_size(entry) > max_bytes:
+            end -= max(1, (end - start) // 10)
+            entry = _envelope_entry(encoding, parts[start:end])
+
+        entries.append(entry)
+        count = end - start
+        start = end
+
+    return entries
+
+
+def unpack_envelope(body: str, attributes: dict) -> list[dict]:
+    """
+        the metric messages from an SQS message, as received by a consumer
+    Args:
+        body: the message body
+        attributes: the received MessageAttributes, empty for messages sent unpacked
+    Returns:
+        the metric messages
+    """
+    if "envelope_version" not in attributes:
+        return [json.loads(body)]
+
+    version = attributes["envelope_version"]["StringValue"]
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"unsupported envelope version {version}")
+
+    if attributes["content_encoding"]["StringValue"] == ENVELOPE_ENCODINGS["gzip"]:
+        body = gzip.decompress(base64.b64decode(body)).decode()
+    return cast(list[dict], json.loads(body))
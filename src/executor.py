@@ -1,41 +1,145 @@
 import asyncio
 import itertools
+import os
 import re
 from collections import defaultdict
+from collections.abc import AsyncGenerator, Callable, Iterable
+from dataclasses import replace
+from functools import partial
+from time import monotonic
 from typing import Any, cast
 
 from associator import Associator, NoOpAssociator
+from budget import PlanBucket, apply_budget, log_dropped, shed
+from cache import (
+    HIGH_WATER_MARKS,
+    LIST_METRICS_CACHE,
+    RESOURCE_CACHE,
+    SCRAPE_PLAN_CACHE,
+    Coalescer,
+    HighWaterMarkKey,
+    HighWaterMarks,
+    ListMetricsKey,
+    ResourceCache,
+    ResourcesKey,
+    TTLCache,
+)
 from clients import (
     DISCOVERY_FILTERS,
     ClientFactory,
     CloudWatchClient,
+    MetricSink,
     ResourceFilter,
-    SQSClient,
     STSClient,
     SupportAppClient,
     TaggingClient,
 )
 from config import ScrapeConfig
 from model import (
+    BucketKey,
+    CloudwatchMetric,
     CloudwatchMetricTask,
     DiscoveryJob,
+    DroppedMetrics,
+    InsightsJob,
+    InsightsQuery,
+    MetricDataBatch,
+    MetricRollup,
     MetricStats,
     MetricTaskSignature,
     Resource,
+    ScrapeBudget,
+    ScrapePlan,
+    ScrapePlanKey,
     StaticJob,
 )
 from shared import get_start_end, logger
 
+# fetch metric data while discovery is still running, see pipeline_discovered_and_emit
+PIPELINE_DISCOVERY = os.environ.get("PIPELINE_DISCOVERY", "false").lower() == "true"
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 100))
+
+# completed series messages sent together while results are still being fetched
+EMIT_FLUSH_MESSAGES = int(os.environ.get("EMIT_FLUSH_MESSAGES", 500))
+# sends in flight per emitter before further results wait for one to finish
+EMIT_MAX_PENDING_SENDS = 2
+
+
+def rollup_metric_tasks(
+    rollup: MetricRollup, metric_tasks: list[CloudwatchMetricTask]
+) -> list[CloudwatchMetricTask]:
+    """
+        replace the tasks of a metric request with a task per group and statistic, fetched
+        as the metric math aggregate of the group's series
+    Args:
+        rollup: the metric request rollup
+        metric_tasks: a task per discovered series and statistic
+
+    Returns:
+        the rollup tasks, groups with too many series to fit in one request are not rolled up
+    """
+    groups: dict[
+        tuple[str, tuple[tuple[str, str], ...]], list[CloudwatchMetricTask]
+    ] = defaultdict(list)
+    for task in metric_tasks:
+        group_dimensions = tuple(
+            (name, task.dimensions[name])
+            for name in rollup.group_by
+            if name in task.dimensions
+        )
+        groups[(task.statistic, group_dimensions)].append(task)
+
+    max_series = CloudWatchClient.max_rollup_series()
+    rolled_up: list[CloudwatchMetricTask] = []
+    for (statistic, group_dimensions), series in groups.items():
+        first = series[0]
+        if len(series) > max_series:
+            logger.warning(
+                f"not rolling up {len(series)} {first.ns} {first.metric_name} series for "
+                f"{dict(group_dimensions)}, the most is {max_series}"
+            )
+            rolled_up.extend(series)
+            continue
+
+        resource_names = {task.resource_name for task in series}
+        rolled_up.append(
+            CloudwatchMetricTask(
+                ns=first.ns,
+                metric_name=first.metric_name,
+                resource_name=(
+                    first.resource_name if len(resource_names) == 1 else "rollup"
+                ),
+                dimensions=dict(group_dimensions),
+                statistic=statistic,
+                nil_to_zero=first.nil_to_zero,
+                add_cw_timestamp=first.add_cw_timestamp,
+                unit=first.unit,
+                # only the tags the series agree on
+                tags={
+                    k: v
+                    for k, v in first.tags.items()
+                    if all(task.tags.get(k) == v for task in series)
+                },
+                rollup=rollup.function,
+                rollup_dimensions=[task.dimensions for task in series],
+                priority=first.priority,
+            )
+        )
+
+    return rolled_up
+
 
 class Executor:
 
     def __init__(
-        self, config: ScrapeConfig, client_factory: ClientFactory, sqs_client: SQSClient
+        self, config: ScrapeConfig, client_factory: ClientFactory, sink: MetricSink
     ):
         self.config = config
         self.client_factory = client_factory
-        self.sqs_client = sqs_client
+        self.sink = sink
         self.executors = self._get_executors()
+        # tasks shed for the invocation budget
+        self.dropped: list[DroppedMetrics] = []
 
     def _get_executors(self):
 
@@ -62,7 +166,22 @@ class Executor:
             ):
                 static_jobs[(region, role)].append(static_job)
 
-        region_roles = set(itertools.chain(discovery_jobs.keys(), static_jobs.keys()))
+        insights_jobs: dict[tuple[str, str | None], list[InsightsJob]] = defaultdict(
+            list
+        )
+        for region, role, insights_job in itertools.chain(
+            *(
+                insights_job.sub_jobs(self.config.default_region)
+                for insights_job in self.config.insights_jobs
+            )
+        ):
+            insights_jobs[(region, role)].append(insights_job)
+
+        region_roles = set(
+            itertools.chain(
+                discovery_jobs.keys(), static_jobs.keys(), insights_jobs.keys()
+            )
+        )
 
         return [
             RegionRoleExecutor(
@@ -71,7 +190,8 @@ class Executor:
                 config=self.config,
                 discovery_jobs=discovery_jobs[rr],
                 static_jobs=static_jobs[rr],
-                sqs_client=self.sqs_client,
+                insights_jobs=insights_jobs[rr],
+                sink=self.sink,
                 client_factory=self.client_factory,
             )
             for rr in region_roles
@@ -79,18 +199,82 @@ class Executor:
 
     async def scrape_and_emit(self) -> dict[tuple[str, str | None], list[MetricStats]]:
 
+        plans: list[ScrapePlan | None] = [None] * len(self.executors)
+        if self.config.budget.enabled:
+            plans = list(await self.get_governed_scrape_plans())
+
         async def _scrape(
-            ex: RegionRoleExecutor,
+            ex: RegionRoleExecutor, plan: ScrapePlan | None
         ) -> tuple[tuple[str, str | None], list[MetricStats]]:
-            metrics = await ex.scrape_and_emit()
+            metrics = await ex.scrape_and_emit(plan)
             return (ex.region, ex.role), metrics
 
-        tasks = [_scrape(ex) for ex in self.executors]
+        if HIGH_WATER_MARKS.enabled:
+            HIGH_WATER_MARKS.prune()
 
-        results = await asyncio.gather(*tasks)
+        tasks = [
+            _scrape(ex, plan) for ex, plan in zip(self.executors, plans, strict=True)
+        ]
+
+        try:
+            # anything left by the last invocation is sent alongside the scrape
+            results, _ = await asyncio.gather(asyncio.gather(*tasks), self.sink.drain())
+        finally:
+            await self.sink.close()
+            await self.wait_for_refreshes()
+
+        throughput = self.sink.throughput
+        if throughput.dropped:
+            logger.warning(f"{self.sink.name} sent {throughput}")
+        elif throughput.requests or throughput.spilled:
+            logger.info(f"{self.sink.name} sent {throughput}")
 
         return dict(results)
 
+    async def wait_for_refreshes(self):
+        """
+        finish the background cache refreshes before the invocation ends, those still
+        running at the sink deadline are cancelled
+        """
+        timeout = None
+        if self.sink.deadline is not None:
+            timeout = max(0.0, self.sink.deadline - monotonic())
+
+        caches = {
+            id(cache): cache
+            for ex in self.executors
+            for cache in (ex.list_metrics_cache, ex.scrape_plan_cache)
+        }
+        await asyncio.gather(
+            *(cache.wait_for_refreshes(timeout) for cache in caches.values())
+        )
+
+    async def get_governed_scrape_plans(self) -> list[ScrapePlan]:
+        """
+            plan every region/role before fetching anything, so the lowest priority tasks
+            over the invocation budget can be dropped
+        Returns:
+            the plan for each executor, without the dropped tasks
+        """
+
+        async def _plan(ex: RegionRoleExecutor) -> ScrapePlan:
+            await ex.ensure_scrape_clients()
+            return await ex.get_scrape_plan()
+
+        plans = await asyncio.gather(*(_plan(ex) for ex in self.executors))
+        governed, dropped = apply_budget(self.config.budget, plans)
+        if dropped:
+            self.dropped.extend(dropped)
+            log_dropped("scrape", dropped)
+        return governed
+
+    @property
+    def dropped_metrics(self) -> list[DroppedMetrics]:
+        return [
+            *self.dropped,
+            *itertools.chain(*(ex.dropped for ex in self.executors)),
+        ]
+
     async def discover_metrics(
         self, init_clients: bool = False
     ) -> dict[
@@ -129,17 +313,33 @@ class RegionRoleExecutor:
         config: ScrapeConfig,
         discovery_jobs: list[DiscoveryJob],
         static_jobs: list[StaticJob],
-        sqs_client: SQSClient,
+        sink: MetricSink,
         client_factory: ClientFactory,
+        insights_jobs: list[InsightsJob] | None = None,
     ):
         self.config = config
-        self.sqs = sqs_client
+        self.sink = sink
         self.client_factory = client_factory
         self.region = region
         self.role = role
         self.discovery_jobs = discovery_jobs or []
         self.static_jobs = static_jobs or []
+        self.insights_jobs = insights_jobs or []
         self._clients: dict[type, Any] = {}
+        self.list_metrics_cache: TTLCache[ListMetricsKey, list[CloudwatchMetric]] = (
+            LIST_METRICS_CACHE
+        )
+        self.resource_cache: ResourceCache = RESOURCE_CACHE
+        self.scrape_plan_cache: TTLCache[ScrapePlanKey, ScrapePlan] = SCRAPE_PLAN_CACHE
+        # identical requests from different jobs are only made once per invocation
+        self._list_metrics_requests: Coalescer[
+            ListMetricsKey, list[CloudwatchMetric]
+        ] = Coalescer()
+        self._resources_requests: Coalescer[ResourcesKey, list[Resource]] = Coalescer()
+        self.pipeline_discovery = PIPELINE_DISCOVERY
+        self.high_water_marks: HighWaterMarks = HIGH_WATER_MARKS
+        # tasks shed for the job limits this invocation
+        self.dropped: list[DroppedMetrics] = []
 
     @property
     def cloudwatch(self) -> CloudWatchClient:
@@ -177,16 +377,30 @@ class RegionRoleExecutor:
                 client_type, self.region, self.role
             )
 
-    async def scrape_and_emit(self) -> list[MetricStats]:
+    async def ensure_scrape_clients(self):
+        await self.ensure_clients(
+            STSClient,
+            SupportAppClient,
+            CloudWatchClient,
+            *self.client_factory.discovery_required_clients(self.discovery_jobs),
+        )
+
+    async def scrape_and_emit(
+        self, plan: ScrapePlan | None = None
+    ) -> list[MetricStats]:
+        """
+            scrape the metrics for the region/role and send them to the queue
+        Args:
+            plan: a plan to scrape, e.g. shed to a budget, rather than the cached plan or
+                pipelined discovery
+
+        Returns:
+            counts of the emitted metrics
+        """
         logger.info(f"scraping  {self.region} {self.role}")
 
         try:
-            await self.ensure_clients(
-                STSClient,
-                SupportAppClient,
-                CloudWatchClient,
-                *self.client_factory.discovery_required_clients(self.discovery_jobs),
-            )
+            await self.ensure_scrape_clients()
 
             account_id = await self.sts.get_account_id()
             account_alias = await self.support.get_account_alias()
@@ -203,23 +417,27 @@ class RegionRoleExecutor:
 
             results: list[list[MetricStats]] = []
 
-            discovered_metrics = await self.get_batched_discovery_metrics()
-            if discovered_metrics:
-                discovery_tasks = [
-                    self.get_discovered_batch_and_emit(
-                        period, delay, length, tasks, context_labels=labels
-                    )
-                    for (period, delay), (length, tasks) in discovered_metrics.items()
-                ]
-                discovery_results = await asyncio.gather(*discovery_tasks)
+            if (
+                not plan
+                and self.pipeline_discovery
+                and not self.scrape_plan_cache.peek(self.scrape_plan_key)
+            ):
+                results.extend(await self.pipeline_discovered_and_emit(labels))
+            else:
+                plan = plan or await self.get_scrape_plan()
+                if plan.buckets:
+                    discovery_tasks = [
+                        self.get_discovered_batch_and_emit(
+                            period, delay, length, batches, context_labels=labels
+                        )
+                        for (period, delay, length), batches in plan.buckets.items()
+                    ]
+                    discovery_results = await asyncio.gather(*discovery_tasks)
 
-                results.extend(discovery_results)
+                    results.extend(discovery_results)
 
-            if self.static_jobs:
-                static_results = await self.get_static_metrics_emit(
-                    context_labels=labels, static_jobs=self.static_jobs
-                )
-                results.extend([static_results])
+            if self.insights_jobs:
+                results.append(await self.get_insights_and_emit(labels))
 
             for stat in cast(list[MetricStats], itertools.chain(*results)):
                 key = (stat.ns, stat.name)
@@ -235,6 +453,31 @@ class RegionRoleExecutor:
             logger.exception(f"scraping {self.region} {self.role} failed")
             raise e
 
+    async def get_insights_and_emit(
+        self, context_labels: dict[str, str]
+    ) -> list[MetricStats]:
+        """
+            run the Metrics Insights queries, each query discovers and fetches its series
+            in one GetMetricData call, in place of ListMetrics discovery
+        Args:
+            context_labels: labels added to every message
+
+        Returns:
+            stats for the emitted metrics
+        """
+
+        async def _query(job: InsightsJob, query: InsightsQuery):
+            start, end = get_start_end(query.period, query.length, query.delay)
+            return await self.cloudwatch.get_insights_data(
+                start, end, query, job.custom_tags
+            )
+
+        results = await asyncio.gather(
+            *(_query(job, query) for job in self.insights_jobs for query in job.queries)
+        )
+
+        return await self.emit_discovered(context_labels, itertools.chain(*results))
+
     @staticmethod
     def _group_metrics_to_message(
         context_labels: dict[str, str], metric_tasks: list[CloudwatchMetricTask]
@@ -267,103 +510,347 @@ class RegionRoleExecutor:
 
         return message
 
-    async def get_static_metrics_emit(
+    async def get_discovered_batch_and_emit(
         self,
+        period: int,
+        delay: int,
+        length: int,
+        batches: list[MetricDataBatch],
         context_labels: dict[str, str],
-        static_jobs: list[StaticJob],
     ) -> list[MetricStats]:
 
-        tasks = [
-            self.cloudwatch.get_metric_statistics(metric, job)
-            for job in static_jobs
-            for metric in job.metrics
-        ]
-
-        results = await asyncio.gather(*tasks)
-
-        stats: dict[tuple[str, str], int] = defaultdict(int)
-
-        for stat in itertools.chain(*results):
-            stats[(stat.ns, stat.metric_name)] += 1
+        emitter = MetricEmitter(
+            self.sink,
+            context_labels,
+            on_sent=partial(self.advance_high_water_marks, period, delay, length),
+        )
+        emitter.expect(task for batch in batches for task in batch.tasks)
+        try:
+            async for page in self.iter_discovered_batch(
+                period, delay, length, batches
+            ):
+                await emitter.add(page)
+            return await emitter.finish()
+        finally:
+            emitter.cancel()
+
+    async def iter_discovered_batch(
+        self, period: int, delay: int, length: int, batches: list[MetricDataBatch]
+    ) -> AsyncGenerator[list[CloudwatchMetricTask], None]:
+        """
+            fetch the batches of a bucket
+        Args:
+            period: bucket period
+            delay: bucket delay
+            length: bucket window length
+            batches: batches to fetch
+
+        Returns:
+            the tasks with results of each batch, as each batch completes
+        """
+        start, end = get_start_end(period, length, delay)
+        bucket = (period, delay, length)
+
+        start_times: list[float] | None = None
+        if self.high_water_marks.enabled:
+            # only request datapoints after those already emitted
+            incremental = [
+                (self._incremental_start(start, bucket, batch), batch)
+                for batch in batches
+            ]
+            incremental = [(s, b) for s, b in incremental if s < end]
+            start_times = [batch_start for batch_start, _ in incremental]
+            batches = [batch for _, batch in incremental]
 
-        messages = [
-            self._group_metrics_to_message(context_labels, tasks) for tasks in results
+        async for page in self.cloudwatch.get_metric_data(
+            start, end, batches, start_times
+        ):
+            if self.high_water_marks.enabled:
+                for task in page:
+                    self._drop_emitted_datapoints(bucket, task)
+            yield page
+
+    def _high_water_mark_key(
+        self, bucket: BucketKey, task: CloudwatchMetricTask
+    ) -> HighWaterMarkKey:
+        return self.region, self.role, bucket, task.signature
+
+    def _incremental_start(
+        self, start: float, bucket: BucketKey, batch: MetricDataBatch
+    ) -> float:
+        marks = [
+            self.high_water_marks.get(self._high_water_mark_key(bucket, task))
+            for task in batch.tasks
         ]
-        if messages:
-            await self.sqs.send_messages(messages)
-
-        return [
-            MetricStats(ns=ns, name=name, count=count)
-            for (ns, name), count in stats.items()
+        if not marks or None in marks:
+            return start
+        period = bucket[0]
+        return max(start, min(cast(list[float], marks)) + period)
+
+    def _drop_emitted_datapoints(self, bucket: BucketKey, task: CloudwatchMetricTask):
+        # series in a batch can have different marks, the batch starts at the earliest
+        mark = self.high_water_marks.get(self._high_water_mark_key(bucket, task))
+        if mark is None or not task.result:
+            return
+        kept = [
+            (value, timestamp)
+            for value, timestamp in zip(
+                task.result.values, task.result.timestamps, strict=True
+            )
+            if timestamp.timestamp() > mark
         ]
-
-    async def get_discovered_batch_and_emit(
+        if not kept:
+            # nothing new since the series was emitted, as for a skipped batch the series
+            # is not emitted, even as zero for nil_to_zero or as a static metric
+            task.result = None
+            return
+        task.result.values = [value for value, _ in kept]
+        task.result.timestamps = [timestamp for _, timestamp in kept]
+
+    def advance_high_water_marks(
         self,
         period: int,
         delay: int,
         length: int,
-        metric_tasks: list[CloudwatchMetricTask],
+        tasks: Iterable[CloudwatchMetricTask],
+    ):
+        """
+            record the latest datapoint of each emitted series, call once the tasks are
+            emitted, stats of a series fetched in other batches must not see the new marks
+        Args:
+            period: bucket period
+            delay: bucket delay
+            length: bucket window length
+            tasks: the emitted tasks
+        """
+        if not self.high_water_marks.enabled:
+            return
+
+        for task in tasks:
+            if not task.result or not task.result.timestamps:
+                continue
+            latest = max(timestamp.timestamp() for timestamp in task.result.timestamps)
+            self.high_water_marks.advance(
+                self._high_water_mark_key((period, delay, length), task),
+                latest,
+                expires_at=latest + length + delay + period,
+            )
+
+    async def emit_discovered(
+        self,
         context_labels: dict[str, str],
+        tasks: Iterable[CloudwatchMetricTask],
     ) -> list[MetricStats]:
 
-        start, end = get_start_end(period, length, delay)
-
-        stats: dict[tuple[str, str], int] = defaultdict(int)
+        emitter = MetricEmitter(self.sink, context_labels)
+        try:
+            await emitter.add(tasks)
+            return await emitter.finish()
+        finally:
+            emitter.cancel()
+
+    async def pipeline_discovered_and_emit(  # noqa: C901
+        self, context_labels: dict[str, str]
+    ) -> list[list[MetricStats]]:
+        """
+            run discovery and GetMetricData concurrently, discovered tasks flow through a
+            bounded queue and a batch is fetched as soon as its (period, delay, length)
+            bucket has a full batch of tasks, the fetched metrics are emitted as each
+            series completes
+        Args:
+            context_labels: labels added to every message
+
+        Returns:
+            stats per bucket
+        """
+        if not self.discovery_jobs and not self.static_jobs:
+            return []
 
-        grouped_by_metric: dict[MetricTaskSignature, list[CloudwatchMetricTask]] = (
-            defaultdict(list)
+        queue: asyncio.Queue[tuple[BucketKey, list[CloudwatchMetricTask]] | None] = (
+            asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
         )
 
-        async for page in self.cloudwatch.get_metric_data(
-            period, start, end, metric_tasks
+        async def _discover_job(job: DiscoveryJob):
+            async for bucket, tasks in self.iter_discovery_job(job):
+                await queue.put((bucket, tasks))
+
+        async def _discover():
+            try:
+                for bucket, tasks in self.static_metric_tasks().items():
+                    await queue.put((bucket, tasks))
+                await asyncio.gather(*(_discover_job(j) for j in self.discovery_jobs))
+            finally:
+                await queue.put(None)
+
+        pending: dict[BucketKey, list[CloudwatchMetricTask]] = defaultdict(list)
+        batches: dict[BucketKey, list[MetricDataBatch]] = defaultdict(list)
+        fetches: list[asyncio.Task[None]] = []
+        emitters: dict[BucketKey, MetricEmitter] = {}
+
+        def _emitter(bucket: BucketKey) -> MetricEmitter:
+            emitter = emitters.get(bucket)
+            if not emitter:
+                emitter = MetricEmitter(
+                    self.sink,
+                    context_labels,
+                    on_sent=partial(self.advance_high_water_marks, *bucket),
+                )
+                emitters[bucket] = emitter
+            return emitter
+
+        async def _fetch_and_emit(
+            bucket: BucketKey, new_batches: list[MetricDataBatch]
         ):
+            period, delay, length = bucket
+            async for page in self.iter_discovered_batch(
+                period, delay, length, new_batches
+            ):
+                await emitters[bucket].add(page)
 
-            for task in page:
-                if not task.result or not task.result.values:
-                    continue
+        def _fetch(bucket: BucketKey, tasks: list[CloudwatchMetricTask]):
+            period, _delay, length = bucket
+            new_batches = CloudWatchClient.build_metric_data_batches(
+                period, length, tasks
+            )
+            batches[bucket].extend(new_batches)
+            fetches.append(asyncio.create_task(_fetch_and_emit(bucket, new_batches)))
 
-                grouped_by_metric[task.signature].append(task)
-                stats[(task.ns, task.metric_name)] += 1
+        discovery = asyncio.create_task(_discover())
+        try:
+            while (item := await queue.get()) is not None:
+                bucket, tasks = item
+                # a discovered chunk holds every stat of its series
+                _emitter(bucket).expect(tasks)
+                bucket_pending = pending[bucket]
+                bucket_pending.extend(tasks)
+                batch_size = CloudWatchClient.metric_data_batch_size(
+                    bucket[0], bucket[2]
+                )
+                while len(bucket_pending) >= batch_size:
+                    _fetch(bucket, bucket_pending[:batch_size])
+                    del bucket_pending[:batch_size]
 
-        messages = [
-            self._group_metrics_to_message(context_labels, tasks)
-            for tasks in grouped_by_metric.values()
-        ]
-        if messages:
-            await self.sqs.send_messages(messages)
+            await discovery
 
-        return [
-            MetricStats(ns=ns, name=name, count=count)
-            for (ns, name), count in stats.items()
-        ]
+            for bucket, tasks in pending.items():
+                if tasks:
+                    _fetch(bucket, tasks)
+
+            await asyncio.gather(*fetches)
+            stats = list(
+                await asyncio.gather(
+                    *(emitter.finish() for emitter in emitters.values())
+                )
+            )
+        finally:
+            discovery.cancel()
+            for fetch in fetches:
+                fetch.cancel()
+            for emitter in emitters.values():
+                emitter.cancel()
+
+        if self.scrape_plan_cache.enabled:
+            # later invocations reuse the batches rather than running discovery again
+            self.scrape_plan_cache.put(
+                self.scrape_plan_key,
+                ScrapePlan(
+                    key=self.scrape_plan_key,
+                    buckets=dict(batches),
+                ),
+            )
+
+        return stats
+
+    @property
+    def scrape_plan_key(self) -> ScrapePlanKey:
+        return self.config.config_hash, self.region, self.role
+
+    async def get_scrape_plan(self) -> ScrapePlan:
+        """
+            get the scrape plan for this region/role, a cached plan is reused across warm
+            invocations and rebuilt in the background once stale
+        Returns:
+            the plan, with any previous results cleared
+        """
+        plan = await self.scrape_plan_cache.get(
+            self.scrape_plan_key, self.build_scrape_plan
+        )
+        plan.reset()
+        return plan
+
+    async def build_scrape_plan(self) -> ScrapePlan:
+
+        discovered_metrics = await self.get_batched_discovery_metrics()
+
+        return ScrapePlan(
+            key=self.scrape_plan_key,
+            buckets={
+                (period, delay, length): CloudWatchClient.build_metric_data_batches(
+                    period, length, tasks
+                )
+                for (period, delay, length), tasks in discovered_metrics.items()
+            },
+        )
 
     async def get_batched_discovery_metrics(
         self, init_clients: bool = False
-    ) -> dict[tuple[int, int], tuple[int, list[CloudwatchMetricTask]]]:
-
-        period_delay_batched_metrics: dict[
-            tuple[int, int], tuple[int, list[CloudwatchMetricTask]]
-        ] = {}
-
-        if self.discovery_jobs:
-
-            discovery_batches = await self.discover_metrics(init_clients=init_clients)
-            for batch in discovery_batches:
-                for (period, delay, length), tasks in batch.items():
-                    existing = period_delay_batched_metrics.get((period, delay))
-                    if not existing:
-                        period_delay_batched_metrics[(period, delay)] = (length, tasks)
-                        continue
-
-                    existing[1].extend(tasks)
-                    if existing[0] < length:
-                        # track the longest length for the period/delay
-                        period_delay_batched_metrics[(period, delay)] = (
-                            length,
-                            existing[1],
-                        )
+    ) -> dict[BucketKey, list[CloudwatchMetricTask]]:
+        """
+            merge the discovered and static metric tasks into buckets, a bucket is fetched
+            with one window, so requests with different lengths are kept apart and each
+            task only gets the datapoints it reduces
+        Returns:
+            tasks by (period, delay, length)
+        """
+        batched_metrics: dict[BucketKey, list[CloudwatchMetricTask]] = defaultdict(list)
+
+        discovery_batches = await self.discover_metrics(init_clients=init_clients)
+        if self.static_jobs:
+            discovery_batches.append(self.static_metric_tasks())
+
+        for batch in discovery_batches:
+            for bucket, tasks in batch.items():
+                batched_metrics[bucket].extend(tasks)
+
+        return batched_metrics
+
+    def static_metric_tasks(
+        self,
+    ) -> dict[tuple[int, int, int], list[CloudwatchMetricTask]]:
+        """
+            compile the static jobs to metric tasks, so they are fetched with GetMetricData
+            in the same (period, delay, length) batches as discovered metrics
+        Returns:
+            tasks by (period, delay, length)
+        """
+        metrics_requests: dict[tuple[int, int, int], list[CloudwatchMetricTask]] = (
+            defaultdict(list)
+        )
+        for job in self.static_jobs:
+            for metric_req in job.metrics:
+                metrics_requests[
+                    (metric_req.period, metric_req.delay, metric_req.length)
+                ].extend(
+                    CloudwatchMetricTask(
+                        ns=job.ns,
+                        metric_name=metric_req.name,
+                        resource_name="static",
+                        dimensions=job.dimensions,
+                        statistic=stat,
+                        nil_to_zero=metric_req.nil_to_zero,
+                        add_cw_timestamp=metric_req.add_cw_timestamp,
+                        unit=metric_req.unit,
+                        tags={},
+                        priority=(
+                            job.priority
+                            if metric_req.priority is None
+                            else metric_req.priority
+                        ),
+                    )
+                    for stat in metric_req.stats
+                )
 
-        return period_delay_batched_metrics
+        return metrics_requests
 
     async def discover_metrics(
         self, init_clients: bool = False
@@ -384,13 +871,59 @@ class RegionRoleExecutor:
 
         return discovery_results
 
-    async def run_discovery_job(  # noqa: C901
+    async def run_discovery_job(
         self, job: DiscoveryJob
     ) -> dict[tuple[int, int, int], list[CloudwatchMetricTask]]:
 
+        metrics_requests: dict[tuple[int, int, int], list[CloudwatchMetricTask]] = (
+            defaultdict(list)
+        )
+        async for key, tasks in self.iter_discovery_job(job):
+            metrics_requests[key].extend(tasks)
+
+        return metrics_requests
+
+    async def iter_discovery_job(
+        self, job: DiscoveryJob
+    ) -> AsyncGenerator[tuple[tuple[int, int, int], list[CloudwatchMetricTask]], None]:
+        """
+            discover the metric tasks for a job, with the job's max_metrics the lowest
+            priority tasks over the limit are dropped
+        Args:
+            job: the discovery job
+
+        Returns:
+            (period, delay, length) and the tasks for each metric request, as each is
+            discovered, or once the job has finished if it has a limit
+        """
+        if not job.max_metrics:
+            async for item in self._discover_job_metrics(job):
+                yield item
+            return
+
+        # shedding by priority needs all the job's tasks
+        discovered: dict[PlanBucket, list[CloudwatchMetricTask]] = defaultdict(list)
+        async for bucket, tasks in self._discover_job_metrics(job):
+            discovered[(0, bucket)].extend(tasks)
+
+        kept, dropped = shed(
+            ScrapeBudget(max_metrics=job.max_metrics), discovered, job_limit=True
+        )
+        if dropped:
+            self.dropped.extend(dropped)
+            log_dropped(f"{job.ns} job {self.region} {self.role}", dropped)
+
+        for (_plan_ix, bucket), tasks in kept.items():
+            if tasks:
+                yield bucket, tasks
+
+    async def _discover_job_metrics(  # noqa: C901
+        self, job: DiscoveryJob
+    ) -> AsyncGenerator[tuple[tuple[int, int, int], list[CloudwatchMetricTask]], None]:
+
         resources: list[Resource] = []
         if job.resource_type_filters:
-            resources = await self.tagging.get_all_resources(job)
+            resources = await self.get_resources(job)
 
         resource_filter_type = DISCOVERY_FILTERS.get(job.ns)
         if resource_filter_type:
@@ -408,74 +941,244 @@ class RegionRoleExecutor:
             else NoOpAssociator()
         )
 
-        metrics_requests: dict[tuple[int, int, int], list[CloudwatchMetricTask]] = (
-            defaultdict(list)
-        )
         for metric_req in job.metrics:
-            async for page in self.cloudwatch.list_metrics(metric_req.name, job):
-                for metric in page:
+            priority = (
+                job.priority if metric_req.priority is None else metric_req.priority
+            )
+            metric_tasks: list[CloudwatchMetricTask] = []
+            for metric in await self.list_metrics(metric_req.name, job):
 
-                    exact_dimensions = job.dimensions_exact
-                    # shallow clone
-                    search_dimensions: dict[str, re.Pattern] = dict(
-                        (job.search_dimensions or {}).items()
-                    )
+                exact_dimensions = job.dimensions_exact
+                # shallow clone
+                search_dimensions: dict[str, re.Pattern] = dict(
+                    (job.search_dimensions or {}).items()
+                )
+
+                if metric_req.dimensions_exact is not None:
+                    exact_dimensions = metric_req.dimensions_exact
+
+                if metric_req.search_dimensions:
+                    if metric_req.merge_dimensions:
+                        search_dimensions.update(metric_req.search_dimensions)
+                    else:
+                        search_dimensions = metric_req.search_dimensions
+
+                if (
+                    exact_dimensions
+                    and set(search_dimensions.keys()) != metric.dimension_names
+                ):
+                    continue
+
+                if search_dimensions and not all(
+                    v.match(metric.dimensions.get(k, ""))
+                    for k, v in search_dimensions.items()
+                ):
+                    continue
+
+                resource, skip = associator.associate_metric_to_resource(metric)
+                if skip:
+                    continue
+
+                resource = resource or Resource(ns=job.ns, arn="global", tags={})
+
+                tags = (
+                    {k: resource.tags.get(k, "") for k in job.exported_tags}
+                    if job.exported_tags
+                    else {}
+                )
 
-                    if metric_req.dimensions_exact is not None:
-                        exact_dimensions = metric_req.dimensions_exact
-
-                    if metric_req.search_dimensions:
-                        if metric_req.merge_dimensions:
-                            search_dimensions.update(metric_req.search_dimensions)
-                        else:
-                            search_dimensions = metric_req.search_dimensions
-
-                    if (
-                        exact_dimensions
-                        and set(search_dimensions.keys()) != metric.dimension_names
-                    ):
-                        continue
-
-                    if search_dimensions and not all(
-                        v.match(metric.dimensions.get(k, ""))
-                        for k, v in search_dimensions.items()
-                    ):
-                        continue
-
-                    resource, skip = associator.associate_metric_to_resource(metric)
-                    if skip:
-                        continue
-
-                    resource = resource or Resource(ns=job.ns, arn="global", tags={})
-
-                    tags = (
-                        {k: resource.tags.get(k, "") for k in job.exported_tags}
-                        if job.exported_tags
-                        else {}
+                tags.update(job.custom_tags)
+
+                metric_tasks.extend(
+                    CloudwatchMetricTask(
+                        ns=job.ns,
+                        metric_name=metric_req.name,
+                        resource_name=resource.arn,
+                        dimensions=metric.dimensions,
+                        statistic=stat,
+                        nil_to_zero=metric_req.nil_to_zero,
+                        add_cw_timestamp=metric_req.add_cw_timestamp,
+                        unit=metric_req.unit,
+                        tags=tags,
+                        priority=priority,
                     )
+                    for stat in metric_req.stats
+                )
 
-                    tags.update(job.custom_tags)
-
-                    for stat in metric_req.stats:
-                        metrics_requests[
-                            (metric_req.period, metric_req.delay, metric_req.length)
-                        ].append(
-                            CloudwatchMetricTask(
-                                ns=job.ns,
-                                metric_name=metric_req.name,
-                                resource_name=resource.arn,
-                                dimensions=metric.dimensions,
-                                statistic=stat,
-                                nil_to_zero=metric_req.nil_to_zero,
-                                add_cw_timestamp=metric_req.add_cw_timestamp,
-                                unit=metric_req.unit,
-                                tags=tags,
-                            )
-                        )
+            if metric_tasks and metric_req.rollup:
+                metric_tasks = rollup_metric_tasks(metric_req.rollup, metric_tasks)
 
-        return metrics_requests
+            if metric_tasks:
+                yield (
+                    metric_req.period,
+                    metric_req.delay,
+                    metric_req.length,
+                ), metric_tasks
+
+    async def get_resources(self, job: DiscoveryJob) -> list[Resource]:
+
+        key: ResourcesKey = (
+            self.region,
+            self.role,
+            job.ns,
+            tuple(job.resource_type_filters),
+            tuple(sorted(job.search_tags.keys())),
+        )
+        tagging = self.tagging
+
+        resources = await self._resources_requests.get(
+            key,
+            partial(
+                self.resource_cache.get,
+                key,
+                partial(tagging.get_unfiltered_resources, job),
+                partial(tagging.get_resources_by_arn, job),
+            ),
+        )
+
+        # each job gets its own copies, association and resource filters mutate them
+        return [
+            replace(resource, mapped=False)
+            for resource in resources
+            if job.matches_search_tags(resource.tags)
+        ]
+
+    async def list_metrics(
+        self, metric_name: str, job: DiscoveryJob
+    ) -> list[CloudwatchMetric]:
+
+        key: ListMetricsKey = (
+            self.region,
+            self.role,
+            job.ns,
+            metric_name,
+            job.linked_accounts,
+            job.recently_active_only,
+        )
+        cloudwatch = self.cloudwatch
+
+        async def _list_metrics() -> list[CloudwatchMetric]:
+            metrics: list[CloudwatchMetric] = []
+            async for page in cloudwatch.list_metrics(metric_name, job):
+                metrics.extend(page)
+            return metrics
+
+        return await self._list_metrics_requests.get(
+            key, partial(self.list_metrics_cache.get, key, _list_metrics)
+        )
 
     async def namespace_specific_resource_discovery(
         self, job: DiscoveryJob
     ) -> list[Resource] | None:
         return []
+
+
+class MetricEmitter:
+    """
+    groups the stats of each series into a message as the results arrive, a series is
+    queued for sending as soon as all its expected stats have arrived, so only the series
+    still being fetched are held, the queued messages are sent in the background every
+    EMIT_FLUSH_MESSAGES
+    """
+
+    def __init__(
+        self,
+        sink: MetricSink,
+        context_labels: dict[str, str],
+        on_sent: Callable[[list[CloudwatchMetricTask]], None] | None = None,
+    ):
+        self.sink = sink
+        self.context_labels = context_labels
+        # called with the tasks of each send, once sent
+        self.on_sent = on_sent
+        self.expected: dict[MetricTaskSignature, int] = defaultdict(int)
+        self.arrived: dict[MetricTaskSignature, list[CloudwatchMetricTask]] = {}
+        self.messages: list[dict] = []
+        self.emitted: list[CloudwatchMetricTask] = []
+        self.sends: list[asyncio.Task[None]] = []
+        # held from queueing a send until it's done, concurrent adds wait for a slot
+        self._send_slots = asyncio.Semaphore(EMIT_MAX_PENDING_SENDS)
+        self.stats: dict[tuple[str, str], int] = defaultdict(int)
+
+    def expect(self, tasks: Iterable[CloudwatchMetricTask]):
+        for task in tasks:
+            self.expected[task.signature] += 1
+
+    async def add(self, tasks: Iterable[CloudwatchMetricTask]):
+        for task in tasks:
+            group = self.arrived.setdefault(task.signature, [])
+            group.append(task)
+            expected = self.expected.get(task.signature, 0)
+            if expected and len(group) >= expected:
+                del self.arrived[task.signature]
+                del self.expected[task.signature]
+                self._queue(group)
+
+        if len(self.messages) >= EMIT_FLUSH_MESSAGES:
+            await self._flush()
+
+    def _queue(self, group: list[CloudwatchMetricTask]):
+        # discovered series are only emitted with datapoints, static metrics always, with
+        # a None value or zero for nil_to_zero, series without new datapoints since their
+        # high-water mark have no result
+        group = [
+            task
+            for task in group
+            if task.result and (task.result.values or task.is_static)
+        ]
+        if not group:
+            return
+        self.messages.append(
+            RegionRoleExecutor._group_metrics_to_message(self.context_labels, group)
+        )
+        self.emitted.extend(group)
+        for task in group:
+            self.stats[(task.ns, task.metric_name)] += 1
+
+    async def _send(self, messages: list[dict], tasks: list[CloudwatchMetricTask]):
+        try:
+            await self.sink.send_messages(messages)
+        finally:
+            self._send_slots.release()
+        if self.on_sent:
+            self.on_sent(tasks)
+
+    async def _flush(self):
+        if not self.messages:
+            return
+        messages, tasks = self.messages, self.emitted
+        self.messages, self.emitted = [], []
+
+        await self._send_slots.acquire()
+        # pruned in place, other adds may be flushing concurrently
+        done = [send for send in self.sends if send.done()]
+        for send in done:
+            self.sends.remove(send)
+        self.sends.append(asyncio.create_task(self._send(messages, tasks)))
+        for send in done:
+            send.result()
+
+    async def finish(self) -> list[MetricStats]:
+        """
+            send the remaining series, including those with stats that never arrived e.g.
+            from skipped batches, and wait for the sends
+        Returns:
+            stats for the emitted metrics
+        """
+        for group in self.arrived.values():
+            self._queue(group)
+        self.arrived.clear()
+        await self._flush()
+        while self.sends:
+            sends = list(self.sends)
+            self.sends.clear()
+            await asyncio.gather(*sends)
+
+        return [
+            MetricStats(ns=ns, name=name, count=count)
+            for (ns, name), count in self.stats.items()
+        ]
+
+    def cancel(self):
+        for send in self.sends:
+            send.cancel()
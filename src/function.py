@@ -1,14 +1,31 @@
 import asyncio
 import os
+from time import monotonic
 
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from clients import ClientFactory
 from config import ScrapeConfig
 from executor import Executor
 from shared import logger
+from sinks import get_sink
+from snapshot import get_snapshot_store, load_snapshot, save_snapshot
+from spill import SQS_SPILL_MARGIN
 
 config: ScrapeConfig | None = None
 
+# restore discovery state at init, so the first invocation after a cold start begins warm
+snapshot_store = get_snapshot_store(os.environ.get("SNAPSHOT_URL"))
+if snapshot_store:
+    load_snapshot(snapshot_store)
+
+
+def _sink_url() -> str:
+    # terraform sets exactly one of these
+    sink_url = os.environ.get("SINK_URL") or os.environ.get("QUEUE_URL")
+    if not sink_url:
+        raise ValueError("SINK_URL or QUEUE_URL must be set")
+    return sink_url
+
 
 def _ensure_config():
     global config
@@ -22,7 +39,7 @@ def _ensure_config():
 
 
 @logger.inject_lambda_context(log_event=False)
-def handler(_event: dict, _context: LambdaContext):
+def handler(_event: dict, context: LambdaContext):
 
     global config
 
@@ -37,10 +54,21 @@ def handler(_event: dict, _context: LambdaContext):
     client_factory = ClientFactory(
         config.sts_region, base_config_args=config.boto_kwargs
     )
-    queue_url = os.environ["QUEUE_URL"]
-    queue_region = os.environ.get("QUEUE_REGION", config.default_region)
-    queue_role = os.environ.get("QUEUE_ROLE") or None
+    sink_url = _sink_url()
+    sink_region = (
+        os.environ.get("SINK_REGION")
+        or os.environ.get("QUEUE_REGION")
+        or config.default_region
+    )
+    sink_role = os.environ.get("SINK_ROLE") or os.environ.get("QUEUE_ROLE") or None
     # init this sync, if we can't do this there's no point continuing
-    sqs_client = client_factory.get_sqs_client(queue_url, queue_region, queue_role)
-    executor = Executor(config, client_factory, sqs_client)
+    sink = get_sink(sink_url, client_factory, sink_region, sink_role)
+    # leave time to spill what can't be sent, rather than lose it to the timeout
+    sink.deadline = (
+        monotonic() + context.get_remaining_time_in_millis() / 1000 - SQS_SPILL_MARGIN
+    )
+    executor = Executor(config, client_factory, sink)
     _result = loop.run_until_complete(executor.scrape_and_emit())
+
+    if snapshot_store:
+        save_snapshot(snapshot_store)
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable
+from time import monotonic
+
+import botocore.exceptions
+from botocore.exceptions import ClientError, HTTPClientError
+from shared import logger
+
+# how far the concurrency limit can grow past the configured *_API_CONCURRENCY
+API_MAX_CONCURRENCY_FACTOR = float(os.environ.get("API_MAX_CONCURRENCY_FACTOR", 2))
+API_MAX_ATTEMPTS = int(os.environ.get("API_MAX_ATTEMPTS", 5))
+API_RETRY_BASE_DELAY = float(os.environ.get("API_RETRY_BASE_DELAY", 0.1))
+API_RETRY_MAX_DELAY = float(os.environ.get("API_RETRY_MAX_DELAY", 5))
+
+_THROTTLING_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+}
+
+
+def is_throttling_error(error: BaseException | None) -> bool:
+    if not isinstance(error, ClientError):
+        return False
+    if error.response.get("Error", {}).get("Code") in _THROTTLING_CODES:
+        return True
+    return bool(error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 429)
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    if is_throttling_error(error):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return bool(status >= 500)
+    # botocore and asyncio transport connection failures and timeouts
+    return isinstance(
+        error,
+        botocore.exceptions.ConnectionError | HTTPClientError | OSError | TimeoutError,
+    )
+
+
+class TokenBucket:
+    """
+    requests per second ceiling, with bursts of up to capacity requests
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def take(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit, while requests are using at least half the limit it grows by
+    one for each limit's worth of successful requests, it is halved on throttling, used
+    in place of a semaphore:
+
+        async with limiter:
+            await make_request()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        max_limit: int | None = None,
+        min_limit: int = 1,
+        tps: float = 0,
+        decrease_factor: float = 0.5,
+        decrease_interval: float = 1,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit or initial, initial, min_limit)
+        self.limit = float(max(initial, min_limit))
+        self.in_flight = 0
+        self.decrease_factor = decrease_factor
+        # throttles from requests made before the last decrease don't decrease it again
+        self.decrease_interval = decrease_interval
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._tokens = TokenBucket(tps) if tps > 0 else None
+
+    @property
+    def current_limit(self) -> int:
+        return max(int(self.limit), self.min_limit)
+
+    def _bind_loop(self):
+        # limiters outlive a ClientFactory, a new event loop can't wait on the old one's
+        # condition and none of its requests are still in flight
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._condition = asyncio.Condition()
+        self.in_flight = 0
+        if self._tokens:
+            self._tokens._lock = asyncio.Lock()
+
+    async def acquire(self):
+        self._bind_loop()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+        if not self._tokens:
+            return
+        try:
+            await self._tokens.take()
+        except BaseException:
+            await self.release(succeeded=False)
+            raise
+
+    async def release(self, throttled: bool = False, succeeded: bool = True):
+        async with self._condition:
+            # only grow the limit when it is what's holding requests back
+            near_limit = self.in_flight * 2 >= self.current_limit
+            self.in_flight -= 1
+            if throttled:
+                self.on_throttled()
+            elif succeeded and near_limit:
+                self.on_success()
+            self._condition.notify_all()
+
+    def on_success(self):
+        before = self.current_limit
+        self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+        if self.current_limit != before:
+            logger.info(f"{self.name} concurrency limit {self.current_limit}")
+
+    def on_throttled(self):
+        now = monotonic()
+        if now - self._last_decrease < self.decrease_interval:
+            return
+        self._last_decrease = now
+        before = self.current_limit
+        self.limit = max(self.limit * self.decrease_factor, float(self.min_limit))
+        logger.warning(
+            f"{self.name} throttled, concurrency limit {before} -> {self.current_limit}"
+        )
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, _exc_type, exc, _tb):
+        await self.release(throttled=is_throttling_error(exc), succeeded=exc is None)
+
+
+def retry_delay(attempt: int) -> float:
+    """
+        exponential backoff with full jitter
+    Args:
+        attempt: attempts made so far, from 1
+    Returns:
+        seconds to wait before the next attempt
+    """
+    return random.uniform(
+        0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2**attempt)
+    )
+
+
+async def with_retries[T](
+    limiter: AdaptiveLimiter,
+    func: Callable[[], Awaitable[T]],
+    max_attempts: int | None = None,
+) -> T:
+    """
+        call func under the limiter, retrying throttling, server and connection errors
+        with exponential backoff and full jitter
+    Args:
+        limiter: limiter to acquire for each attempt
+        func: makes the request
+        max_attempts: attempts including the first, defaults to API_MAX_ATTEMPTS
+
+    Returns:
+        the result of func
+    """
+    max_attempts = max_attempts or API_MAX_ATTEMPTS
+    attempt = 0
+    while True:
+        try:
+            async with limiter:
+                return await func()
+        except Exception as e:
+            attempt += 1
+            if attempt >= max_attempts or not is_retryable_error(e):
+                raise
+            delay = retry_delay(attempt)
+            logger.info(
+                f"{limiter.name} retrying in {delay:.2f}s, attempt {attempt}: {e}"
+            )
+            await asyncio.sleep(delay)
+
+
+def with_retries_sync[T](
+    name: str, func: Callable[[], T], max_attempts: int | None = None
+) -> T:
+    """
+        call func, retrying as with_retries, for the few calls made before the event loop
+        runs, such as assuming the sink role
+    Args:
+        name: used in log messages
+        func: makes the request
+        max_attempts: attempts including the first, defaults to API_MAX_ATTEMPTS
+
+    Returns:
+        the result of func
+    """
+    max_attempts = max_attempts or API_MAX_ATTEMPTS
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            attempt += 1
+            if attempt >= max_attempts or not is_retryable_error(e):
+                raise
+            delay = retry_delay(attempt)
+            logger.info(f"{name} retrying in {delay:.2f}s, attempt {attempt}: {e}")
+            time.sleep(delay)
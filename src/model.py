@@ -17,6 +17,24 @@ class Service:
         self.rex = [re.compile(r) for r in (self.rex or [])]
 
 
+_ROLLUP_FUNCTIONS = ("SUM", "MAX", "MIN", "AVG")
+
+
+@dataclass
+class MetricRollup:
+    # metric math function applied across the series
+    function: str = "SUM"
+    # series with the same values for these dimensions are rolled up together
+    group_by: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.function = self.function.upper()
+        if self.function not in _ROLLUP_FUNCTIONS:
+            raise ValueError(
+                f"unsupported rollup function {self.function}, use one of {_ROLLUP_FUNCTIONS}"
+            )
+
+
 @dataclass
 class MetricRequest:
     name: str
@@ -31,11 +49,17 @@ class MetricRequest:
     search_dimensions: dict[str, re.Pattern[str]] = field(default_factory=dict)
     merge_dimensions: bool = True
     dimensions_exact: bool | None = None
+    # fetch only aggregates of the discovered series, computed with metric math
+    rollup: MetricRollup | None = None
+    # overrides the job priority, lower priorities are shed first when over budget
+    priority: int | None = None
 
     def __post_init__(self):
         self.search_dimensions = {
             k: re.compile(v) for k, v in (self.search_dimensions or {}).items()
         }
+        if isinstance(self.rollup, dict):
+            self.rollup = MetricRollup(**self.rollup)
 
 
 @dataclass
@@ -58,6 +82,10 @@ class DiscoveryJob:
     resource_type_filters: list[str] = field(default_factory=list)
     # from config
     exported_tags: set[str] = field(default_factory=set)
+    # lower priorities are shed first when over budget
+    priority: int = 0
+    # most GetMetricData metrics for the job in each region/role, 0 for no limit
+    max_metrics: int = 0
 
     def __post_init__(self):
         self.regions = [r for r in (self.regions or []) if r]
@@ -69,6 +97,9 @@ class DiscoveryJob:
             k: re.compile(v) for k, v in (self.search_dimensions or {}).items()
         }
 
+    def matches_search_tags(self, tags: dict[str, str]) -> bool:
+        return all(v.match(tags.get(k, "")) for k, v in self.search_tags.items())
+
     def sub_jobs(
         self, default_region: str
     ) -> Generator[tuple[str, str | None, "DiscoveryJob"], None, None]:
@@ -89,6 +120,8 @@ class StaticJob:
     roles: list[str] = field(default_factory=list)
     custom_tags: dict[str, str] = field(default_factory=dict)
     dimensions: dict[str, str] = field(default_factory=dict)
+    # lower priorities are shed first when over budget
+    priority: int = 0
 
     def __post_init__(self):
         self.regions = [r for r in (self.regions or []) if r]
@@ -106,6 +139,110 @@ class StaticJob:
         )
 
 
+_INSIGHTS_STATISTICS = {
+    "AVG": "Average",
+    "SUM": "Sum",
+    "MIN": "Minimum",
+    "MAX": "Maximum",
+    "COUNT": "SampleCount",
+}
+
+_INSIGHTS_SELECT = re.compile(
+    r'^\s*SELECT\s+(\w+)\s*\(\s*"?([^")]+?)"?\s*\)\s+FROM\s+(?:SCHEMA\s*\(\s*)?"?([^",)\s]+)"?',
+    re.IGNORECASE,
+)
+_INSIGHTS_GROUP_BY = re.compile(
+    r"\bGROUP\s+BY\s+(.+?)(?:\s+ORDER\s+BY\b|\s+LIMIT\b|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# joins the group by dimension values in result labels
+INSIGHTS_LABEL_SEPARATOR = "|"
+
+
+@dataclass
+class InsightsQuery:
+    # Metrics Insights SQL, e.g. SELECT SUM(RequestCount)
+    # FROM SCHEMA("AWS/ApplicationELB", LoadBalancer) GROUP BY LoadBalancer LIMIT 10
+    query: str
+    period: int = 60
+    length: int = 60
+    delay: int = 0
+    nil_to_zero: bool = False
+    add_cw_timestamp: bool = True
+    # parsed from the query if not set
+    ns: str = ""
+    name: str = ""
+    statistic: str = ""
+    group_by: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        select = _INSIGHTS_SELECT.match(self.query)
+        if select:
+            function, name, ns = select.groups()
+            self.statistic = self.statistic or _INSIGHTS_STATISTICS.get(
+                function.upper(), ""
+            )
+            self.name = self.name or name
+            self.ns = self.ns or ns
+
+        if not (self.ns and self.name and self.statistic):
+            raise ValueError(
+                f"could not parse the namespace, metric and statistic from {self.query}"
+            )
+
+        group_by = _INSIGHTS_GROUP_BY.search(self.query)
+        if group_by and not self.group_by:
+            self.group_by = [
+                name.strip().strip('"') for name in group_by.group(1).split(",")
+            ]
+
+    @property
+    def label(self) -> str | None:
+        """
+        a dynamic label template, so the dimensions of each returned series can be
+        recovered from its label
+        """
+        if not self.group_by:
+            return None
+        return INSIGHTS_LABEL_SEPARATOR.join(
+            f"${{PROP('Dim.{name}')}}" for name in self.group_by
+        )
+
+    def label_dimensions(self, label: str) -> dict[str, str]:
+        if not self.group_by:
+            return {}
+        values = label.split(INSIGHTS_LABEL_SEPARATOR, len(self.group_by) - 1)
+        return {
+            name: value
+            for name, value in zip(self.group_by, values, strict=False)
+            if value
+        }
+
+
+@dataclass
+class InsightsJob:
+    queries: list[InsightsQuery]
+    regions: list[str] = field(default_factory=list)
+    roles: list[str] = field(default_factory=list)
+    custom_tags: dict[str, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.regions = [r for r in (self.regions or []) if r]
+        self.roles = [r for r in (self.roles or []) if r]
+
+    def sub_jobs(
+        self, default_region: str
+    ) -> Generator[tuple[str, str | None, "InsightsJob"], None, None]:
+        regions = self.regions or [default_region]
+        roles = self.roles or [None]  # type: ignore[list-item]
+
+        return cast(
+            Generator[tuple[str, str | None, InsightsJob], None, None],
+            itertools.product(regions, roles, [self]),
+        )
+
+
 @dataclass
 class Resource:
     ns: str
@@ -119,10 +256,10 @@ class CloudwatchMetric:
     ns: str
     name: str
     dimensions: dict[str, str]
-    dimension_names: set[str] = None  # type: ignore[assignment]
+    dimension_names: frozenset[str] = None  # type: ignore[assignment]
 
     def __post_init__(self):
-        self.dimension_names = set(self.dimensions.keys())
+        self.dimension_names = frozenset(self.dimensions.keys())
 
 
 @dataclass
@@ -133,6 +270,17 @@ class CloudwatchMetricResult:
     messages: list[dict[str, str]] | None = None
 
 
+# namespace, metric name, dimensions, statistic, rollup function and rolled up series
+# dimensions, tasks with the same key within a GetMetricData window can share a query
+type MetricQueryKey = tuple[
+    str,
+    str,
+    tuple[tuple[str, str], ...],
+    str,
+    str | None,
+    tuple[tuple[tuple[str, str], ...], ...],
+]
+
 type MetricTaskSignature = tuple[
     str, str, tuple[tuple[str, str], ...], tuple[tuple[str, str], ...]
 ]
@@ -149,6 +297,10 @@ class CloudwatchMetricTask:
     add_cw_timestamp: bool
     unit: str | None
     tags: dict[str, str]
+    # metric math function, the task is an aggregate of the series with these dimensions
+    rollup: str | None = None
+    rollup_dimensions: list[dict[str, str]] = field(default_factory=list)
+    priority: int = 0
     result: CloudwatchMetricResult | None = None
     signature: MetricTaskSignature = None  # type: ignore[assignment]
 
@@ -157,6 +309,26 @@ class CloudwatchMetricTask:
         tags = tuple(sorted(self.tags.items()))
         self.signature = (self.ns, self.metric_name, dims, tags)
 
+    @property
+    def query_key(self) -> MetricQueryKey:
+        return (
+            self.ns,
+            self.metric_name,
+            self.signature[2],
+            self.statistic,
+            self.rollup,
+            tuple(tuple(sorted(dims.items())) for dims in self.rollup_dimensions),
+        )
+
+    @property
+    def is_static(self) -> bool:
+        return self.resource_name == "static"
+
+    @property
+    def metric_count(self) -> int:
+        # GetMetricData is billed per metric, a rollup for each of its series
+        return len(self.rollup_dimensions) or 1
+
     def stat_shortname(self) -> str:
         stat = self.statistic.lower()
         if stat == "samplecount":
@@ -210,8 +382,96 @@ class CloudwatchMetricTask:
         return max(values)
 
 
+@dataclass
+class MetricDataBatch:
+    tasks: list[CloudwatchMetricTask]
+    # GetMetricData MetricDataQueries, returned queries have the Id m<ix>, rollups add
+    # queries for their series which are not returned
+    queries: list[dict]
+    # for each returned query m<ix>, the indexes in tasks of the tasks sharing its result
+    query_tasks: list[list[int]]
+
+
+# config hash, region, role
+type ScrapePlanKey = tuple[str, str, str | None]
+
+# period, delay, length, tasks in a bucket share a GetMetricData window
+type BucketKey = tuple[int, int, int]
+
+
+@dataclass
+class ScrapePlan:
+    key: ScrapePlanKey
+    buckets: dict[BucketKey, list[MetricDataBatch]]
+
+    def tasks(self) -> Generator[CloudwatchMetricTask, None, None]:
+        for batches in self.buckets.values():
+            for batch in batches:
+                yield from batch.tasks
+
+    def reset(self):
+        for task in self.tasks():
+            task.result = None
+
+
 @dataclass
 class MetricStats:
     ns: str
     name: str
     count: int
+
+
+@dataclass
+class EmitThroughput:
+    # metric messages, messages or records sent (e.g. SQS envelopes) and requests
+    messages: int = 0
+    entries: int = 0
+    requests: int = 0
+    bytes: int = 0
+    # messages spilled to disk to send next invocation, sent from the spill, and dropped
+    # as rejected, failing or with the spill full
+    spilled: int = 0
+    drained: int = 0
+    dropped: int = 0
+    # monotonic time the first request started and the last finished
+    started: float = 0
+    finished: float = 0
+
+    @property
+    def seconds(self) -> float:
+        return max(self.finished - self.started, 0)
+
+    def __str__(self) -> str:
+        seconds = self.seconds or 1
+        return (
+            f"{self.messages} metrics in {self.entries} messages, {self.requests} "
+            f"requests, {self.bytes} bytes in {self.seconds:.2f}s "
+            f"({self.messages / seconds:.0f} metrics/s, "
+            f"{self.bytes / seconds / 1024:.0f} KiB/s), {self.spilled} spilled, "
+            f"{self.drained} drained from spill, {self.dropped} dropped"
+        )
+
+
+@dataclass
+class ScrapeBudget:
+    # most GetMetricData metrics per invocation, 0 for no limit
+    max_metrics: int = 0
+    # most GetMetricData requests per invocation, 0 for no limit
+    max_requests: int = 0
+    # most GetMetricData metrics per namespace per invocation
+    namespaces: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(
+            self.max_metrics or self.max_requests or any(self.namespaces.values())
+        )
+
+
+@dataclass
+class DroppedMetrics:
+    ns: str
+    name: str
+    # the budget exceeded: job, namespace, metrics or requests
+    reason: str
+    count: int
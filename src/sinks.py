@@ -0,0 +1,427 @@
+import asyncio
+import hashlib
+import json
+import os
+import posixpath
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+from functools import partial
+from math import ceil
+from time import monotonic, time_ns
+from urllib.parse import urlparse
+from uuid import uuid4
+
+import boto3
+from botocore.config import Config
+from clients import (
+    AWS_CLIENT_MAX_THREADS,
+    ClientFactory,
+    MetricSink,
+    get_executor,
+    get_limiter,
+    run_in_executor,
+    with_pool_connections,
+)
+from limiter import (
+    API_MAX_ATTEMPTS,
+    API_MAX_CONCURRENCY_FACTOR,
+    AdaptiveLimiter,
+    is_retryable_error,
+    retry_delay,
+    with_retries,
+)
+from shared import logger
+
+# requests in flight for the kinesis, firehose and s3 sinks, adapting as the other apis
+SINK_API_CONCURRENCY = int(os.environ.get("SINK_API_CONCURRENCY", 5))
+
+
+def _message_line(message: dict) -> bytes:
+    return json.dumps(message).encode() + b"\n"
+
+
+class RecordSink(MetricSink):
+    """
+    a sink sending batches of records per request, such as kinesis PutRecords, failed
+    records are retried with backoff, records still failing after API_MAX_ATTEMPTS or at
+    the deadline are dropped and logged
+    """
+
+    client_name: str
+    max_records: int
+    max_batch_bytes: int
+    # per record error codes that mean the sink is throttling
+    throttling_codes: frozenset[str] = frozenset()
+
+    def __init__(self, config: Config, session: boto3.Session = None):
+        super().__init__()
+        session = session or boto3
+        self.limiter = AdaptiveLimiter(
+            f"{self.name} {config.region_name}",
+            initial=SINK_API_CONCURRENCY,
+            max_limit=min(
+                ceil(SINK_API_CONCURRENCY * API_MAX_CONCURRENCY_FACTOR),
+                AWS_CLIENT_MAX_THREADS,
+            ),
+        )
+        # threads and connections for the most the limiter can grow to
+        self.concurrency = self.limiter.max_limit
+        self.client = session.client(
+            self.client_name,
+            config=with_pool_connections(config, self.concurrency).merge(
+                # throttling is retried by with_retries, so the limiter sees it
+                Config(retries={"mode": "standard", "total_max_attempts": 1})
+            ),
+        )
+        # assigned by get_sink, the loop's default executor until then
+        self.executor: ThreadPoolExecutor | None = None
+
+    @abstractmethod
+    def _record(self, message: dict) -> dict:
+        """
+        the request record for a metric message
+        """
+
+    @staticmethod
+    @abstractmethod
+    def _record_size(record: dict) -> int:
+        pass
+
+    @abstractmethod
+    async def _put(self, records: list[dict]) -> dict:
+        """
+            send the records in a single request
+        Returns:
+            the response
+        """
+
+    @staticmethod
+    @abstractmethod
+    def _record_errors(response: dict) -> list[str | None]:
+        """
+        the error code of each record in a response, None for records sent
+        """
+
+    def _batches(self, records: list[dict]) -> list[list[dict]]:
+        batches: list[list[dict]] = []
+        batch: list[dict] = []
+        batch_bytes = 0
+        for record in records:
+            size = self._record_size(record)
+            if batch and (
+                len(batch) >= self.max_records
+                or batch_bytes + size > self.max_batch_bytes
+            ):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(record)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _drop(self, records: list[dict], reason: str):
+        logger.error(f"{self.name} dropping {len(records)} unsent records: {reason}")
+        self.throughput.dropped += len(records)
+
+    async def _put_once(self, batch: list[dict]) -> list[dict]:
+        """
+            send a batch, counting the records sent
+        Returns:
+            the failed records
+        """
+        response = await with_retries(self.limiter, partial(self._put, batch))
+        errors = self._record_errors(response)
+        failed = [record for record, error in zip(batch, errors, strict=True) if error]
+        if any(error in self.throttling_codes for error in errors):
+            self.limiter.on_throttled()
+
+        self.throughput.requests += 1
+        self.throughput.entries += len(batch) - len(failed)
+        self.throughput.bytes += sum(
+            self._record_size(record)
+            for record, error in zip(batch, errors, strict=True)
+            if not error
+        )
+        self.throughput.finished = monotonic()
+        return failed
+
+    async def _send_batch(self, batch: list[dict]):
+        if not self.throughput.started:
+            self.throughput.started = monotonic()
+
+        attempt = 0
+        while batch:
+            if self._past_deadline():
+                self._drop(batch, "deadline reached")
+                return
+            try:
+                batch = await self._put_once(batch)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                self._drop(batch, str(e))
+                return
+
+            if not batch:
+                return
+            attempt += 1
+            if attempt >= API_MAX_ATTEMPTS:
+                self._drop(batch, f"failing after {attempt} attempts")
+                return
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def send_messages(self, messages: list[dict]):
+        """
+            send metric messages, batches packed by record count and size are sent
+            concurrently, up to the limiter's concurrency
+        Args:
+            messages: metric messages
+        """
+        records = [self._record(message) for message in messages]
+        await asyncio.gather(
+            *(self._send_batch(batch) for batch in self._batches(records))
+        )
+        self.throughput.messages += len(messages)
+
+
+class KinesisSink(RecordSink):
+    """
+    a kinesis data stream record per metric message, partitioned by series
+    """
+
+    name = "kinesis"
+    client_name = "kinesis"
+    # PutRecords limits, the record size includes the partition key
+    max_records = 500
+    max_batch_bytes = 5 * 1024 * 1024
+    throttling_codes = frozenset({"ProvisionedThroughputExceededException"})
+
+    def __init__(self, stream_name: str, config: Config, session: boto3.Session = None):
+        super().__init__(config, session)
+        self.stream_name = stream_name
+
+    def _record(self, message: dict) -> dict:
+        series = json.dumps(
+            [
+                message.get("namespace"),
+                message.get("metric_name"),
+                message.get("dimensions"),
+            ],
+            sort_keys=True,
+        )
+        return {
+            "Data": json.dumps(message).encode(),
+            "PartitionKey": hashlib.md5(
+                series.encode(), usedforsecurity=False
+            ).hexdigest(),
+        }
+
+    @staticmethod
+    def _record_size(record: dict) -> int:
+        return len(record["Data"]) + len(record["PartitionKey"])
+
+    async def _put(self, records: list[dict]) -> dict:
+        return await run_in_executor(
+            self.client.put_records,
+            executor=self.executor,
+            StreamName=self.stream_name,
+            Records=records,
+        )
+
+    @staticmethod
+    def _record_errors(response: dict) -> list[str | None]:
+        return [record.get("ErrorCode") for record in response["Records"]]
+
+
+class FirehoseSink(RecordSink):
+    """
+    a firehose record per metric message, newline terminated so the delivered objects are
+    newline delimited json
+    """
+
+    name = "firehose"
+    client_name = "firehose"
+    # PutRecordBatch limits
+    max_records = 500
+    max_batch_bytes = 4 * 1024 * 1024
+    throttling_codes = frozenset({"ServiceUnavailableException"})
+
+    def __init__(
+        self, delivery_stream: str, config: Config, session: boto3.Session = None
+    ):
+        super().__init__(config, session)
+        self.delivery_stream = delivery_stream
+
+    def _record(self, message: dict) -> dict:
+        return {"Data": _message_line(message)}
+
+    @staticmethod
+    def _record_size(record: dict) -> int:
+        return len(record["Data"])
+
+    async def _put(self, records: list[dict]) -> dict:
+        return await run_in_executor(
+            self.client.put_record_batch,
+            executor=self.executor,
+            DeliveryStreamName=self.delivery_stream,
+            Records=records,
+        )
+
+    @staticmethod
+    def _record_errors(response: dict) -> list[str | None]:
+        return [record.get("ErrorCode") for record in response["RequestResponses"]]
+
+
+class S3Sink(MetricSink):
+    """
+    newline delimited json, one object per invocation, written when the sink is closed,
+    keyed by the hour e.g. <prefix>/2024/01/31/13/<time>-<id>.jsonl, if the scrape is
+    still running at the deadline the buffered messages are written then, and later
+    messages as they arrive
+    """
+
+    name = "s3"
+
+    def __init__(
+        self, bucket: str, prefix: str, config: Config, session: boto3.Session = None
+    ):
+        super().__init__()
+        session = session or boto3
+        self.limiter = AdaptiveLimiter(f"s3 {config.region_name}", initial=1)
+        self.client = session.client("s3", config=config)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.lines: list[bytes] = []
+        # assigned by get_sink, the loop's default executor until then
+        self.executor: ThreadPoolExecutor | None = None
+        self._deadline_timer: asyncio.TimerHandle | None = None
+        self._deadline_flushes: list[asyncio.Task[None]] = []
+
+    async def send_messages(self, messages: list[dict]):
+        if not self.throughput.started:
+            self.throughput.started = monotonic()
+            self._flush_at_deadline()
+        self.lines.extend(_message_line(message) for message in messages)
+        self.throughput.messages += len(messages)
+        if self._past_deadline():
+            await self.flush()
+
+    def _flush_at_deadline(self):
+        if self.deadline is None:
+            return
+        self._deadline_timer = asyncio.get_running_loop().call_later(
+            max(0.0, self.deadline - monotonic()),
+            lambda: self._deadline_flushes.append(asyncio.create_task(self.flush())),
+        )
+
+    def object_key(self) -> str:
+        now = datetime.now(tz=UTC)
+        return posixpath.join(
+            self.prefix, f"{now:%Y/%m/%d/%H}", f"{time_ns()}-{uuid4().hex[:8]}.jsonl"
+        )
+
+    async def flush(self):
+        """
+        write the buffered messages to a new object, messages still failing after the
+        retries are dropped and logged
+        """
+        if not self.lines:
+            return
+        lines, self.lines = self.lines, []
+        body = b"".join(lines)
+        try:
+            await with_retries(
+                self.limiter,
+                partial(
+                    run_in_executor,
+                    self.client.put_object,
+                    executor=self.executor,
+                    Bucket=self.bucket,
+                    Key=self.object_key(),
+                    Body=body,
+                    ContentType="application/x-ndjson",
+                ),
+            )
+        except Exception as e:
+            if not is_retryable_error(e):
+                raise
+            logger.error(f"s3 dropping {len(lines)} unsent messages: {e}")
+            self.throughput.dropped += len(lines)
+            return
+        self.throughput.requests += 1
+        self.throughput.entries += 1
+        self.throughput.bytes += len(body)
+        self.throughput.finished = monotonic()
+
+    async def close(self):
+        if self._deadline_timer:
+            self._deadline_timer.cancel()
+        await asyncio.gather(*self._deadline_flushes)
+        await self.flush()
+
+
+class FileSink(MetricSink):
+    """
+    appends newline delimited json to a local file, for testing
+    """
+
+    name = "file"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    async def send_messages(self, messages: list[dict]):
+        if not self.throughput.started:
+            self.throughput.started = monotonic()
+        body = b"".join(_message_line(message) for message in messages)
+        with open(self.path, "ab") as f:
+            f.write(body)
+        self.throughput.messages += len(messages)
+        self.throughput.entries += len(messages)
+        self.throughput.requests += 1
+        self.throughput.bytes += len(body)
+        self.throughput.finished = monotonic()
+
+
+def get_sink(
+    url: str, client_factory: ClientFactory, region: str, role: str | None = None
+) -> MetricSink:
+    """
+        sink from a url
+    Args:
+        url: an SQS queue url, kinesis://<stream name>, firehose://<delivery stream>,
+            s3://bucket/prefix or a file path / file:// url
+        client_factory: for the session of the role
+        region: sink region
+        role: role to assume for the sink, None for the lambda's own role
+
+    Returns:
+        the sink
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ("http", "https"):
+        return client_factory.get_sqs_client(url, region, role)
+
+    if parsed.scheme in ("", "file"):
+        return FileSink(parsed.path)
+
+    session = client_factory.get_session_sync(role)
+    config = client_factory.region_config(region)
+    sink: KinesisSink | FirehoseSink | S3Sink
+    if parsed.scheme == "kinesis":
+        sink = KinesisSink(parsed.netloc, config=config, session=session)
+    elif parsed.scheme == "firehose":
+        sink = FirehoseSink(parsed.netloc, config=config, session=session)
+    elif parsed.scheme == "s3":
+        sink = S3Sink(parsed.netloc, parsed.path, config=config, session=session)
+    else:
+        raise ValueError(f"unsupported sink url: {url}")
+
+    concurrency = sink.concurrency if isinstance(sink, RecordSink) else 1
+    sink.executor = get_executor(sink.name, region, role, concurrency)
+    sink.limiter = get_limiter(sink.name, region, role, sink.limiter)
+    return sink
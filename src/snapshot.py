@@ -0,0 +1,316 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from dataclasses import fields
+from typing import cast
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+from cache import (
+    HIGH_WATER_MARKS,
+    LIST_METRICS_CACHE,
+    RESOURCE_CACHE,
+    SCRAPE_PLAN_CACHE,
+    HighWaterMarks,
+    ListMetricsKey,
+    ResourceCache,
+    ResourcesKey,
+    TTLCache,
+)
+from model import (
+    CloudwatchMetric,
+    CloudwatchMetricTask,
+    MetricDataBatch,
+    MetricTaskSignature,
+    Resource,
+    ScrapePlan,
+    ScrapePlanKey,
+)
+from shared import logger
+
+SNAPSHOT_VERSION = 3
+
+# derived or per invocation state which is not snapshotted
+_TASK_EXCLUDED_FIELDS = {"result", "signature"}
+
+
+class SnapshotStore(ABC):
+
+    @abstractmethod
+    def load(self) -> dict | None:
+        """
+        Returns:
+            the stored snapshot or None if there isn't one
+        """
+
+    @abstractmethod
+    def save(self, snapshot: dict):
+        pass
+
+
+class FileSnapshotStore(SnapshotStore):
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return cast(dict, json.load(f))
+
+    def save(self, snapshot: dict):
+        # write then rename, so a timeout mid write does not leave a corrupt snapshot
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self.path)
+
+
+class S3SnapshotStore(SnapshotStore):
+
+    def __init__(self, bucket: str, key: str, session: boto3.Session = None):
+        session = session or boto3
+        self.client = session.client("s3")
+        self.bucket = bucket
+        self.key = key
+
+    def load(self) -> dict | None:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise e
+        return cast(dict, json.loads(response["Body"].read()))
+
+    def save(self, snapshot: dict):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(snapshot).encode(),
+            ContentType="application/json",
+        )
+
+
+def get_snapshot_store(url: str | None) -> SnapshotStore | None:
+    """
+        snapshot store from a url
+    Args:
+        url: s3://bucket/key or a file path / file:// url, empty for no snapshots
+
+    Returns:
+        the store, or None if not configured
+    """
+    if not url:
+        return None
+
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3SnapshotStore(bucket=parsed.netloc, key=parsed.path.lstrip("/"))
+
+    if parsed.scheme in ("", "file"):
+        return FileSnapshotStore(parsed.path)
+
+    raise ValueError(f"unsupported snapshot url: {url}")
+
+
+def _task_to_dict(task: CloudwatchMetricTask) -> dict:
+    return {
+        f.name: getattr(task, f.name)
+        for f in fields(task)
+        if f.name not in _TASK_EXCLUDED_FIELDS
+    }
+
+
+def _plan_to_dict(plan: ScrapePlan) -> dict:
+    return {
+        "buckets": [
+            {
+                "period": period,
+                "delay": delay,
+                "length": length,
+                "batches": [
+                    {
+                        "tasks": [_task_to_dict(task) for task in batch.tasks],
+                        "queries": batch.queries,
+                        "query_tasks": batch.query_tasks,
+                    }
+                    for batch in batches
+                ],
+            }
+            for (period, delay, length), batches in plan.buckets.items()
+        ]
+    }
+
+
+def _plan_from_dict(key: ScrapePlanKey, raw: dict) -> ScrapePlan:
+    return ScrapePlan(
+        key=key,
+        buckets={
+            (bucket["period"], bucket["delay"], bucket["length"]): [
+                MetricDataBatch(
+                    tasks=[CloudwatchMetricTask(**task) for task in batch["tasks"]],
+                    queries=batch["queries"],
+                    query_tasks=batch["query_tasks"],
+                )
+                for batch in bucket["batches"]
+            ]
+            for bucket in raw["buckets"]
+        },
+    )
+
+
+def take_snapshot(
+    list_metrics_cache: TTLCache[
+        ListMetricsKey, list[CloudwatchMetric]
+    ] = LIST_METRICS_CACHE,
+    resource_cache: ResourceCache = RESOURCE_CACHE,
+    scrape_plan_cache: TTLCache[ScrapePlanKey, ScrapePlan] = SCRAPE_PLAN_CACHE,
+    high_water_marks: HighWaterMarks = HIGH_WATER_MARKS,
+) -> dict:
+    """
+        serialise the discovery caches, series lists, resources and scrape plans, and the
+        incremental window high-water marks
+    Returns:
+        json serialisable snapshot
+    """
+    return {
+        "version": SNAPSHOT_VERSION,
+        "list_metrics": [
+            {
+                "key": key,
+                "fetched_at": entry.fetched_at,
+                "metrics": [
+                    {"ns": m.ns, "name": m.name, "dimensions": m.dimensions}
+                    for m in entry.value
+                ],
+            }
+            for key, entry in list_metrics_cache.items()
+        ],
+        "resources": [
+            {
+                "key": key,
+                "fetched_at": entry.fetched_at,
+                "checked_at": entry.checked_at,
+                "resources": [
+                    {"ns": r.ns, "arn": r.arn, "tags": r.tags} for r in entry.resources
+                ],
+            }
+            for key, entry in resource_cache.items()
+        ],
+        "scrape_plans": [
+            {
+                "key": key,
+                "fetched_at": entry.fetched_at,
+                "plan": _plan_to_dict(entry.value),
+            }
+            for key, entry in scrape_plan_cache.items()
+        ],
+        "high_water_marks": [
+            {
+                "region": region,
+                "role": role,
+                "period": period,
+                "delay": delay,
+                "length": length,
+                "ns": ns,
+                "metric_name": metric_name,
+                "dimensions": dict(dimensions),
+                "tags": dict(tags),
+                "timestamp": mark.timestamp,
+                "expires_at": mark.expires_at,
+            }
+            for (
+                region,
+                role,
+                (period, delay, length),
+                (ns, metric_name, dimensions, tags),
+            ), mark in high_water_marks.items()
+        ],
+    }
+
+
+def restore_snapshot(
+    snapshot: dict,
+    list_metrics_cache: TTLCache[
+        ListMetricsKey, list[CloudwatchMetric]
+    ] = LIST_METRICS_CACHE,
+    resource_cache: ResourceCache = RESOURCE_CACHE,
+    scrape_plan_cache: TTLCache[ScrapePlanKey, ScrapePlan] = SCRAPE_PLAN_CACHE,
+    high_water_marks: HighWaterMarks = HIGH_WATER_MARKS,
+):
+    """
+        load snapshotted entries into the caches, entries keep their original fetch times,
+        so once past their ttl they are used for the first scrape and refreshed lazily
+    Args:
+        snapshot: as returned by take_snapshot
+    """
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        logger.info(f"ignoring snapshot version {snapshot.get('version')}")
+        return
+
+    for item in snapshot.get("list_metrics", []):
+        list_metrics_cache.put(
+            cast(ListMetricsKey, tuple(item["key"])),
+            [CloudwatchMetric(**metric) for metric in item["metrics"]],
+            fetched_at=item["fetched_at"],
+        )
+
+    for item in snapshot.get("resources", []):
+        region, role, ns, rtf, tag_keys = item["key"]
+        resources_key: ResourcesKey = (region, role, ns, tuple(rtf), tuple(tag_keys))
+        resource_cache.put(
+            resources_key,
+            [Resource(**resource) for resource in item["resources"]],
+            fetched_at=item["fetched_at"],
+            checked_at=item["checked_at"],
+        )
+
+    for item in snapshot.get("scrape_plans", []):
+        plan_key = cast(ScrapePlanKey, tuple(item["key"]))
+        scrape_plan_cache.put(
+            plan_key,
+            _plan_from_dict(plan_key, item["plan"]),
+            fetched_at=item["fetched_at"],
+        )
+
+    for item in snapshot.get("high_water_marks", []):
+        signature: MetricTaskSignature = (
+            item["ns"],
+            item["metric_name"],
+            tuple(sorted(item["dimensions"].items())),
+            tuple(sorted(item["tags"].items())),
+        )
+        high_water_marks.advance(
+            (
+                item["region"],
+                item["role"],
+                (item["period"], item["delay"], item["length"]),
+                signature,
+            ),
+            item["timestamp"],
+            expires_at=item["expires_at"],
+        )
+
+
+def load_snapshot(store: SnapshotStore) -> bool:
+    try:
+        snapshot = store.load()
+        if not snapshot:
+            return False
+        restore_snapshot(snapshot)
+        return True
+    except Exception:
+        logger.exception("failed to load snapshot")
+        return False
+
+
+def save_snapshot(store: SnapshotStore) -> bool:
+    try:
+        store.save(take_snapshot())
+        return True
+    except Exception:
+        logger.exception("failed to save snapshot")
+        return False
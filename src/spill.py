@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from time import time_ns
+from uuid import uuid4
+
+from shared import logger
+
+# unsent SQS messages are written here when the invocation is running out of time, and
+# sent at the start of the next warm invocation
+SQS_SPILL_DIR = os.environ.get("SQS_SPILL_DIR", "/tmp/sqs-spill")
+SQS_SPILL_MAX_BYTES = int(os.environ.get("SQS_SPILL_MAX_BYTES", 256 * 1024 * 1024))
+# seconds before the lambda timeout from which messages are spilled rather than sent
+SQS_SPILL_MARGIN = float(os.environ.get("SQS_SPILL_MARGIN", 2))
+
+
+class SpillBuffer:
+    """
+        files of SendMessageBatch entries waiting to be sent to a queue, kept on the lambda's
+        /tmp so they survive between warm invocations
+    Args:
+        queue_url: the queue the entries are for
+        root: directory for all queues
+        max_bytes: the most bytes spilled for the queue, further entries are dropped
+    """
+
+    def __init__(
+        self,
+        queue_url: str,
+        root: str = SQS_SPILL_DIR,
+        max_bytes: int = SQS_SPILL_MAX_BYTES,
+    ):
+        queue_hash = hashlib.sha1(queue_url.encode(), usedforsecurity=False)
+        self.path = os.path.join(root, queue_hash.hexdigest()[:16])
+        self.max_bytes = max_bytes
+
+    def files(self) -> list[str]:
+        """
+        spilled files, oldest first
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return [
+            os.path.join(self.path, name)
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(".jsonl")
+        ]
+
+    @property
+    def size(self) -> int:
+        return sum(os.path.getsize(path) for path in self.files())
+
+    def write(self, entries: list[dict]) -> bool:
+        """
+            spill entries to a new file
+        Args:
+            entries: SendMessageBatch entries, any Id is dropped
+        Returns:
+            False if the entries were dropped as the buffer is full
+        """
+        lines = "".join(
+            json.dumps({k: v for k, v in entry.items() if k != "Id"}) + "\n"
+            for entry in entries
+        )
+        if self.size + len(lines) > self.max_bytes:
+            logger.error(
+                f"sqs spill buffer full, dropping {len(entries)} unsent messages"
+            )
+            return False
+
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{time_ns()}-{uuid4().hex[:8]}"
+        temp_path = os.path.join(self.path, f"{name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(lines)
+        # a partially written file is never drained
+        os.replace(temp_path, os.path.join(self.path, f"{name}.jsonl"))
+        return True
+
+    @staticmethod
+    def read(path: str) -> list[dict]:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    @staticmethod
+    def remove(path: str):
+        os.remove(path)
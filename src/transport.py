@@ -0,0 +1,251 @@
+import asyncio
+import os
+import ssl
+from dataclasses import dataclass
+from typing import cast
+from urllib.parse import urlsplit
+
+from botocore.awsrequest import create_request_object, prepare_request_dict
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from botocore.httpsession import get_cert_path
+from botocore.parsers import create_parser
+from botocore.serialize import create_serializer
+
+# boto3 (default) runs the sync clients in the default thread pool, asyncio sends the
+# requests over non-blocking keep-alive connections from the event loop
+AWS_TRANSPORT = os.environ.get("AWS_TRANSPORT", "boto3").lower()
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+@dataclass
+class HTTPResponse:
+    status_code: int
+    # lower case names
+    headers: dict[str, str]
+    body: bytes
+
+
+class _Connection:
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+    async def request(
+        self, method: str, target: str, headers: dict[str, str], body: bytes
+    ) -> tuple[HTTPResponse, bool]:
+        """
+            send a request and read the response
+        Returns:
+            the response and whether the connection can be reused
+        """
+        head = [f"{method} {target} HTTP/1.1"]
+        head.extend(f"{name}: {value}" for name, value in headers.items())
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        _version, status, *_reason = status_line.decode("latin-1").split(" ", 2)
+
+        response_headers: dict[str, str] = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            existing = response_headers.get(name)
+            response_headers[name] = f"{existing}, {value}" if existing else value
+
+        keep_alive = response_headers.get("connection", "").lower() != "close"
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            response_body = await self._read_chunked()
+        elif "content-length" in response_headers:
+            response_body = await self.reader.readexactly(
+                int(response_headers["content-length"])
+            )
+        elif method == "HEAD" or status in ("204", "304"):
+            response_body = b""
+        else:
+            response_body = await self.reader.read()
+            keep_alive = False
+
+        return HTTPResponse(int(status), response_headers, response_body), keep_alive
+
+    async def _read_chunked(self) -> bytes:
+        chunks: list[bytes] = []
+        while True:
+            size_line = await self.reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if not size:
+                # trailers
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+
+class ConnectionPool:
+    """
+    keep-alive HTTP/1.1 connections to a single host over asyncio streams
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ssl_context: ssl.SSLContext | None,
+        max_connections: int = 10,
+        connect_timeout: float = 60,
+        read_timeout: float = 60,
+    ):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle: list[_Connection] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self) -> _Connection:
+        async with asyncio.timeout(self.connect_timeout):
+            reader, writer = await asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=self.ssl_context,
+                server_hostname=self.host if self.ssl_context else None,
+            )
+        return _Connection(reader, writer)
+
+    async def request(
+        self, method: str, target: str, headers: dict[str, str], body: bytes
+    ) -> HTTPResponse:
+        async with self._slots:
+            while self._idle:
+                connection = self._idle.pop()
+                try:
+                    return await self._request(
+                        connection, method, target, headers, body
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # the server closed an idle connection, try the next one
+                    continue
+
+            return await self._request(
+                await self._connect(), method, target, headers, body
+            )
+
+    async def _request(
+        self,
+        connection: _Connection,
+        method: str,
+        target: str,
+        headers: dict[str, str],
+        body: bytes,
+    ) -> HTTPResponse:
+        try:
+            async with asyncio.timeout(self.read_timeout):
+                response, keep_alive = await connection.request(
+                    method, target, headers, body
+                )
+        except BaseException:
+            connection.close()
+            raise
+
+        if keep_alive:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        return response
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+class AsyncTransport:
+    """
+    makes the api calls of a boto3 client from the event loop, requests are serialised,
+    signed and parsed by botocore using the client's model, credentials and config,
+    client event hooks are not run
+    """
+
+    def __init__(self, client: BaseClient):
+        self.client = client
+        meta = client.meta
+        self._service_model = meta.service_model
+        self._serializer = create_serializer(
+            self._service_model.protocol,
+            include_validation=meta.config.parameter_validation,
+        )
+        self._parser = create_parser(self._service_model.protocol)
+        self._endpoint_url = meta.endpoint_url
+
+        endpoint = urlsplit(self._endpoint_url)
+        scheme = endpoint.scheme or "https"
+        self._host_header = endpoint.netloc
+        self.pool = ConnectionPool(
+            host=endpoint.hostname or "",
+            port=endpoint.port or _DEFAULT_PORTS[scheme],
+            ssl_context=(
+                ssl.create_default_context(cafile=get_cert_path(True))
+                if scheme == "https"
+                else None
+            ),
+            max_connections=meta.config.max_pool_connections,
+            connect_timeout=meta.config.connect_timeout,
+            read_timeout=meta.config.read_timeout,
+        )
+
+    async def call(self, method_name: str, **kwargs) -> dict:
+        """
+            the async equivalent of client.<method_name>(**kwargs)
+        Args:
+            method_name: the boto3 client method e.g. list_metrics
+            **kwargs: api parameters
+
+        Returns:
+            the parsed response, ClientError is raised for error responses
+        """
+        operation_name = self.client.meta.method_to_api_mapping[method_name]
+        operation_model = self._service_model.operation_model(operation_name)
+
+        request_dict = self._serializer.serialize_to_request(kwargs, operation_model)
+        prepare_request_dict(
+            request_dict,
+            endpoint_url=self._endpoint_url,
+            user_agent=self.client.meta.config.user_agent,
+        )
+        request = create_request_object(request_dict)
+        # the client's signer, so credentials, region and signing name match boto3
+        self.client._request_signer.sign(operation_name, request)
+        prepared = request.prepare()
+
+        url = urlsplit(prepared.url)
+        target = f"{url.path or '/'}?{url.query}" if url.query else url.path or "/"
+        body = prepared.body or b""
+        if isinstance(body, str):
+            body = body.encode()
+        headers = {"Host": self._host_header, **prepared.headers}
+        headers["Content-Length"] = str(len(body))
+
+        response = await self.pool.request(prepared.method, target, headers, body)
+
+        parsed = self._parser.parse(
+            {
+                "status_code": response.status_code,
+                "headers": response.headers,
+                "body": response.body,
+            },
+            operation_model.output_shape,
+        )
+        if response.status_code >= 300:
+            raise ClientError(parsed, operation_name)
+
+        return cast(dict, parsed)
@@ -28,6 +28,14 @@ def global_setup():
         yield
 
 
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    import clients
+
+    # limiters are kept across warm invocations, each test starts from the configured limits
+    monkeypatch.setattr(clients, "_LIMITERS", {})
+
+
 @pytest.fixture
 def s3():
 
@@ -0,0 +1,109 @@
+from associator import Associator
+from model import CloudwatchMetric, Resource
+from services import _SERVICES_CONF, _Services
+
+_SERVICES = _Services(_SERVICES_CONF)
+
+
+def test_associate_most_specific_mapping():
+
+    api_arn = "arn:aws:apigateway:eu-west-2::/restapis/orders"
+    stage_arn = "arn:aws:apigateway:eu-west-2::/restapis/orders/stages/live"
+    associator = Associator(
+        _SERVICES.get("apigateway").rex,
+        [
+            Resource(ns="AWS/ApiGateway", arn=api_arn, tags={}),
+            Resource(ns="AWS/ApiGateway", arn=stage_arn, tags={}),
+        ],
+    )
+
+    # Stage sorts after ApiName, the signature must use the same key order as the mapping
+    resource, skip = associator.associate_metric_to_resource(
+        CloudwatchMetric(
+            ns="AWS/ApiGateway",
+            name="Count",
+            dimensions={"Stage": "live", "ApiName": "orders"},
+        )
+    )
+    assert not skip
+    assert resource
+    assert resource.arn == stage_arn
+
+    resource, skip = associator.associate_metric_to_resource(
+        CloudwatchMetric(
+            ns="AWS/ApiGateway", name="Count", dimensions={"ApiName": "orders"}
+        )
+    )
+    assert not skip
+    assert resource
+    assert resource.arn == api_arn
+
+
+def test_associate_skips_unknown_resources():
+
+    associator = Associator(
+        _SERVICES.get("alb").rex,
+        [
+            Resource(
+                ns="AWS/ApplicationELB",
+                arn="arn:aws:elasticloadbalancing:eu-west-2:123456789012:loadbalancer/app/a/1",
+                tags={},
+            )
+        ],
+    )
+
+    resource, skip = associator.associate_metric_to_resource(
+        CloudwatchMetric(
+            ns="AWS/ApplicationELB",
+            name="RequestCount",
+            dimensions={"LoadBalancer": "app/b/2"},
+        )
+    )
+    assert resource is None
+    assert skip
+
+    # no mapping for these dimensions
+    resource, skip = associator.associate_metric_to_resource(
+        CloudwatchMetric(
+            ns="AWS/ApplicationELB",
+            name="RequestCount",
+            dimensions={"AvailabilityZone": "a"},
+        )
+    )
+    assert resource is None
+    assert not skip
+
+
+def test_associate_fixes_mq_broker_suffix():
+
+    broker_arn = "arn:aws:mq:eu-west-2:123456789012:broker:orders:b-1234"
+    associator = Associator(
+        _SERVICES.get("mq").rex,
+        [Resource(ns="AWS/AmazonMQ", arn=broker_arn, tags={})],
+    )
+
+    for broker in ("orders", "orders-1"):
+        resource, skip = associator.associate_metric_to_resource(
+            CloudwatchMetric(
+                ns="AWS/AmazonMQ", name="CpuUtilization", dimensions={"Broker": broker}
+            )
+        )
+        assert not skip
+        assert resource
+        assert resource.arn == broker_arn
+
+
+def test_mappings_for_load_balancers_and_target_groups():
+
+    prefix = "arn:aws:elasticloadbalancing:eu-west-2:123456789012"
+    lb = Resource(
+        ns="AWS/ApplicationELB", arn=f"{prefix}:loadbalancer/app/a/1", tags={}
+    )
+    tg = Resource(ns="AWS/ApplicationELB", arn=f"{prefix}:targetgroup/t/2", tags={})
+    associator = Associator(_SERVICES.get("alb").rex, [lb, tg])
+
+    mappings = {m.dim_names: m.resources for m in associator.mappings}
+    assert mappings[frozenset({"LoadBalancer"})] == {(("LoadBalancer", "app/a/1"),): lb}
+    assert mappings[frozenset({"TargetGroup"})] == {
+        (("TargetGroup", "targetgroup/t/2"),): tg
+    }
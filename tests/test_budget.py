@@ -0,0 +1,107 @@
+from budget import apply_budget, shed
+from clients import CloudWatchClient
+from common import temp_config
+from config import ScrapeConfig
+from model import CloudwatchMetricTask, ScrapeBudget, ScrapePlan
+
+
+def _task(ns: str, name: str, ix: int, priority: int = 0, **kwargs):
+    return CloudwatchMetricTask(
+        ns=ns,
+        metric_name=name,
+        resource_name=f"resource-{ix}",
+        dimensions={"Name": f"resource-{ix}"},
+        statistic="Sum",
+        nil_to_zero=False,
+        add_cw_timestamp=True,
+        unit=None,
+        tags={},
+        priority=priority,
+        **kwargs,
+    )
+
+
+def _plan(tasks: list[CloudwatchMetricTask]) -> ScrapePlan:
+    return ScrapePlan(
+        key=("hash", "eu-west-2", None),
+        buckets={
+            (60, 0, 300): CloudWatchClient.build_metric_data_batches(60, 300, tasks)
+        },
+    )
+
+
+def test_shed_lowest_priority():
+
+    low = [_task("AWS/S3", "NumberOfObjects", ix) for ix in range(5)]
+    high = [_task("AWS/SQS", "NumberOfMessagesSent", ix, priority=1) for ix in range(3)]
+    # a rollup is billed for each of its series
+    rollup = _task(
+        "AWS/ApplicationELB",
+        "RequestCount",
+        0,
+        priority=2,
+        rollup="SUM",
+        rollup_dimensions=[{"LoadBalancer": "a"}, {"LoadBalancer": "b"}],
+    )
+    plan = _plan([*low, *high, rollup])
+
+    [governed], dropped = apply_budget(ScrapeBudget(max_metrics=7), [plan])
+
+    kept = list(governed.tasks())
+    assert kept == [*low[:2], *high, rollup]
+    assert [(d.ns, d.name, d.reason, d.count) for d in dropped] == [
+        ("AWS/S3", "NumberOfObjects", "metrics", 3)
+    ]
+    # the same tasks are dropped every time
+    assert list(apply_budget(ScrapeBudget(max_metrics=7), [plan])[0][0].tasks()) == kept
+
+    # within budget, the plan is used as it is
+    [same], dropped = apply_budget(ScrapeBudget(max_metrics=10), [plan])
+    assert same is plan
+    assert not dropped
+
+
+def test_shed_namespace_and_requests(monkeypatch):
+
+    s3 = [_task("AWS/S3", "NumberOfObjects", ix) for ix in range(4)]
+    sqs = [_task("AWS/SQS", "NumberOfMessagesSent", ix) for ix in range(4)]
+    buckets = {(0, (60, 0, 300)): [*s3, *sqs]}
+
+    kept, dropped = shed(ScrapeBudget(namespaces={"AWS/S3": 1}), buckets)
+    assert kept[(0, (60, 0, 300))] == [s3[0], *sqs]
+    assert [(d.ns, d.reason, d.count) for d in dropped] == [("AWS/S3", "namespace", 3)]
+
+    # 3 queries per request, so 2 requests fit 6 tasks
+    monkeypatch.setattr("clients.METRIC_DATA_MAX_QUERIES", 3)
+    kept, dropped = shed(ScrapeBudget(max_requests=2), buckets)
+    assert len(kept[(0, (60, 0, 300))]) == 6
+    assert [(d.reason, d.count) for d in dropped] == [("requests", 2)]
+
+
+def test_budget_config():
+
+    conf = {
+        "budget": {"max_metrics": 1000, "namespaces": {"AWS/ApplicationELB": 200}},
+        "discovery": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "priority": 2,
+                    "max_metrics": 300,
+                    "metrics": [
+                        {"name": "RequestCount", "stats": ["Sum"], "priority": 5}
+                    ],
+                }
+            ]
+        },
+    }
+
+    with temp_config(conf):
+        config = ScrapeConfig()
+        assert config.budget.enabled
+        assert config.budget.namespaces == {"AWS/ApplicationELB": 200}
+        [job] = config.discovery_jobs
+        assert (job.priority, job.max_metrics, job.metrics[0].priority) == (2, 300, 5)
+
+    with temp_config({}):
+        assert not ScrapeConfig().budget.enabled
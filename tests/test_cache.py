@@ -0,0 +1,241 @@
+import asyncio
+from time import monotonic
+
+from cache import Coalescer, ResourceCache, TTLCache
+from clients import ClientFactory, CloudWatchClient
+from common import temp_config
+from config import ScrapeConfig
+from executor import Executor
+from model import DiscoveryJob, Resource
+from sinks import FileSink
+
+
+async def test_ttl_cache_disabled():
+
+    cache: TTLCache[str, int] = TTLCache("test", 0)
+    calls: list[int] = []
+
+    async def _fetch() -> int:
+        calls.append(1)
+        return len(calls)
+
+    assert await cache.get("a", _fetch) == 1
+    assert await cache.get("a", _fetch) == 2
+    assert not len(cache)
+
+
+async def test_ttl_cache_serves_stale_and_refreshes():
+
+    cache: TTLCache[str, int] = TTLCache("test", 60)
+    calls: list[int] = []
+
+    async def _fetch() -> int:
+        calls.append(1)
+        return len(calls)
+
+    assert await cache.get("a", _fetch) == 1
+    assert await cache.get("a", _fetch) == 1
+    assert len(calls) == 1
+
+    cache.put("a", 1, fetched_at=0)
+    # stale value is returned while the refresh happens in the background
+    assert await cache.get("a", _fetch) == 1
+    await cache.wait_for_refreshes()
+    assert len(calls) == 2
+    assert await cache.get("a", _fetch) == 2
+
+
+async def test_ttl_cache_failed_refresh_keeps_stale_value():
+
+    cache: TTLCache[str, int] = TTLCache("test", 60)
+
+    async def _fail() -> int:
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    cache.put("a", 1, fetched_at=0)
+    assert await cache.get("a", _fail) == 1
+    await cache.wait_for_refreshes()
+    entry = cache.peek("a")
+    assert entry
+    assert entry.value == 1
+
+
+async def test_scrape_finishes_background_refreshes(tmp_path):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/refresh/1"},
+                    "metrics": [{"name": "RejectedConnectionCount", "stats": ["Sum"]}],
+                }
+            ]
+        }
+    }
+
+    async def _slow() -> int:
+        await asyncio.sleep(0.05)
+        return 2
+
+    async def _hung() -> int:
+        await asyncio.sleep(60)
+        return 3
+
+    cache: TTLCache[str, int] = TTLCache("test", 60)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        for fetch, deadline, expected in ((_slow, None, 2), (_hung, 0.0, 1)):
+            sink = FileSink(str(tmp_path / "metrics.jsonl"))
+            sink.deadline = deadline if deadline is None else monotonic() + deadline
+            executor = Executor(config, ClientFactory(config.sts_region), sink)
+            for ex in executor.executors:
+                ex.list_metrics_cache = cache
+
+            cache.put("a", 1, fetched_at=0)
+            assert await cache.get("a", fetch) == 1
+            await executor.scrape_and_emit()
+
+            # the refresh finished, or was cancelled at the deadline
+            assert not cache._refreshing
+            entry = cache.peek("a")
+            assert entry
+            assert entry.value == expected
+
+
+async def test_list_metrics_cached_across_runs(test_bucket):
+
+    conf = {
+        "discovery": {
+            "jobs": [
+                {
+                    "type": "s3",
+                    "regions": ["eu-west-2"],
+                    "metrics": [
+                        {
+                            "name": "NumberOfObjects",
+                            "stats": ["Average"],
+                            "period": 86400,
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    cache: TTLCache = TTLCache("test", 300)
+    key = ("eu-west-2", None, "AWS/S3", "NumberOfObjects", False, True)
+
+    with temp_config(conf):
+        config = ScrapeConfig()
+
+        fetched_at: set[float] = set()
+        for _ in range(2):
+            client_factory = ClientFactory(config.sts_region)
+            executor = Executor(config, client_factory, None)  # type: ignore[arg-type]
+            for ex in executor.executors:
+                ex.list_metrics_cache = cache
+            discovered = await executor.discover_metrics(init_clients=True)
+            metrics = discovered[("eu-west-2", None)][(86400, 0, 60)]
+            assert len(metrics) == 1
+            entry = cache.peek(key)
+            assert entry
+            fetched_at.add(entry.fetched_at)
+
+        assert len(cache) == 1
+        assert len(fetched_at) == 1
+
+
+async def test_resource_cache_incremental_refresh():
+
+    cache = ResourceCache("test", 300, 60)
+    key = ("eu-west-2", None, "AWS/S3", ("s3",), ())
+    full: list[int] = []
+    checked: list[list[str]] = []
+
+    async def _fetch_all() -> list[Resource]:
+        full.append(1)
+        return [
+            Resource(ns="AWS/S3", arn="arn:aws:s3:::a", tags={"v": "1"}),
+            Resource(ns="AWS/S3", arn="arn:aws:s3:::b", tags={"v": "1"}),
+        ]
+
+    async def _fetch_by_arn(arns: list[str]) -> list[Resource]:
+        checked.append(arns)
+        return [Resource(ns="AWS/S3", arn="arn:aws:s3:::a", tags={"v": "2"})]
+
+    resources = await cache.get(key, _fetch_all, _fetch_by_arn)
+    assert len(resources) == 2
+    # returned resources are copies
+    resources[0].mapped = True
+
+    resources = await cache.get(key, _fetch_all, _fetch_by_arn)
+    assert len(resources) == 2
+    assert not any(resource.mapped for resource in resources)
+    assert not checked
+
+    entry = cache.peek(key)
+    assert entry
+    entry.checked_at = 0
+    resources = await cache.get(key, _fetch_all, _fetch_by_arn)
+    assert checked == [["arn:aws:s3:::a", "arn:aws:s3:::b"]]
+    assert len(resources) == 1
+    assert resources[0].tags == {"v": "2"}
+
+    entry.fetched_at = 0
+    resources = await cache.get(key, _fetch_all, _fetch_by_arn)
+    assert len(resources) == 2
+    assert len(full) == 2
+
+
+async def test_coalescer_shares_requests():
+
+    coalescer: Coalescer[str, int] = Coalescer()
+    calls: list[int] = []
+
+    async def _fetch() -> int:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    results = await asyncio.gather(*(coalescer.get("a", _fetch) for _ in range(5)))
+    assert results == [1] * 5
+    assert await coalescer.get("a", _fetch) == 1
+    assert await coalescer.get("b", _fetch) == 2
+
+
+async def test_list_metrics_coalesced_across_jobs(test_bucket, monkeypatch):
+
+    metrics = [{"name": "NumberOfObjects", "stats": ["Average"], "period": 86400}]
+    conf = {
+        "discovery": {
+            "jobs": [
+                {"type": "s3", "regions": ["eu-west-2"], "metrics": metrics},
+                {
+                    "type": "s3",
+                    "regions": ["eu-west-2"],
+                    "search_dimensions": {"BucketName": "^temp-.*"},
+                    "metrics": metrics,
+                },
+            ]
+        }
+    }
+
+    calls: list[str] = []
+    list_metrics = CloudWatchClient.list_metrics
+
+    def _list_metrics(self, metric_name: str, job: DiscoveryJob):
+        calls.append(metric_name)
+        return list_metrics(self, metric_name, job)
+
+    monkeypatch.setattr(CloudWatchClient, "list_metrics", _list_metrics)
+
+    with temp_config(conf):
+        config = ScrapeConfig()
+        client_factory = ClientFactory(config.sts_region)
+        executor = Executor(config, client_factory, None)  # type: ignore[arg-type]
+        discovered = await executor.discover_metrics(init_clients=True)
+        assert len(discovered[("eu-west-2", None)][(86400, 0, 60)]) == 2
+        assert calls == ["NumberOfObjects"]
@@ -0,0 +1,306 @@
+import asyncio
+import threading
+import time
+from dataclasses import replace
+from datetime import UTC, datetime, timedelta
+
+import clients
+import limiter
+import pytest
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from clients import (
+    AWS_CLIENT_MAX_THREADS,
+    APIGatewayFilter,
+    ClientFactory,
+    CloudWatchClient,
+    SupportAppClient,
+)
+from common import temp_metrics
+from model import CloudwatchMetricTask
+from moto.cloudwatch.models import MetricDatum
+from shared import get_start_end
+
+
+async def test_clients_have_dedicated_executors(monkeypatch):
+
+    monkeypatch.setenv("METRICS_API_CONCURRENCY", "20")
+    monkeypatch.setattr(clients, "_EXECUTORS", {})
+
+    cloudwatch_clients = []
+    for _ in range(2):
+        client_factory = ClientFactory("eu-west-2")
+        cloudwatch_clients.append(
+            await client_factory.get_client(CloudWatchClient, "eu-west-2")
+        )
+
+    first, second = cloudwatch_clients
+    assert first is not second
+    # the threads outlive the factory, so warm invocations reuse them
+    assert first.executor
+    assert first.executor is second.executor
+    # sized for the most the adaptive limit can grow to
+    assert first.limiter.current_limit == 20
+    assert first.concurrency == min(40, AWS_CLIENT_MAX_THREADS)
+    assert first.executor._max_workers == first.concurrency
+    assert first.client.meta.config.max_pool_connections >= first.concurrency
+
+    other_region = await client_factory.get_client(CloudWatchClient, "eu-west-1")
+    support = await client_factory.get_client(SupportAppClient, "eu-west-2")
+    assert other_region.executor is not first.executor
+    assert support.executor
+    assert support.executor._max_workers == 2
+
+    api_filter = await client_factory.get_client(APIGatewayFilter, "eu-west-2")
+    assert api_filter.v1_client.executor
+    assert api_filter.v1_client.executor is not api_filter.v2_client.executor
+
+    sqs = client_factory.get_sqs_client("https://queue", "eu-west-2")
+    assert sqs.executor
+
+
+async def test_limiters_shared_across_factories():
+
+    cloudwatch_clients = []
+    for _ in range(2):
+        client_factory = ClientFactory("eu-west-2")
+        cloudwatch_clients.append(
+            await client_factory.get_client(CloudWatchClient, "eu-west-2")
+        )
+
+    first, second = cloudwatch_clients
+    # the limit learned from throttling carries over to warm invocations
+    assert first.limiter is second.limiter
+    first.limiter.on_throttled()
+    assert second.limiter.current_limit == first.limiter.current_limit
+
+    other_region = await client_factory.get_client(CloudWatchClient, "eu-west-1")
+    assert other_region.limiter is not first.limiter
+    api_filter = await client_factory.get_client(APIGatewayFilter, "eu-west-2")
+    assert api_filter.v1_client.limiter is not api_filter.v2_client.limiter
+    assert client_factory._sts.limiter is ClientFactory("eu-west-2")._sts.limiter
+
+
+async def test_limiter_used_from_a_new_event_loop():
+
+    api_limiter = limiter.AdaptiveLimiter("test", initial=1, tps=100)
+
+    async def contend():
+        async def request():
+            async with api_limiter:
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(request(), request(), request())
+
+    await contend()
+    # as when warm invocations run on a new loop
+    await asyncio.to_thread(asyncio.run, contend())
+    await contend()
+    assert api_limiter.in_flight == 0
+
+
+def test_sync_assume_role_retried(monkeypatch):
+
+    monkeypatch.setattr(limiter, "API_RETRY_BASE_DELAY", 0.001)
+    client_factory = ClientFactory("eu-west-2")
+    assume_role = client_factory._sts.client.assume_role
+    errors = [("Throttling", 400), ("InternalFailure", 500)]
+    calls: list[str] = []
+
+    def _assume_role(**kwargs):
+        calls.append(kwargs["RoleArn"])
+        if errors:
+            code, status = errors.pop(0)
+            raise ClientError(
+                {
+                    "Error": {"Code": code},
+                    "ResponseMetadata": {"HTTPStatusCode": status},
+                },
+                "AssumeRole",
+            )
+        return assume_role(**kwargs)
+
+    monkeypatch.setattr(client_factory._sts.client, "assume_role", _assume_role)
+    role = "arn:aws:iam::123456789012:role/metrics-sink"
+    session = client_factory.get_session_sync(role)
+
+    assert session.get_credentials()
+    assert calls == [role] * 3
+
+
+def _tasks(count: int) -> list[CloudwatchMetricTask]:
+    return [
+        CloudwatchMetricTask(
+            ns="AWS/S3",
+            metric_name="NumberOfObjects",
+            resource_name=f"arn:aws:s3:::bucket-{ix}",
+            dimensions={"BucketName": f"bucket-{ix}"},
+            statistic="Average",
+            nil_to_zero=False,
+            add_cw_timestamp=True,
+            unit=None,
+            tags={},
+        )
+        for ix in range(count)
+    ]
+
+
+def test_metric_data_batches_packed_to_limits():
+
+    # 5 datapoints per query, the query limit applies, evenly balanced
+    batches = CloudWatchClient.build_metric_data_batches(60, 300, _tasks(1200))
+    assert [len(b.tasks) for b in batches] == [400, 400, 400]
+    assert [q["Id"] for q in batches[-1].queries][-1] == "m399"
+
+    # 1440 datapoints per query, the datapoint limit applies
+    assert CloudWatchClient.metric_data_batch_size(60, 86400) == 70
+    batches = CloudWatchClient.build_metric_data_batches(60, 86400, _tasks(141))
+    assert [len(b.tasks) for b in batches] == [47, 47, 47]
+
+    # more datapoints than a single request allows, still one query per batch
+    assert CloudWatchClient.metric_data_batch_size(1, 200_000) == 1
+
+
+async def test_metric_data_batches_fetched_concurrently(monkeypatch):
+
+    monkeypatch.setenv("METRICS_API_CONCURRENCY", "3")
+    client = CloudWatchClient(Config(region_name="eu-west-2"))
+
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+    make_api_call = client.client._make_api_call
+
+    def _make_api_call(operation_name, params):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05)
+        try:
+            return make_api_call(operation_name, params)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    monkeypatch.setattr(client.client, "_make_api_call", _make_api_call)
+
+    tasks = _tasks(8)
+    batches = [
+        batch
+        for task in tasks
+        for batch in CloudWatchClient.build_metric_data_batches(60, 300, [task])
+    ]
+    start, end = get_start_end(60, 300, 0)
+    fetched = [
+        task
+        async for page in client.get_metric_data(start, end, batches)
+        for task in page
+    ]
+
+    assert sorted(t.resource_name for t in fetched) == sorted(
+        t.resource_name for t in tasks
+    )
+    assert max_in_flight == 3
+
+
+async def test_metric_data_fetches_finished_on_error():
+
+    client = CloudWatchClient(Config(region_name="eu-west-2"))
+    unwound: list[int] = []
+
+    async def _get_metric_data_batch(start: float, end: float, batch):
+        ix = batches.index(batch)
+        try:
+            if ix < 2:
+                raise ValueError(f"batch {ix} failed")
+            await asyncio.sleep(60)
+        finally:
+            unwound.append(ix)
+
+    client._get_metric_data_batch = _get_metric_data_batch  # type: ignore[method-assign]
+
+    batches = [
+        batch
+        for task in _tasks(3)
+        for batch in CloudWatchClient.build_metric_data_batches(60, 300, [task])
+    ]
+    start, end = get_start_end(60, 300, 0)
+    with pytest.raises(ValueError, match="failed"):
+        async for _page in client.get_metric_data(start, end, batches):
+            pass
+
+    # the fetch still in flight has been cancelled and has finished unwinding
+    assert sorted(unwound) == [0, 1, 2]
+
+
+async def test_identical_queries_deduplicated():
+
+    tasks = _tasks(3)
+    # the same series from a job adding custom tags
+    tagged = [replace(task, tags={"team": "odin"}) for task in tasks]
+    batches = CloudWatchClient.build_metric_data_batches(60, 300, tasks + tagged)
+
+    [batch] = batches
+    assert len(batch.queries) == 3
+    assert batch.query_tasks == [[0, 1], [2, 3], [4, 5]]
+    assert batch.tasks[0].signature != batch.tasks[1].signature
+
+    client = CloudWatchClient(Config(region_name="eu-west-2"))
+    start, end = get_start_end(60, 300, 0)
+    with temp_metrics(
+        [
+            MetricDatum(
+                namespace="AWS/S3",
+                name="NumberOfObjects",
+                value=7,
+                dimensions=[{"Name": "BucketName", "Value": "bucket-0"}],
+                timestamp=datetime.fromtimestamp(end, tz=UTC) - timedelta(minutes=1),
+                unit="Count",
+            )
+        ]
+    ):
+        fetched = [
+            task
+            async for page in client.get_metric_data(start, end, batches)
+            for task in page
+        ]
+
+    assert len(fetched) == 6
+    bucket_0 = [t for t in fetched if t.dimensions["BucketName"] == "bucket-0"]
+    assert [(t.tags, t.get_value()) for t in bucket_0] == [
+        ({}, 7),
+        ({"team": "odin"}, 7),
+    ]
+
+
+def test_rollup_metric_data_queries(monkeypatch):
+
+    series = _tasks(3)
+    rollup = replace(
+        series[0],
+        dimensions={},
+        rollup="SUM",
+        rollup_dimensions=[task.dimensions for task in series],
+    )
+    batches = CloudWatchClient.build_metric_data_batches(60, 300, [rollup, *_tasks(2)])
+
+    [batch] = batches
+    assert [(q["Id"], q["ReturnData"]) for q in batch.queries] == [
+        ("s0_0", False),
+        ("s0_1", False),
+        ("s0_2", False),
+        ("m0", True),
+        ("m1", True),
+        ("m2", True),
+    ]
+    assert batch.queries[3]["Expression"] == "SUM([s0_0, s0_1, s0_2])"
+    assert batch.queries[1]["MetricStat"]["Metric"]["Dimensions"] == [
+        {"Name": "BucketName", "Value": "bucket-1"}
+    ]
+    assert batch.query_tasks == [[0], [1], [2]]
+
+    # a rollup's series count towards the query limit
+    monkeypatch.setattr(clients, "METRIC_DATA_MAX_QUERIES", 5)
+    batches = CloudWatchClient.build_metric_data_batches(60, 300, [rollup, *_tasks(2)])
+    assert [len(b.queries) for b in batches] == [4, 2]
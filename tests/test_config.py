@@ -1,5 +1,7 @@
+import pytest
 from common import temp_config
 from config import ScrapeConfig
+from model import InsightsQuery
 
 
 def test_load_discovery_jobs():
@@ -30,3 +32,50 @@ def test_load_discovery_jobs():
     with temp_config(conf):
         jobs = ScrapeConfig()
         assert len(jobs.discovery_jobs) == len(conf["discovery"]["jobs"])
+
+
+def test_metric_rollup():
+
+    conf: dict = {
+        "discovery": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "metrics": [
+                        {
+                            "name": "HTTPCode_Target_5XX_Count",
+                            "stats": ["Sum"],
+                            "rollup": {"function": "sum", "group_by": ["LoadBalancer"]},
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    with temp_config(conf):
+        [job] = ScrapeConfig().discovery_jobs
+        rollup = job.metrics[0].rollup
+        assert rollup
+        assert (rollup.function, rollup.group_by) == ("SUM", ["LoadBalancer"])
+
+    conf["discovery"]["jobs"][0]["metrics"][0]["rollup"] = {"function": "p99"}
+    with temp_config(conf), pytest.raises(ValueError, match="error parsing"):
+        ScrapeConfig()
+
+
+def test_insights_query_parsing():
+
+    query = InsightsQuery(
+        query='SELECT MAX("CPUUtilization") FROM "AWS/EC2" GROUP BY "InstanceId" LIMIT 5'
+    )
+    assert (query.ns, query.name, query.statistic) == (
+        "AWS/EC2",
+        "CPUUtilization",
+        "Maximum",
+    )
+    assert query.group_by == ["InstanceId"]
+    assert query.label_dimensions("i-123") == {"InstanceId": "i-123"}
+
+    with pytest.raises(ValueError, match="could not parse"):
+        InsightsQuery(query="SELECT PERCENTILE(Latency, 99) FROM SCHEMA(Custom)")
@@ -1,14 +1,21 @@
+import asyncio
 import json
 from datetime import UTC, datetime
+from typing import cast
 from uuid import uuid4
 
 import boto3
+import clients
+import executor as executor_module
+import shared
 from botocore.config import Config
+from cache import HighWaterMarks, TTLCache
 from clients import ClientFactory, SQSClient
 from common import temp_config, temp_metrics
 from config import ScrapeConfig
 from dateutil.relativedelta import relativedelta
-from executor import Executor
+from executor import Executor, MetricEmitter
+from model import CloudwatchMetricResult, CloudwatchMetricTask, MetricStats
 from moto.cloudwatch.models import MetricDatum
 
 
@@ -133,3 +140,650 @@ async def test_alb_discovery_scrape_and_emit(temp_queue, temp_alb):
         assert messages[0]["value"]["sum"] == 10.0
         assert messages[0]["value"]["count"] == 1
         assert messages[0]["value"]["max"] == 10
+
+
+async def test_scrape_plan_reused_across_runs(test_bucket, temp_queue):
+
+    conf = {
+        "discovery": {
+            "jobs": [
+                {
+                    "type": "s3",
+                    "regions": ["eu-west-2"],
+                    "metrics": [
+                        {
+                            "name": "NumberOfObjects",
+                            "stats": ["Average"],
+                            "period": 60,
+                            "length": 86400,  # moto incorrectly excludes 00:00:00 metrics for s3
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    plan_cache: TTLCache = TTLCache("test", 300)
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        plans = []
+        for _ in range(2):
+            client_factory = ClientFactory(config.sts_region)
+            executor = Executor(config, client_factory, sqs_client)
+            for ex in executor.executors:
+                ex.scrape_plan_cache = plan_cache
+            results = await executor.scrape_and_emit()
+            assert results[("eu-west-2", None)]
+            messages = _read_all_messages(temp_queue.url)
+            assert len(messages) == 1
+            assert messages[0]["metric_name"] == "NumberOfObjects"
+            temp_queue.purge()
+            entry = plan_cache.peek((config.config_hash, "eu-west-2", None))
+            assert entry
+            plans.append(entry.value)
+
+        assert plans[0] is plans[1]
+
+
+async def test_pipelined_discovery_scrape_and_emit(
+    test_bucket, temp_queue, monkeypatch
+):
+
+    conf = {
+        "discovery": {
+            "jobs": [
+                {
+                    "type": "s3",
+                    "regions": ["eu-west-2"],
+                    "metrics": [
+                        {
+                            "name": "NumberOfObjects",
+                            "stats": ["Average", "Maximum", "Minimum"],
+                            "period": 60,
+                            "length": 86400,  # moto incorrectly excludes 00:00:00 metrics for s3
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    # one task per batch, so batches are fetched while discovery is still queueing
+    monkeypatch.setattr(clients, "METRIC_DATA_MAX_QUERIES", 1)
+
+    plan_cache: TTLCache = TTLCache("test", 300)
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        for _ in range(2):
+            client_factory = ClientFactory(config.sts_region)
+            executor = Executor(config, client_factory, sqs_client)
+            for ex in executor.executors:
+                ex.scrape_plan_cache = plan_cache
+                ex.pipeline_discovery = True
+            results = await executor.scrape_and_emit()
+            assert results[("eu-west-2", None)][0].count == 3
+            messages = _read_all_messages(temp_queue.url)
+            assert len(messages) == 1
+            assert set(messages[0]["value"]) == {"avg", "max", "min"}
+            temp_queue.purge()
+
+            # the pipelined run stores its batches as the plan for the next run
+            entry = plan_cache.peek((config.config_hash, "eu-west-2", None))
+            assert entry
+            batches = entry.value.buckets[(60, 0, 86400)]
+            assert len(batches) == 3
+
+
+async def test_static_jobs_batched_with_get_metric_data(temp_queue, monkeypatch):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/static/1"},
+                    "custom_tags": {"team": "odin"},
+                    "metrics": [
+                        # a longer window, so a minute ticking over mid test is fine
+                        {
+                            "name": "RequestCount",
+                            "stats": ["Sum", "Maximum"],
+                            "length": 300,
+                        },
+                        {
+                            "name": "HealthyHostCount",
+                            "stats": ["Minimum"],
+                            "length": 300,
+                        },
+                        {
+                            "name": "RejectedConnectionCount",
+                            "stats": ["Sum"],
+                            "nil_to_zero": True,
+                            "length": 300,
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    calls: list[str] = []
+    call = clients.CloudWatchClient._call
+
+    async def _call(self, method_name: str, **kwargs):
+        calls.append(method_name)
+        return await call(self, method_name, **kwargs)
+
+    monkeypatch.setattr(clients.CloudWatchClient, "_call", _call)
+
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        client_factory = ClientFactory(config.sts_region)
+
+        executor = Executor(config, client_factory, sqs_client)
+        with temp_metrics(
+            [
+                MetricDatum(
+                    namespace="AWS/ApplicationELB",
+                    name="RequestCount",
+                    value=10,
+                    dimensions=[{"Name": "LoadBalancer", "Value": "app/static/1"}],
+                    timestamp=datetime.now(tz=UTC).replace(second=0, microsecond=0)
+                    - relativedelta(minutes=1),
+                    unit="Count",
+                )
+            ]
+        ):
+            results = await executor.scrape_and_emit()
+
+        assert calls == ["get_metric_data"]
+        assert {(s.name, s.count) for s in results[("eu-west-2", None)]} == {
+            ("RequestCount", 2),
+            ("HealthyHostCount", 1),
+            ("RejectedConnectionCount", 1),
+        }
+        messages = {m["metric_name"]: m for m in _read_all_messages(temp_queue.url)}
+        # static metrics are emitted without datapoints, and without the custom tags
+        assert set(messages) == {
+            "RequestCount",
+            "HealthyHostCount",
+            "RejectedConnectionCount",
+        }
+        assert messages["RequestCount"]["value"] == {"sum": 10.0, "max": 10.0}
+        assert messages["RequestCount"]["tags"] == {}
+        assert messages["HealthyHostCount"]["value"] == {"min": None}
+        assert messages["RequestCount"]["dimensions"] == {
+            "LoadBalancer": "app/static/1"
+        }
+        assert messages["RejectedConnectionCount"]["value"] == {"sum": 0}
+
+
+async def test_incremental_windows_only_emit_new_datapoints(temp_queue, monkeypatch):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": f"app/incremental/{ix}"},
+                    "metrics": [
+                        {
+                            "name": "RequestCount",
+                            "stats": ["Sum"],
+                            "length": 600,
+                            "nil_to_zero": True,
+                        }
+                    ],
+                }
+                for ix in (1, 2)
+            ]
+        }
+    }
+
+    now = datetime.now(tz=UTC).replace(second=0, microsecond=0)
+    # the clock is fixed so the runs share a window
+    monkeypatch.setattr(shared, "time", lambda: now.timestamp())
+
+    def _datum(ix: int, minutes_ago: int, value: float) -> MetricDatum:
+        return MetricDatum(
+            namespace="AWS/ApplicationELB",
+            name="RequestCount",
+            value=value,
+            dimensions=[{"Name": "LoadBalancer", "Value": f"app/incremental/{ix}"}],
+            timestamp=now - relativedelta(minutes=minutes_ago),
+            unit="Count",
+        )
+
+    high_water_marks = HighWaterMarks("test", enabled=True)
+    sqs_client = _get_sqs_client(temp_queue.url)
+    sums: list[dict[str, float]] = []
+    with temp_config(conf):
+        config = ScrapeConfig()
+        first = [_datum(1, 3, 1), _datum(1, 2, 2)]
+        runs = [
+            first,
+            # a new datapoint arrives for the first series
+            [*first, _datum(1, 1, 4)],
+            [*first, _datum(1, 1, 4)],
+            # then for the second
+            [*first, _datum(1, 1, 4), _datum(2, 1, 5)],
+            [*first, _datum(1, 1, 4), _datum(2, 1, 5)],
+        ]
+        for datums in runs:
+            client_factory = ClientFactory(config.sts_region)
+            executor = Executor(config, client_factory, sqs_client)
+            for ex in executor.executors:
+                ex.high_water_marks = high_water_marks
+            with temp_metrics(datums):
+                await executor.scrape_and_emit()
+            sums.append(
+                {
+                    m["dimensions"]["LoadBalancer"]: m["value"]["sum"]
+                    for m in _read_all_messages(temp_queue.url)
+                }
+            )
+
+    # only datapoints after the last emitted one are emitted, a series with a mark and
+    # nothing newer is not emitted at all, not even as zero, whether its datapoints were
+    # fetched for a series without a mark in the batch, or the batch was skipped
+    assert sums == [
+        {"app/incremental/1": 3, "app/incremental/2": 0},
+        {"app/incremental/1": 4, "app/incremental/2": 0},
+        {"app/incremental/2": 0},
+        {"app/incremental/2": 5},
+        {},
+    ]
+    marks = {key[3][2]: mark.timestamp for key, mark in high_water_marks.items()}
+    assert marks == {
+        (("LoadBalancer", f"app/incremental/{ix}"),): (
+            now - relativedelta(minutes=1)
+        ).timestamp()
+        for ix in (1, 2)
+    }
+
+
+async def test_incremental_windows_per_period(temp_queue, monkeypatch):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/periods/1"},
+                    "metrics": [
+                        {
+                            "name": "RequestCount",
+                            "stats": ["Sum"],
+                            "period": period,
+                            "length": 600,
+                        }
+                        for period in (60, 300)
+                    ],
+                }
+            ]
+        }
+    }
+
+    # the clock is fixed for each run, aligned to both periods
+    start = datetime.fromtimestamp(
+        (datetime.now(tz=UTC).timestamp() // 600 - 1) * 600, tz=UTC
+    )
+
+    def _datum(minutes: int, value: float) -> MetricDatum:
+        return MetricDatum(
+            namespace="AWS/ApplicationELB",
+            name="RequestCount",
+            value=value,
+            dimensions=[{"Name": "LoadBalancer", "Value": "app/periods/1"}],
+            timestamp=start + relativedelta(minutes=minutes),
+            unit="Count",
+        )
+
+    high_water_marks = HighWaterMarks("test", enabled=True)
+    sqs_client = _get_sqs_client(temp_queue.url)
+    sums: list[list[float]] = []
+    with temp_config(conf):
+        config = ScrapeConfig()
+        # a new datapoint arrives between the runs, five minutes apart
+        runs = [
+            (0, [_datum(-8, 1), _datum(-3, 2)]),
+            (5, [_datum(-8, 1), _datum(-3, 2), _datum(1, 4)]),
+        ]
+        for minutes, datums in runs:
+            now = (start + relativedelta(minutes=minutes)).timestamp()
+            monkeypatch.setattr(shared, "time", lambda now=now: now)
+            client_factory = ClientFactory(config.sts_region)
+            executor = Executor(config, client_factory, sqs_client)
+            for ex in executor.executors:
+                ex.high_water_marks = high_water_marks
+            with temp_metrics(datums):
+                await executor.scrape_and_emit()
+            sums.append(
+                sorted(m["value"]["sum"] for m in _read_all_messages(temp_queue.url))
+            )
+
+    # each period has its own mark, so neither skips the datapoints of the other
+    assert sums == [[3, 3], [4, 4]]
+    marks = {key[2]: mark.timestamp for key, mark in high_water_marks.items()}
+    assert marks == {
+        (60, 0, 600): (start + relativedelta(minutes=1)).timestamp(),
+        (300, 0, 600): start.timestamp(),
+    }
+
+
+async def test_windows_per_length(temp_queue, monkeypatch):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/lengths/1"},
+                    "metrics": [
+                        {"name": "RequestCount", "stats": ["Sum"], "length": 60},
+                        {"name": "HealthyHostCount", "stats": ["Minimum"]},
+                        {
+                            "name": "ActiveConnectionCount",
+                            "stats": ["Sum"],
+                            "length": 900,
+                        },
+                    ],
+                }
+            ]
+        }
+    }
+
+    windows: dict[float, list[str]] = {}
+    call = clients.CloudWatchClient._call
+
+    async def _call(self, method_name: str, **kwargs):
+        windows[kwargs["EndTime"] - kwargs["StartTime"]] = [
+            q["MetricStat"]["Metric"]["MetricName"] for q in kwargs["MetricDataQueries"]
+        ]
+        return await call(self, method_name, **kwargs)
+
+    monkeypatch.setattr(clients.CloudWatchClient, "_call", _call)
+
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        client_factory = ClientFactory(config.sts_region)
+        executor = Executor(config, client_factory, sqs_client)
+        await executor.scrape_and_emit()
+
+    # requests sharing a period are not fetched over the longest length
+    assert windows == {
+        60: ["RequestCount", "HealthyHostCount"],
+        900: ["ActiveConnectionCount"],
+    }
+
+
+async def test_scrape_shed_to_budget(temp_queue):
+
+    conf = {
+        "budget": {"max_metrics": 2},
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/budget/1"},
+                    "metrics": [
+                        {"name": "RequestCount", "stats": ["Sum"], "nil_to_zero": True},
+                        {
+                            "name": "HTTPCode_ELB_5XX_Count",
+                            "stats": ["Sum"],
+                            "nil_to_zero": True,
+                            "priority": 1,
+                        },
+                        {
+                            "name": "HealthyHostCount",
+                            "stats": ["Minimum"],
+                            "nil_to_zero": True,
+                            "priority": 1,
+                        },
+                    ],
+                }
+            ]
+        },
+    }
+
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        client_factory = ClientFactory(config.sts_region)
+        executor = Executor(config, client_factory, sqs_client)
+        await executor.scrape_and_emit()
+
+    messages = _read_all_messages(temp_queue.url)
+    assert {m["metric_name"] for m in messages} == {
+        "HTTPCode_ELB_5XX_Count",
+        "HealthyHostCount",
+    }
+    assert [(d.name, d.reason, d.count) for d in executor.dropped_metrics] == [
+        ("RequestCount", "metrics", 1)
+    ]
+
+
+async def test_insights_scrape_and_emit(temp_queue, monkeypatch):
+
+    conf = {
+        "insights": {
+            "jobs": [
+                {
+                    "regions": ["eu-west-2"],
+                    "custom_tags": {"team": "odin"},
+                    "queries": [
+                        {
+                            "query": 'SELECT SUM(RequestCount) FROM SCHEMA("AWS/ApplicationELB", '
+                            "LoadBalancer, TargetGroup) GROUP BY LoadBalancer, TargetGroup "
+                            "ORDER BY SUM() DESC LIMIT 10",
+                            "length": 300,
+                        }
+                    ],
+                }
+            ]
+        }
+    }
+
+    requests: list[dict] = []
+    now = datetime.now(tz=UTC)
+
+    async def _call(self, method_name: str, **kwargs):
+        requests.append(kwargs)
+        # a page per series, as the results of a query can be paginated
+        page = len(requests)
+        return {
+            "MetricDataResults": [
+                {
+                    "Id": "q0",
+                    "Label": f"app/lb-{page}|targetgroup/tg-{page}",
+                    "Values": [page * 10.0],
+                    "Timestamps": [now],
+                    "StatusCode": "Complete",
+                }
+            ],
+            **({"NextToken": "page-2"} if page == 1 else {}),
+        }
+
+    monkeypatch.setattr(clients.CloudWatchClient, "_call", _call)
+
+    sqs_client = _get_sqs_client(temp_queue.url)
+    with temp_config(conf):
+        config = ScrapeConfig()
+        client_factory = ClientFactory(config.sts_region)
+        executor = Executor(config, client_factory, sqs_client)
+        results = await executor.scrape_and_emit()
+
+    [query] = requests[0]["MetricDataQueries"]
+    assert query["Expression"].startswith("SELECT SUM(RequestCount)")
+    assert query["Label"] == "${PROP('Dim.LoadBalancer')}|${PROP('Dim.TargetGroup')}"
+    assert requests[1]["NextToken"] == "page-2"
+
+    assert [(s.ns, s.name, s.count) for s in results[("eu-west-2", None)]] == [
+        ("AWS/ApplicationELB", "RequestCount", 2)
+    ]
+    messages = sorted(
+        _read_all_messages(temp_queue.url), key=lambda m: m["value"]["sum"]
+    )
+    assert [
+        (m["namespace"], m["metric_name"], m["dimensions"], m["tags"], m["value"])
+        for m in messages
+    ] == [
+        (
+            "AWS/ApplicationELB",
+            "RequestCount",
+            {"LoadBalancer": f"app/lb-{page}", "TargetGroup": f"targetgroup/tg-{page}"},
+            {"team": "odin"},
+            {"sum": page * 10.0},
+        )
+        for page in (1, 2)
+    ]
+
+
+async def test_series_emitted_as_they_complete(monkeypatch):
+
+    monkeypatch.setattr(executor_module, "EMIT_FLUSH_MESSAGES", 1)
+    now = datetime.now(tz=UTC)
+
+    sent: list[list[dict]] = []
+
+    class _SQS:
+        async def send_messages(self, messages: list[dict]):
+            sent.append(messages)
+
+    def _task(bucket: str, statistic: str) -> CloudwatchMetricTask:
+        return CloudwatchMetricTask(
+            ns="AWS/S3",
+            metric_name="BucketSizeBytes",
+            resource_name=bucket,
+            dimensions={"BucketName": bucket},
+            statistic=statistic,
+            nil_to_zero=False,
+            add_cw_timestamp=True,
+            unit=None,
+            tags={},
+            result=CloudwatchMetricResult(timestamps=[now], values=[1.0]),
+        )
+
+    tasks = [
+        _task(bucket, stat) for bucket in ("a", "b") for stat in ("Sum", "Maximum")
+    ]
+    on_sent: list[list[CloudwatchMetricTask]] = []
+    emitter = MetricEmitter(
+        cast(SQSClient, _SQS()), {"region": "eu-west-2"}, on_sent=on_sent.append
+    )
+    emitter.expect(tasks)
+
+    # one stat of each series, nothing is complete
+    await emitter.add([tasks[0], tasks[2]])
+    await asyncio.sleep(0)
+    assert not sent
+
+    # bucket a is complete and sent while b is still in flight
+    await emitter.add([tasks[1]])
+    await asyncio.sleep(0)
+    assert [[m["dimensions"] for m in messages] for messages in sent] == [
+        [{"BucketName": "a"}]
+    ]
+    assert sent[0][0]["value"] == {"sum": 1.0, "max": 1.0}
+    assert list(emitter.arrived) == [tasks[2].signature]
+
+    await emitter.add([tasks[3]])
+    stats = await emitter.finish()
+    assert [m["dimensions"]["BucketName"] for ms in sent for m in ms] == ["a", "b"]
+    assert on_sent == [tasks[:2], tasks[2:]]
+    assert [(s.ns, s.name, s.count) for s in stats] == [
+        ("AWS/S3", "BucketSizeBytes", 4)
+    ]
+
+
+async def test_concurrent_adds_send_every_series(monkeypatch):
+
+    monkeypatch.setattr(executor_module, "EMIT_FLUSH_MESSAGES", 1)
+    now = datetime.now(tz=UTC)
+
+    sent: list[str] = []
+    in_flight = max_in_flight = 0
+
+    class _SQS:
+        async def send_messages(self, messages: list[dict]):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            sent.extend(m["dimensions"]["BucketName"] for m in messages)
+
+    def _task(bucket: str) -> CloudwatchMetricTask:
+        return CloudwatchMetricTask(
+            ns="AWS/S3",
+            metric_name="BucketSizeBytes",
+            resource_name=bucket,
+            dimensions={"BucketName": bucket},
+            statistic="Sum",
+            nil_to_zero=False,
+            add_cw_timestamp=True,
+            unit=None,
+            tags={},
+            result=CloudwatchMetricResult(timestamps=[now], values=[1.0]),
+        )
+
+    tasks = [_task(f"bucket-{i}") for i in range(20)]
+    emitter = MetricEmitter(cast(SQSClient, _SQS()), {"region": "eu-west-2"})
+    emitter.expect(tasks)
+
+    # as from the concurrent fetches of a pipelined run
+    await asyncio.gather(*(emitter.add([task]) for task in tasks))
+    stats = await emitter.finish()
+
+    assert sorted(sent) == sorted(task.resource_name for task in tasks)
+    assert stats == [MetricStats(ns="AWS/S3", name="BucketSizeBytes", count=20)]
+    assert max_in_flight <= executor_module.EMIT_MAX_PENDING_SENDS
+    assert not emitter.sends
+
+
+async def test_series_without_datapoints():
+
+    sent: list[dict] = []
+
+    class _SQS:
+        async def send_messages(self, messages: list[dict]):
+            sent.extend(messages)
+
+    def _task(resource_name: str, nil_to_zero: bool) -> CloudwatchMetricTask:
+        return CloudwatchMetricTask(
+            ns="AWS/ApplicationELB",
+            metric_name="RequestCount",
+            resource_name=resource_name,
+            dimensions={"LoadBalancer": f"app/{resource_name}/{nil_to_zero}"},
+            statistic="Sum",
+            nil_to_zero=nil_to_zero,
+            add_cw_timestamp=False,
+            unit=None,
+            tags={},
+            result=CloudwatchMetricResult(timestamps=[], values=[]),
+        )
+
+    tasks = [
+        _task(resource_name, nil_to_zero)
+        for resource_name in ("static", "arn:aws:elasticloadbalancing:lb")
+        for nil_to_zero in (False, True)
+    ]
+    emitter = MetricEmitter(cast(SQSClient, _SQS()), {})
+    emitter.expect(tasks)
+    await emitter.add(tasks)
+    await emitter.finish()
+
+    # static metrics are always emitted, discovered series only with datapoints
+    assert [(m["dimensions"]["LoadBalancer"], m["value"]) for m in sent] == [
+        ("app/static/False", {"sum": None}),
+        ("app/static/True", {"sum": 0}),
+    ]
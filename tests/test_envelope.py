@@ -0,0 +1,193 @@
+import json
+import time
+
+import boto3
+import pytest
+from botocore.config import Config
+from clients import SQSClient
+from envelope import entry_size, pack_batches, pack_envelopes, unpack_envelope
+from spill import SpillBuffer
+
+
+def _messages(count: int) -> list[dict]:
+    return [
+        {
+            "namespace": "AWS/ApplicationELB",
+            "metric_name": "RequestCount",
+            "dimensions": {"LoadBalancer": f"app/lb-{ix}", "TargetGroup": f"tg-{ix}"},
+            "tags": {"project": "odin"},
+            "value": {"sum": float(ix)},
+            "timestamp": 1700000000 + ix,
+        }
+        for ix in range(count)
+    ]
+
+
+@pytest.mark.parametrize("encoding", ["json", "gzip"])
+def test_pack_envelopes_within_max_bytes(encoding: str):
+
+    messages = _messages(2000)
+    entries = pack_envelopes(messages, encoding, max_bytes=16_384)
+
+    assert all(entry_size(entry) <= 16_384 for entry in entries)
+    unpacked = [
+        message
+        for entry in entries
+        for message in unpack_envelope(entry["MessageBody"], entry["MessageAttributes"])
+    ]
+    assert unpacked == messages
+    assert sum(
+        int(entry["MessageAttributes"]["metric_count"]["StringValue"])
+        for entry in entries
+    ) == len(messages)
+    # many messages per envelope, compression packs several times more
+    assert len(entries) <= (3 if encoding == "gzip" else 30)
+
+
+def test_unpack_unknown_version():
+
+    with pytest.raises(ValueError, match="unsupported envelope version"):
+        unpack_envelope(
+            "[]",
+            {
+                "envelope_version": {"DataType": "String", "StringValue": "2"},
+                "content_encoding": {"DataType": "String", "StringValue": "json"},
+            },
+        )
+
+
+async def test_send_enveloped_messages(temp_queue):
+
+    messages = _messages(500)
+    sqs_client = SQSClient(
+        queue_url=temp_queue.url,
+        config=Config(region_name="eu-west-2"),
+        envelope="gzip",
+    )
+    await sqs_client.send_messages(messages)
+
+    sqs = boto3.client("sqs", region_name="eu-west-2")
+    received = []
+    while response := sqs.receive_message(
+        QueueUrl=temp_queue.url,
+        MaxNumberOfMessages=10,
+        MessageAttributeNames=["All"],
+    ).get("Messages"):
+        received.extend(response)
+
+    assert len(received) == 1
+    [message] = received
+    assert unpack_envelope(message["Body"], message["MessageAttributes"]) == messages
+
+
+def test_pack_batches_by_count_and_size():
+
+    small = [{"MessageBody": "x" * 100} for _ in range(25)]
+    assert [len(batch) for batch in pack_batches(small)] == [10, 10, 5]
+
+    large = [{"MessageBody": "x" * 100_000} for _ in range(5)]
+    batches = pack_batches(large)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [entry["Id"] for entry in batches[0]] == ["0", "1"]
+
+
+async def test_send_messages_concurrently(temp_queue):
+
+    messages = _messages(95)
+    sqs_client = SQSClient(
+        queue_url=temp_queue.url, config=Config(region_name="eu-west-2")
+    )
+    in_flight = 0
+    most_in_flight = 0
+    send_message_batch = sqs_client.client.send_message_batch
+
+    def _send_message_batch(**kwargs):
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        time.sleep(0.05)
+        in_flight -= 1
+        return send_message_batch(**kwargs)
+
+    sqs_client.client.send_message_batch = _send_message_batch
+    await sqs_client.send_messages(messages)
+
+    assert most_in_flight > 1
+    throughput = sqs_client.throughput
+    assert (throughput.messages, throughput.entries, throughput.requests) == (
+        95,
+        95,
+        10,
+    )
+    assert throughput.bytes == sum(len(json.dumps(m)) for m in messages)
+    assert throughput.seconds > 0
+
+
+def _receive_all(queue_url: str) -> list[dict]:
+    sqs = boto3.client("sqs", region_name="eu-west-2")
+    received: list[dict] = []
+    while response := sqs.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=10
+    ).get("Messages"):
+        received.extend(json.loads(message["Body"]) for message in response)
+    return received
+
+
+async def test_failed_entries_retried(temp_queue, tmp_path):
+
+    messages = _messages(10)
+    sqs_client = SQSClient(
+        queue_url=temp_queue.url,
+        config=Config(region_name="eu-west-2"),
+        spill=SpillBuffer(temp_queue.url, root=str(tmp_path)),
+    )
+    send_message_batch = sqs_client.client.send_message_batch
+    calls: list[list[str]] = []
+
+    def _send_message_batch(QueueUrl: str, Entries: list[dict]):
+        calls.append([entry["Id"] for entry in Entries])
+        if len(calls) > 1:
+            return send_message_batch(QueueUrl=QueueUrl, Entries=Entries)
+        # the first two fail, one can be retried
+        response = send_message_batch(QueueUrl=QueueUrl, Entries=Entries[2:])
+        response["Failed"] = [
+            {"Id": "0", "SenderFault": False, "Code": "InternalError"},
+            {"Id": "1", "SenderFault": True, "Code": "InvalidMessageContents"},
+        ]
+        return response
+
+    sqs_client.client.send_message_batch = _send_message_batch
+    await sqs_client.send_messages(messages)
+
+    assert calls == [[str(ix) for ix in range(10)], ["0"]]
+    received = _receive_all(temp_queue.url)
+    assert sorted(m["timestamp"] for m in received) == sorted(
+        m["timestamp"] for ix, m in enumerate(messages) if ix != 1
+    )
+    throughput = sqs_client.throughput
+    assert (throughput.entries, throughput.dropped, throughput.spilled) == (9, 1, 0)
+
+
+async def test_spill_at_deadline_and_drain(temp_queue, tmp_path):
+
+    messages = _messages(25)
+    spill = SpillBuffer(temp_queue.url, root=str(tmp_path))
+    config = Config(region_name="eu-west-2")
+
+    sqs_client = SQSClient(queue_url=temp_queue.url, config=config, spill=spill)
+    sqs_client.deadline = time.monotonic()
+    await sqs_client.send_messages(messages)
+
+    assert not _receive_all(temp_queue.url)
+    assert sqs_client.throughput.spilled == 25
+    assert len(spill.files()) == 3
+
+    # the next invocation
+    sqs_client = SQSClient(queue_url=temp_queue.url, config=config, spill=spill)
+    await sqs_client.drain_spill()
+
+    assert not spill.files()
+    assert sqs_client.throughput.drained == 25
+    assert (
+        sorted(_receive_all(temp_queue.url), key=lambda m: m["timestamp"]) == messages
+    )
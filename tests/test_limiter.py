@@ -0,0 +1,101 @@
+import asyncio
+from time import monotonic
+
+import limiter
+import pytest
+from botocore.exceptions import ClientError
+from limiter import AdaptiveLimiter, TokenBucket, with_retries
+
+
+def _error(code: str, status: int = 400) -> ClientError:
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "GetMetricData",
+    )
+
+
+async def test_limit_increases_at_limit_and_halves_on_throttling():
+
+    adaptive = AdaptiveLimiter("test", initial=4, max_limit=6, decrease_interval=0)
+
+    async def _request():
+        async with adaptive:
+            await asyncio.sleep(0.01)
+
+    # using the limit grows it by about one per limit's worth of requests
+    for _ in range(10):
+        await asyncio.gather(*(_request() for _ in range(adaptive.current_limit)))
+    assert adaptive.current_limit == 6
+
+    # requests that don't use the limit don't grow it
+    adaptive = AdaptiveLimiter("test", initial=4, max_limit=6, decrease_interval=0)
+    for _ in range(10):
+        await _request()
+    assert adaptive.current_limit == 4
+
+    with pytest.raises(ClientError):
+        async with adaptive:
+            raise _error("ThrottlingException")
+    assert adaptive.current_limit == 2
+
+    with pytest.raises(ClientError):
+        async with adaptive:
+            raise _error("SomethingElse", 429)
+    assert adaptive.current_limit == 1
+    assert adaptive.in_flight == 0
+
+
+async def test_limiter_bounds_in_flight():
+
+    adaptive = AdaptiveLimiter("test", initial=2)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def _request():
+        nonlocal in_flight, max_in_flight
+        async with adaptive:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    await asyncio.gather(*(_request() for _ in range(10)))
+    assert max_in_flight == 2
+
+
+async def test_token_bucket_rate():
+
+    bucket = TokenBucket(rate=50, capacity=1)
+    started = monotonic()
+    for _ in range(6):
+        await bucket.take()
+    assert monotonic() - started >= 0.09
+
+
+async def test_retries_throttling_and_server_errors(monkeypatch):
+
+    monkeypatch.setattr(limiter, "API_RETRY_BASE_DELAY", 0.001)
+    adaptive = AdaptiveLimiter("test", initial=8, decrease_interval=0)
+    errors = [_error("Throttling"), _error("InternalFailure", 500)]
+
+    async def _flaky() -> str:
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert await with_retries(adaptive, _flaky) == "ok"
+    assert adaptive.current_limit == 4
+
+    async def _invalid():
+        raise _error("ValidationError")
+
+    with pytest.raises(ClientError):
+        await with_retries(adaptive, _invalid)
+
+    async def _throttled():
+        raise _error("Throttling")
+
+    with pytest.raises(ClientError):
+        await with_retries(adaptive, _throttled, max_attempts=3)
+    assert adaptive.current_limit == 1
+    assert adaptive.in_flight == 0
@@ -5,7 +5,8 @@ from botocore.config import Config
 from clients import ClientFactory, SQSClient
 from common import temp_config, temp_metrics
 from config import ScrapeConfig
-from executor import Executor
+from executor import Executor, rollup_metric_tasks
+from model import CloudwatchMetricTask, MetricRollup
 from moto.cloudwatch.models import MetricDatum
 
 
@@ -148,3 +149,44 @@ async def test_alb_metric_discovery(test_bucket, temp_alb):
         metrics = region_result.get((60, 0, 60))
         assert metrics
         assert len(metrics) == 1
+
+
+def test_rollup_metric_tasks():
+
+    def _task(lb: str, tg: str, statistic: str, team: str) -> CloudwatchMetricTask:
+        return CloudwatchMetricTask(
+            ns="AWS/ApplicationELB",
+            metric_name="HTTPCode_Target_5XX_Count",
+            resource_name=f"arn:{lb}",
+            dimensions={"LoadBalancer": lb, "TargetGroup": tg},
+            statistic=statistic,
+            nil_to_zero=False,
+            add_cw_timestamp=True,
+            unit=None,
+            tags={"project": "odin", "team": team},
+        )
+
+    tasks = [
+        _task(lb, tg, statistic, team)
+        for lb in ("lb-1", "lb-2")
+        for tg, team in (("tg-1", "a"), ("tg-2", "b"))
+        for statistic in ("Sum", "Maximum")
+    ]
+
+    rolled_up = rollup_metric_tasks(
+        MetricRollup(function="SUM", group_by=["LoadBalancer"]), tasks
+    )
+
+    assert len(rolled_up) == 4
+    first = rolled_up[0]
+    assert (first.dimensions, first.statistic, first.rollup) == (
+        {"LoadBalancer": "lb-1"},
+        "Sum",
+        "SUM",
+    )
+    assert first.resource_name == "arn:lb-1"
+    assert first.tags == {"project": "odin"}
+    assert first.rollup_dimensions == [
+        {"LoadBalancer": "lb-1", "TargetGroup": "tg-1"},
+        {"LoadBalancer": "lb-1", "TargetGroup": "tg-2"},
+    ]
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import threading
+from time import monotonic
+
+import boto3
+import function
+import pytest
+import sinks
+from botocore.config import Config
+from clients import ClientFactory, SQSClient
+from common import temp_config
+from config import ScrapeConfig
+from executor import Executor
+from limiter import API_MAX_ATTEMPTS
+from sinks import FileSink, FirehoseSink, KinesisSink, S3Sink, get_sink
+
+_CONFIG = Config(region_name="eu-west-2")
+
+
+def _messages(count: int) -> list[dict]:
+    return [
+        {
+            "namespace": "AWS/SQS",
+            "metric_name": "NumberOfMessagesSent",
+            "dimensions": {"QueueName": f"queue-{ix}"},
+            "value": {"sum": float(ix)},
+        }
+        for ix in range(count)
+    ]
+
+
+def test_get_sink(tmp_path):
+
+    factory = ClientFactory()
+    assert isinstance(
+        get_sink("https://sqs.eu-west-2.amazonaws.com/1/q", factory, "eu-west-2"),
+        SQSClient,
+    )
+    assert isinstance(
+        get_sink(str(tmp_path / "m.jsonl"), factory, "eu-west-2"), FileSink
+    )
+    assert isinstance(get_sink("kinesis://metrics", factory, "eu-west-2"), KinesisSink)
+    assert isinstance(
+        get_sink("firehose://metrics", factory, "eu-west-2"), FirehoseSink
+    )
+    sink = get_sink("s3://bucket/metrics/", factory, "eu-west-2")
+    assert isinstance(sink, S3Sink)
+    assert sink.object_key().startswith("metrics/")
+
+    with pytest.raises(ValueError, match="unsupported sink url"):
+        get_sink("ftp://metrics", factory, "eu-west-2")
+
+
+def test_sink_url_required(monkeypatch):
+
+    monkeypatch.delenv("SINK_URL", raising=False)
+    monkeypatch.delenv("QUEUE_URL", raising=False)
+    with pytest.raises(ValueError, match="SINK_URL or QUEUE_URL must be set"):
+        function._sink_url()
+
+    monkeypatch.setenv("QUEUE_URL", "https://sqs.eu-west-2.amazonaws.com/1/q")
+    assert function._sink_url() == "https://sqs.eu-west-2.amazonaws.com/1/q"
+    monkeypatch.setenv("SINK_URL", "kinesis://metrics")
+    assert function._sink_url() == "kinesis://metrics"
+
+
+async def test_kinesis_sink_retries_failed_records():
+
+    kinesis = boto3.client("kinesis", region_name="eu-west-2")
+    kinesis.create_stream(StreamName="metrics", ShardCount=1)
+
+    sink = KinesisSink("metrics", config=_CONFIG)
+    put_records = sink.client.put_records
+    calls: list[int] = []
+    throttled: set[bytes] = set()
+    # moto's shards are not thread safe
+    lock = threading.Lock()
+
+    def _put_records(StreamName: str, Records: list[dict]):
+        with lock:
+            calls.append(len(Records))
+            first = Records[0]["Data"]
+            if first in throttled:
+                return put_records(StreamName=StreamName, Records=Records)
+            # the first record of each batch is throttled once
+            throttled.add(first)
+            response = put_records(StreamName=StreamName, Records=Records[1:])
+            response["Records"].insert(
+                0, {"ErrorCode": "ProvisionedThroughputExceededException"}
+            )
+            return response
+
+    sink.client.put_records = _put_records
+    messages = _messages(600)
+    await sink.send_messages(messages)
+
+    assert sorted(calls) == [1, 1, 100, 500]
+    shard_id = kinesis.describe_stream(StreamName="metrics")["StreamDescription"][
+        "Shards"
+    ][0]["ShardId"]
+    iterator = kinesis.get_shard_iterator(
+        StreamName="metrics", ShardId=shard_id, ShardIteratorType="TRIM_HORIZON"
+    )["ShardIterator"]
+    records = kinesis.get_records(ShardIterator=iterator, Limit=1000)["Records"]
+    assert sorted(json.loads(r["Data"])["value"]["sum"] for r in records) == [
+        float(ix) for ix in range(600)
+    ]
+    assert (sink.throughput.requests, sink.throughput.entries) == (4, 600)
+
+
+@pytest.mark.parametrize(
+    ("sink_type", "method", "response_key"),
+    [
+        (KinesisSink, "put_records", "Records"),
+        (FirehoseSink, "put_record_batch", "RequestResponses"),
+    ],
+)
+async def test_record_sink_drops_failing_records(
+    sink_type, method: str, response_key: str, monkeypatch
+):
+
+    monkeypatch.setattr(sinks, "retry_delay", lambda attempt: 0)
+    errors: list[str] = []
+    monkeypatch.setattr(sinks.logger, "error", errors.append)
+
+    sink = sink_type("metrics", config=_CONFIG)
+    calls: list[int] = []
+
+    def _put(**kwargs):
+        records = kwargs["Records"]
+        calls.append(len(records))
+        # the first record always fails
+        return {
+            response_key: [{"ErrorCode": "InternalFailure"}, *({} for _ in records[1:])]
+        }
+
+    setattr(sink.client, method, _put)
+    await sink.send_messages(_messages(3))
+
+    assert calls == [3] + [1] * (API_MAX_ATTEMPTS - 1)
+    assert (sink.throughput.entries, sink.throughput.dropped) == (2, 1)
+    assert errors == [
+        f"{sink.name} dropping 1 unsent records: failing after {API_MAX_ATTEMPTS} attempts"
+    ]
+
+    # past the deadline records are dropped without a request
+    calls.clear()
+    sink.deadline = monotonic()
+    await sink.send_messages(_messages(2))
+    assert not calls
+    assert sink.throughput.dropped == 3
+    assert errors[-1] == f"{sink.name} dropping 2 unsent records: deadline reached"
+
+
+async def test_s3_sink_one_object_per_invocation(test_bucket):
+
+    sink = S3Sink(test_bucket.name, "metrics", config=_CONFIG)
+    await sink.send_messages(_messages(3))
+    await sink.send_messages(_messages(2))
+    await sink.close()
+
+    [obj] = list(test_bucket.objects.filter(Prefix="metrics/"))
+    lines = obj.get()["Body"].read().decode().splitlines()
+    assert [json.loads(line)["dimensions"]["QueueName"] for line in lines] == [
+        "queue-0",
+        "queue-1",
+        "queue-2",
+        "queue-0",
+        "queue-1",
+    ]
+
+
+async def test_s3_sink_writes_at_deadline(test_bucket):
+
+    def _object_lines() -> list[int]:
+        return sorted(
+            len(obj.get()["Body"].read().splitlines())
+            for obj in test_bucket.objects.filter(Prefix="deadline/")
+        )
+
+    sink = S3Sink(test_bucket.name, "deadline", config=_CONFIG)
+    sink.deadline = monotonic() + 0.1
+    await sink.send_messages(_messages(3))
+    assert not _object_lines()
+
+    # the scrape is still running at the deadline, what is buffered is written
+    await asyncio.sleep(0.2)
+    await asyncio.gather(*sink._deadline_flushes)
+    assert _object_lines() == [3]
+
+    # then messages are written as they arrive
+    await sink.send_messages(_messages(2))
+    assert _object_lines() == [2, 3]
+
+    await sink.close()
+    assert _object_lines() == [2, 3]
+    assert (sink.throughput.messages, sink.throughput.requests) == (5, 2)
+
+
+async def test_scrape_to_file_sink(tmp_path):
+
+    conf = {
+        "static": {
+            "jobs": [
+                {
+                    "type": "alb",
+                    "regions": ["eu-west-2"],
+                    "dimensions": {"LoadBalancer": "app/file/1"},
+                    "metrics": [
+                        {
+                            "name": "RejectedConnectionCount",
+                            "stats": ["Sum"],
+                            "nil_to_zero": True,
+                        }
+                    ],
+                }
+            ]
+        }
+    }
+    path = tmp_path / "metrics.jsonl"
+    sink = FileSink(str(path))
+    with temp_config(conf):
+        config = ScrapeConfig()
+        executor = Executor(config, ClientFactory(config.sts_region), sink)
+        await executor.scrape_and_emit()
+
+    [message] = [json.loads(line) for line in path.read_text().splitlines()]
+    assert message["metric_name"] == "RejectedConnectionCount"
+    assert message["dimensions"] == {"LoadBalancer": "app/file/1"}
+    assert message["value"] == {"sum": 0}
+    assert (sink.throughput.messages, sink.throughput.requests) == (1, 1)
@@ -0,0 +1,133 @@
+import json
+
+from cache import HighWaterMarks, ResourceCache, TTLCache
+from clients import CloudWatchClient
+from model import CloudwatchMetric, CloudwatchMetricTask, Resource, ScrapePlan
+from snapshot import (
+    FileSnapshotStore,
+    S3SnapshotStore,
+    SnapshotStore,
+    get_snapshot_store,
+    restore_snapshot,
+    take_snapshot,
+)
+
+
+def _populated_caches() -> tuple[TTLCache, ResourceCache, TTLCache, HighWaterMarks]:
+
+    list_metrics_cache: TTLCache = TTLCache("test", 60)
+    list_metrics_cache.put(
+        ("eu-west-2", None, "AWS/S3", "NumberOfObjects", False, True),
+        [CloudwatchMetric(ns="AWS/S3", name="NumberOfObjects", dimensions={"a": "b"})],
+        fetched_at=100,
+    )
+
+    resource_cache = ResourceCache("test", 600)
+    resource_cache.put(
+        ("eu-west-2", None, "AWS/S3", ("s3",), ("project",)),
+        [Resource(ns="AWS/S3", arn="arn:aws:s3:::bucket", tags={"project": "odin"})],
+        fetched_at=100,
+        checked_at=200,
+    )
+
+    task = CloudwatchMetricTask(
+        ns="AWS/S3",
+        metric_name="NumberOfObjects",
+        resource_name="arn:aws:s3:::bucket",
+        dimensions={"a": "b"},
+        statistic="Average",
+        nil_to_zero=False,
+        add_cw_timestamp=True,
+        unit=None,
+        tags={"project": "odin"},
+    )
+    plan_key = ("hash", "eu-west-2", None)
+    scrape_plan_cache: TTLCache = TTLCache("test", 60)
+    scrape_plan_cache.put(
+        plan_key,
+        ScrapePlan(
+            key=plan_key,
+            buckets={
+                (60, 0, 300): CloudWatchClient.build_metric_data_batches(
+                    60, 300, [task]
+                )
+            },
+        ),
+        fetched_at=100,
+    )
+
+    high_water_marks = HighWaterMarks("test", enabled=True)
+    high_water_marks.advance(
+        ("eu-west-2", None, (60, 0, 300), task.signature), 1000, expires_at=1360
+    )
+
+    return list_metrics_cache, resource_cache, scrape_plan_cache, high_water_marks
+
+
+def _assert_round_trip(store: SnapshotStore):
+
+    assert store.load() is None
+
+    snapshot = take_snapshot(*_populated_caches())
+    store.save(snapshot)
+
+    loaded = store.load()
+    assert loaded is not None
+    assert loaded == json.loads(json.dumps(snapshot))
+
+    list_metrics_cache: TTLCache = TTLCache("test", 60)
+    resource_cache = ResourceCache("test", 600)
+    scrape_plan_cache: TTLCache = TTLCache("test", 60)
+    high_water_marks = HighWaterMarks("test", enabled=True)
+    restore_snapshot(
+        loaded, list_metrics_cache, resource_cache, scrape_plan_cache, high_water_marks
+    )
+
+    metrics = list_metrics_cache.peek(
+        ("eu-west-2", None, "AWS/S3", "NumberOfObjects", False, True)
+    )
+    assert metrics
+    assert metrics.fetched_at == 100
+    assert metrics.value[0].dimension_names == {"a"}
+
+    resources = resource_cache.peek(
+        ("eu-west-2", None, "AWS/S3", ("s3",), ("project",))
+    )
+    assert resources
+    assert resources.checked_at == 200
+    assert resources.resources[0].tags == {"project": "odin"}
+
+    plan = scrape_plan_cache.peek(("hash", "eu-west-2", None))
+    assert plan
+    batches = plan.value.buckets[(60, 0, 300)]
+    assert batches[0].tasks[0].signature == (
+        "AWS/S3",
+        "NumberOfObjects",
+        (("a", "b"),),
+        (("project", "odin"),),
+    )
+    assert batches[0].queries[0]["MetricStat"]["Stat"] == "Average"
+
+    [(key, mark)] = high_water_marks.items()
+    assert key == ("eu-west-2", None, (60, 0, 300), batches[0].tasks[0].signature)
+    assert (mark.timestamp, mark.expires_at) == (1000, 1360)
+
+
+def test_file_snapshot_round_trip(tmp_path):
+
+    store = get_snapshot_store(f"file://{tmp_path}/snapshot.json")
+    assert isinstance(store, FileSnapshotStore)
+    _assert_round_trip(store)
+
+
+def test_s3_snapshot_round_trip(test_bucket):
+
+    store = get_snapshot_store(f"s3://{test_bucket.name}/metrics/snapshot.json")
+    assert isinstance(store, S3SnapshotStore)
+    _assert_round_trip(store)
+
+
+def test_no_snapshot_store():
+
+    assert get_snapshot_store("") is None
+    assert get_snapshot_store(None) is None
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import re
+
+import clients
+import pytest
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from clients import CloudWatchClient, TaggingClient
+from model import DiscoveryJob
+from pytest_httpserver import HTTPServer
+from transport import ConnectionPool
+from werkzeug import Request, Response
+
+_CW_NS = "http://monitoring.amazonaws.com/doc/2010-08-01/"
+
+
+def _list_metrics_page(bucket: str, next_token: str | None) -> str:
+    token = f"<NextToken>{next_token}</NextToken>" if next_token else ""
+    return f"""<ListMetricsResponse xmlns="{_CW_NS}">
+  <ListMetricsResult>
+    <Metrics>
+      <member>
+        <Namespace>AWS/S3</Namespace>
+        <MetricName>NumberOfObjects</MetricName>
+        <Dimensions>
+          <member><Name>BucketName</Name><Value>{bucket}</Value></member>
+        </Dimensions>
+      </member>
+    </Metrics>
+    {token}
+  </ListMetricsResult>
+  <ResponseMetadata><RequestId>{bucket}</RequestId></ResponseMetadata>
+</ListMetricsResponse>"""
+
+
+@pytest.fixture
+def asyncio_transport(monkeypatch):
+    httpserver = HTTPServer()
+    httpserver.start()
+    monkeypatch.setattr(clients, "AWS_TRANSPORT", "asyncio")
+    monkeypatch.setenv("AWS_ENDPOINT_URL", httpserver.url_for("").rstrip("/"))
+    yield httpserver
+    httpserver.check_assertions()
+    httpserver.stop()
+
+
+async def test_list_metrics_pages(asyncio_transport: HTTPServer):
+
+    requests: list[dict] = []
+
+    def _handler(request: Request) -> Response:
+        assert request.headers["Authorization"].startswith("AWS4-HMAC-SHA256")
+        requests.append(dict(request.form))
+        next_token = None if request.form.get("NextToken") else "page-2"
+        bucket = "b2" if request.form.get("NextToken") else "b1"
+        return Response(_list_metrics_page(bucket, next_token), content_type="text/xml")
+
+    asyncio_transport.expect_request("/", method="POST").respond_with_handler(_handler)
+
+    client = CloudWatchClient(Config(region_name="eu-west-2"))
+    assert client._transport
+
+    job = DiscoveryJob(ns="AWS/S3", metrics=[])
+    pages = [page async for page in client.list_metrics("NumberOfObjects", job)]
+
+    assert [page[0].dimensions["BucketName"] for page in pages] == ["b1", "b2"]
+    assert [r["Action"] for r in requests] == ["ListMetrics", "ListMetrics"]
+    assert requests[0]["Namespace"] == "AWS/S3"
+    assert requests[1]["NextToken"] == "page-2"
+
+
+async def test_json_protocol_and_errors(asyncio_transport: HTTPServer):
+
+    arn = "arn:aws:s3:::bucket"
+    calls = 0
+
+    def _handler(request: Request) -> Response:
+        nonlocal calls
+        calls += 1
+        assert request.headers["X-Amz-Target"].endswith(".GetResources")
+        if calls in (1, 2):
+            error = "InvalidParameterException" if calls == 1 else "ThrottledException"
+            return Response(
+                json.dumps({"__type": error, "message": "nope"}),
+                status=400,
+                content_type="application/x-amz-json-1.1",
+            )
+        body = json.loads(request.data)
+        assert body == {"ResourceARNList": [arn]}
+        return Response(
+            json.dumps(
+                {
+                    "ResourceTagMappingList": [
+                        {
+                            "ResourceARN": arn,
+                            "Tags": [{"Key": "project", "Value": "odin"}],
+                        }
+                    ]
+                }
+            ),
+            content_type="application/x-amz-json-1.1",
+        )
+
+    asyncio_transport.expect_request("/", method="POST").respond_with_handler(_handler)
+
+    client = TaggingClient(Config(region_name="eu-west-2"))
+    job = DiscoveryJob(
+        ns="AWS/S3", metrics=[], search_tags={"project": re.compile("odin")}
+    )
+
+    with pytest.raises(ClientError) as error:
+        await client.get_resources_by_arn(job, [arn])
+    assert error.value.response["Error"]["Code"] == "InvalidParameterException"
+
+    # throttling is retried
+    resources = await client.get_resources_by_arn(job, [arn])
+    assert [(r.arn, r.tags) for r in resources] == [(arn, {"project": "odin"})]
+    assert calls == 3
+
+
+async def test_connection_pool_keep_alive():
+
+    connections = 0
+
+    async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        nonlocal connections
+        connections += 1
+        # answer two requests then close, as a server dropping idle connections would
+        for _ in range(2):
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"2\r\nok\r\n0\r\n\r\n"
+            )
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(_serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    pool = ConnectionPool("127.0.0.1", port, ssl_context=None, max_connections=2)
+
+    async with server:
+        responses = [
+            await pool.request("GET", "/", {"Host": "localhost"}, b"") for _ in range(3)
+        ]
+        pool.close()
+
+    assert [(r.status_code, r.body) for r in responses] == [(200, b"ok")] * 3
+    # the third request found the idle connection closed and reconnected
+    assert connections == 2
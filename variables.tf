@@ -77,11 +77,19 @@ variable "lambda_insights_layer_version" {
 }
 
 variable "queue_arn" {
-  type = string
+  type    = string
+  default = null
 }
 
 variable "queue_url" {
-  type = string
+  type    = string
+  default = null
+}
+
+variable "sink_url" {
+  description = "deliver the metrics to kinesis://<stream>, firehose://<delivery stream> or s3://<bucket>/<prefix> rather than the queue, add the sink permissions with policy_json"
+  type        = string
+  default     = null
 }
 
 variable "max_concurrency" {